@@ -1,8 +1,20 @@
-import tkinter as tk
-from tkinter import filedialog, messagebox
+import argparse
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache
+import heapq
+import itertools
+import json
 import math
+import os
+import numpy as np
 import pandas as pd
 import re
+import sys
+import tempfile
+import tracemalloc
+import warnings
 
 MAX_P300_HOLD_UL = 200   # hard cap for p300 holds/dispenses
 MAX_P1000_HOLD_UL = 900  # hard cap for p1000 holds/dispenses
@@ -31,22 +43,17 @@ def _find_stock_row(stocks_df: pd.DataFrame, stock_labware_slot, stock_well):
         return m2.index[0]
     return None  # allow graceful fallback
 
+# Inner diameters (cm) of custom labware; anything else is taken as DEFAULT_ID_CM
+_CUSTOM_ID_CM = {'ecmcustom_15_tuberack_14780ul': 1.83, 'avantorhplcvial_40_wellplate_1500ul': 1.0,
+                 'ecmcustom_40_wellplate_881.3ul': 0.6}
+DEFAULT_ID_CM = 3.0
+
 def lookup_id(operation, labware_data):
     """Return inner diameter (cm) for the *dispensing* vessel's labware."""
     dispensing_location = int(operation['stock labware location 1'])
-    lw = labware_data.copy()
-    lw['location'] = lw['location'].astype(int)
-    labware_name = str(lw.loc[lw['location'] == dispensing_location, 'labware_title'].iloc[0])
-
-    if labware_name == 'ecmcustom_15_tuberack_14780ul':
-        ID = 1.83
-    elif labware_name == 'avantorhplcvial_40_wellplate_1500ul':
-        ID = 1.0
-    elif labware_name == 'ecmcustom_40_wellplate_881.3ul':
-        ID = 0.6
-    else:
-        ID = 3.0
-    return ID
+    on_slot = labware_data['location'].astype(int) == dispensing_location
+    labware_name = str(labware_data.loc[on_slot, 'labware_title'].iloc[0])
+    return _CUSTOM_ID_CM.get(labware_name, DEFAULT_ID_CM)
 
 def _calc_height_and_update(stocks_df: pd.DataFrame, idx, transfer_ul, default_z=10.0, ID_CM=1.83):
     """Compute a safe aspirate height (mm) and update stock volume if row exists; else return default_z."""
@@ -157,11 +164,11 @@ def _coerce_priority_series(df: pd.DataFrame) -> pd.Series:
 
 def _apply_priority_sort(ops_df: pd.DataFrame) -> pd.DataFrame:
     """Return operations sorted by priority (ascending). Ties keep original CSV order."""
-    ops = ops_df.copy()
-    ops['__row__'] = range(len(ops))  # stable tie-breaker
-    ops['__priority__'] = _coerce_priority_series(ops)
-    ops = ops.sort_values(['__priority__', '__row__'], kind='stable')
-    return ops.drop(columns=['__priority__', '__row__'])
+    priority = _coerce_priority_series(ops_df).to_numpy()
+    order = np.argsort(priority, kind='stable')  # stable: row order breaks ties
+    if (order == np.arange(len(order))).all():
+        return ops_df  # already in order: no copy
+    return ops_df.iloc[order]
 
 # ---------------- Mix handling ----------------
 
@@ -171,7 +178,15 @@ _MIX_VOL_SYNONYMS  = ['mix volume', 'mix_volume', 'mix vol', 'mix_vol']
 _MIX_EACH_CHUNK_SYNONYMS = ['mix each chunk', 'mix_each_chunk', 'mix per chunk', 'mix_per_chunk']
 
 def _col_lookup_case_insensitive(df: pd.DataFrame, candidates):
-    name_map = {c.lower(): c for c in df.columns}
+    return _lookup_column(tuple(df.columns), tuple(candidates))
+
+def _row_col(row, candidates):
+    """_col_lookup_case_insensitive for one row (a Series or a dict of column -> value)."""
+    return _lookup_column(tuple(row.keys()), tuple(candidates))
+
+@lru_cache(maxsize=256)
+def _lookup_column(columns: tuple, candidates: tuple):
+    name_map = {c.lower(): c for c in columns}
     for k in candidates:
         if k.lower() in name_map:
             return name_map[k.lower()]
@@ -185,11 +200,11 @@ def _truthy(v) -> bool:
 
 def _extract_mix_params(op_row: pd.Series, pip_max_ul: float, total_vol_ul: float):
     # Determine if mix is requested
-    mix_flag_col = _col_lookup_case_insensitive(op_row.to_frame().T, _MIX_FLAG_SYNONYMS)
+    mix_flag_col = _row_col(op_row, _MIX_FLAG_SYNONYMS)
     do_mix = _truthy(op_row[mix_flag_col]) if mix_flag_col else False
 
     # reps
-    reps_col = _col_lookup_case_insensitive(op_row.to_frame().T, _MIX_REPS_SYNONYMS)
+    reps_col = _row_col(op_row, _MIX_REPS_SYNONYMS)
     reps = DEFAULT_MIX_REPS
     if reps_col is not None and not pd.isna(op_row[reps_col]):
         try:
@@ -198,7 +213,7 @@ def _extract_mix_params(op_row: pd.Series, pip_max_ul: float, total_vol_ul: floa
             pass
 
     # volume
-    vol_col = _col_lookup_case_insensitive(op_row.to_frame().T, _MIX_VOL_SYNONYMS)
+    vol_col = _row_col(op_row, _MIX_VOL_SYNONYMS)
     if vol_col is not None and not pd.isna(op_row[vol_col]):
         try:
             mix_vol = float(op_row[vol_col])
@@ -209,33 +224,1104 @@ def _extract_mix_params(op_row: pd.Series, pip_max_ul: float, total_vol_ul: floa
     mix_vol = max(1.0, min(mix_vol, pip_max_ul))
 
     # each-chunk?
-    each_col = _col_lookup_case_insensitive(op_row.to_frame().T, _MIX_EACH_CHUNK_SYNONYMS)
+    each_col = _row_col(op_row, _MIX_EACH_CHUNK_SYNONYMS)
     mix_each_chunk = _truthy(op_row[each_col]) if each_col else False
 
     return do_mix, reps, mix_vol, mix_each_chunk
 
-# ---------------------------------------------------
+# ---------------- Consolidation ----------------
 
-def generate_protocol(stock_data: pd.DataFrame, labware_data: pd.DataFrame, operation_data: pd.DataFrame, save_path: str):
-    # Build labware section
-    content = [
-        "from opentrons import protocol_api",
-        "",
-        "metadata = {",
-        "    'apiLevel': '2.15',",
-        "    'protocolName': 'Automatic Protocol',",
-        "    'author': 'Generated'",
-        "}",
-        "",
-        "def run(protocol: protocol_api.ProtocolContext):",
-        "    # Load labware",
-    ]
+_CONSOLIDATE_SYNONYMS = ['consolidate', 'consolidate group', 'consolidate_group', 'compatible group', 'compatible_group']
+CONSOLIDATE_AIR_GAP_UL = 10.0
 
-    labware_map = {}
+def _consolidate_group(op_row: pd.Series):
+    """The row's consolidate group label, or None. Rows with the same label hold compatible sources."""
+    col = _row_col(op_row, _CONSOLIDATE_SYNONYMS)
+    if col is None or pd.isna(op_row[col]):
+        return None
+    label = str(op_row[col]).strip()
+    if not label or label.lower() in ('0', '0.0', 'false', 'f', 'no', 'n', 'off'):
+        return None
+    return label
+
+# ---------------- Multichannel handling ----------------
+
+MULTI_CHANNELS = 8
+_MULTI_ROWS = 'ABCDEFGH'
+
+def _split_well(well):
+    """'B3' -> ('B', 3). Returns None for names that are not <row letter><column number>."""
+    m = re.match(r'^\s*([A-Za-z])\s*0*(\d+)\s*$', str(well))
+    if not m:
+        return None
+    return m.group(1).upper(), int(m.group(2))
+
+def _column_of(wells):
+    """Return the column number if 'wells' are exactly A..H of one column (in order); else None."""
+    parts = [_split_well(w) for w in wells]
+    if any(p is None for p in parts):
+        return None
+    cols = {p[1] for p in parts}
+    if len(cols) != 1 or ''.join(p[0] for p in parts) != _MULTI_ROWS:
+        return None
+    return cols.pop()
+
+def _is_multichannel_block(block: list, labware_titles: dict) -> bool:
+    """
+    True if MULTI_CHANNELS consecutive operations (a list of rows) can be done by an 8-channel pipette in one pass:
+      - same receiving slot, receiving wells A..H of one column, equal volumes, no mixing
+      - sources are either A..H of one column on one slot (column -> column), or one
+        well of a 'reservoir' labware (reservoir -> column)
+    Only consecutive rows are grouped so the (priority-sorted) execution order is preserved.
+    """
+    if len(block) != MULTI_CHANNELS:
+        return False
+    dst_slots = {int(r['receiving labware location']) for r in block}
+    src_slots = {int(r['stock labware location 1']) for r in block}
+    vols = {float(r['volume 1']) for r in block}
+    src_wells = [str(r['stock well location 1']).strip() for r in block]
+    dst_wells = [str(r['receiving well location']).strip() for r in block]
+
+    ok = len(dst_slots) == 1 and len(src_slots) == 1 and len(vols) == 1
+    ok = ok and _column_of(dst_wells) is not None
+    ok = ok and not any(_extract_mix_params(r, MAX_P300_HOLD_UL, float(r['volume 1']))[0] for r in block)
+    if ok:
+        src_title = str(labware_titles.get(next(iter(src_slots)), '')).lower()
+        from_reservoir = len(set(src_wells)) == 1 and 'reservoir' in src_title
+        ok = from_reservoir or _column_of(src_wells) is not None
+    return ok
+
+# ---------------- Labware definitions and well index ----------------
+
+LABWARE_DIRS_ENV = 'OPENTRONS_LABWARE_DIRS'  # os.pathsep-separated folders of labware definition JSON files
+
+def canonical_well(name):
+    """'a01', ' A1 ' -> 'A1'. Returns None for names that are not <row letter><column number>."""
+    parts = _split_well(name)
+    return f"{parts[0]}{parts[1]}" if parts else None
+
+class WellIndex:
+    """
+    Wells of one labware definition: canonical name -> int index (definition ordering, column by column)
+    with per-index XYZ (mm, labware frame), diameter (mm, None if not circular) and capacity (µL).
+    """
+    __slots__ = ('load_name', 'names', 'index', 'xyz', 'diameter_mm', 'capacity_ul')
+
+    def __init__(self, definition: dict):
+        self.load_name = definition.get('parameters', {}).get('loadName', '')
+        self.names = [canonical_well(w) or w for column in definition['ordering'] for w in column]
+        self.index = {w: i for i, w in enumerate(self.names)}
+        wells = {canonical_well(k) or k: v for k, v in definition['wells'].items()}
+        self.xyz = np.array([[wells[w]['x'], wells[w]['y'], wells[w]['z']] for w in self.names], dtype='float64')
+        self.diameter_mm = [wells[w].get('diameter') for w in self.names]
+        self.capacity_ul = np.array([wells[w].get('totalLiquidVolume', np.nan) for w in self.names], dtype='float64')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, well):
+        return canonical_well(well) in self.index
+
+    def __getitem__(self, well) -> int:
+        return self.index[canonical_well(well)]
+
+def labware_search_dirs(extra=()) -> tuple:
+    """Folders searched for labware definitions: 'extra', then $OPENTRONS_LABWARE_DIRS, then opentrons' own."""
+    dirs = [str(d) for d in extra]
+    dirs += [d for d in os.environ.get(LABWARE_DIRS_ENV, '').split(os.pathsep) if d]
+    try:
+        import opentrons_shared_data
+        dirs.append(os.path.join(os.path.dirname(opentrons_shared_data.__file__), 'data', 'labware', 'definitions', '2'))
+    except ImportError:
+        pass
+    return tuple(dirs)
+
+@lru_cache(maxsize=None)
+def load_well_index(load_name: str, dirs: tuple):
+    """
+    WellIndex for 'load_name' from '<dir>/<load_name>.json' or '<dir>/<load_name>/<version>.json'
+    (latest version) in the first folder of 'dirs' that has it. None if no definition is found.
+    Cached: every definition file is parsed once per process.
+    """
+    for d in dirs:
+        candidates = [os.path.join(d, f"{load_name}.json")]
+        versions = os.path.join(d, load_name)
+        if os.path.isdir(versions):
+            names = [f for f in os.listdir(versions) if f.endswith('.json')]
+            names.sort(key=lambda f: int(re.sub(r'\D', '', f) or 0), reverse=True)
+            candidates += [os.path.join(versions, f) for f in names]
+        for path in candidates:
+            if os.path.isfile(path):
+                with open(path, encoding='utf-8') as f:
+                    return WellIndex(json.load(f))
+    return None
+
+def _deck_well_indexes(labware_titles: dict, labware_dirs=()) -> dict:
+    """{slot: WellIndex} for every labware whose definition can be found."""
+    dirs = labware_search_dirs(labware_dirs)
+    indexes = {}
+    for slot, title in labware_titles.items():
+        idx = load_well_index(title, dirs)
+        if idx is not None:
+            indexes[slot] = idx
+    return indexes
+
+def _prepare_stocks(stock_data: pd.DataFrame, labware_titles: dict, well_indexes: dict) -> pd.DataFrame:
+    """
+    Make stock volumes float and well names canonical (in place), then check every stock against the deck:
+    a well missing from its labware definition is an error, a stock on a slot without labware is a warning.
+    """
+    # Volumes are drawn down by fractional chunks; an integer column (e.g. from CSV) can't hold them
+    stock_data['volume(ul)'] = stock_data['volume(ul)'].astype(float)
+    wells = stock_data['well location'].astype(str)
+    stock_data['well location'] = wells.map(lambda w: canonical_well(w) or w.strip())
+    problems = []
+    for k, row in stock_data.iterrows():
+        slot = int(row['labware location'])
+        if slot not in labware_titles:
+            warnings.warn(f"Stock '{row['stock name']}' (row {k + 1}) is in slot {slot}, which has no labware "
+                          f"in the labware sheet; it can't match any transfer source.")
+        elif slot in well_indexes and row['well location'] not in well_indexes[slot]:
+            problems.append(f"stock row {k + 1}: {slot}:{row['well location']} is not a well of {labware_titles[slot]}")
+    if problems:
+        raise RuntimeError("Unknown wells in stock table:\n  " + '\n  '.join(problems))
+    return stock_data
+
+def _check_ops_wells(ops: pd.DataFrame, labware_titles: dict, well_indexes: dict):
+    """Raise listing every transfer row whose slot has no labware or whose well is not in the labware definition."""
+    problems = []
+    columns = [ops[c].to_numpy() for c in ('stock labware location 1', 'stock well location 1',
+                                          'receiving labware location', 'receiving well location')]
+    for k, action, src_slot, src_well, dst_slot, dst_well in zip(ops.index, _action_mask(ops), *columns):
+        if action:
+            continue
+        for slot, well, role in ((int(src_slot), src_well, 'source'), (int(dst_slot), dst_well, 'destination')):
+            if slot not in labware_titles:
+                problems.append(f"transfers row {k + 1}: {role} slot {slot} has no labware")
+            elif slot in well_indexes and well not in well_indexes[slot]:
+                problems.append(f"transfers row {k + 1}: {role} {slot}:{well} is not a well of {labware_titles[slot]}")
+    if problems:
+        raise RuntimeError("Unknown wells in transfers:\n  " + '\n  '.join(problems))
+
+# ---------------- Volume pre-flight ----------------
+
+DEAD_HEIGHT_MM = 1.0  # lowest aspirate height: the liquid below it can't be drawn
+_CAPACITY_SYNONYMS = ['capacity', 'capacity (ul)', 'well capacity', 'max volume', 'max volume (ul)']
+_DEAD_VOLUME_SYNONYMS = ['dead volume', 'dead volume (ul)', 'dead_volume', 'dead vol']
+
+def _sheet_value(lw: pd.Series, synonyms):
+    col = _row_col(lw, synonyms)
+    if col is None or pd.isna(lw[col]) or str(lw[col]).strip() == '':
+        return None
+    return float(lw[col])
+
+def _well_limits(labware_data: pd.DataFrame, well_indexes: dict):
+    """
+    (capacity(slot, well), dead volume {slot: µL}). A capacity comes from the labware sheet's capacity
+    column, the definition's totalLiquidVolume or a '<n>ul' in the load name, else NaN (unchecked).
+    A dead volume comes from the sheet, else is the liquid below DEAD_HEIGHT_MM in a known inner
+    diameter (lookup_id's custom labware or the definition's circular wells), else 0.
+    """
+    sheet_cap, name_cap, dead = {}, {}, {}
+    for _, lw in labware_data.iterrows():
+        slot, title = int(lw['location']), str(lw['labware_title']).strip()
+        cap = _sheet_value(lw, _CAPACITY_SYNONYMS)
+        if cap is not None:
+            sheet_cap[slot] = cap
+        m = re.findall(r'(\d+(?:\.\d+)?)ul', title, re.IGNORECASE)
+        if m and 'tiprack' not in title.lower():
+            name_cap[slot] = float(m[-1])
+        dead[slot] = _sheet_value(lw, _DEAD_VOLUME_SYNONYMS)
+        if dead[slot] is None:
+            diameters = [d for d in well_indexes[slot].diameter_mm if d] if slot in well_indexes else []
+            diameter_mm = 10.0 * _CUSTOM_ID_CM[title] if title in _CUSTOM_ID_CM else min(diameters, default=0.0)
+            dead[slot] = round(math.pi * (diameter_mm / 2) ** 2 * DEAD_HEIGHT_MM, 1)
+
+    def capacity(slot, well):
+        if slot in sheet_cap:
+            return sheet_cap[slot]
+        index = well_indexes.get(slot)
+        if index is not None and well in index and not np.isnan(index.capacity_ul[index[well]]):
+            return float(index.capacity_ul[index[well]])
+        return name_cap.get(slot, np.nan)
+
+    return capacity, dead
+
+def volume_violations(ops: pd.DataFrame, stock_data: pd.DataFrame, labware_data: pd.DataFrame,
+                      well_indexes: dict, labware_titles: dict, pool_stocks: bool = False) -> list:
+    """
+    Check normalized rows in run order (index = sheet row) against well capacities and dead volumes
+    (see _well_limits) and return one message per violating row: a destination filled past its
+    capacity, or a source drawn below its dead volume. Fills and draws are summed per vessel in one
+    pass; sources with neither a stock row nor an earlier fill are not checked. With pool_stocks a
+    pooled stock is checked as a whole.
+    """
+    rows = ops[~_action_mask(ops)]
+    if rows.empty:
+        return []
+    capacity, dead = _well_limits(labware_data, well_indexes)
+    src_slot = rows['stock labware location 1'].astype(int).to_numpy()
+    dst_slot = rows['receiving labware location'].astype(int).to_numpy()
+    src_well = rows['stock well location 1'].astype(str).to_numpy()
+    dst_well = rows['receiving well location'].astype(str).to_numpy()
+    src = np.char.add(np.char.add(src_slot.astype(str), ':'), src_well).astype(object)
+    dst = np.char.add(np.char.add(dst_slot.astype(str), ':'), dst_well).astype(object)
+    volume = rows['volume 1'].astype(float).to_numpy()
+
+    names = stock_data['stock name'].astype(str).str.strip()
+    stock_slot = stock_data['labware location'].astype(int)
+    keys = stock_slot.astype(str) + ':' + stock_data['well location'].astype(str)
+    initial = stock_data['volume(ul)'].astype(float).groupby(keys).sum().to_dict()
+    pool_floor = {}
+    if pool_stocks:
+        # A row's stock is named in the stock-name column, else found by (slot, well), else by its well (legacy)
+        counts = names.value_counts()
+        name_of_key = dict(zip(keys[::-1], names[::-1]))
+        known = set(names)
+        name_col = _col_lookup_case_insensitive(rows, _STOCK_NAME_SYNONYMS)
+        given = (rows[name_col].astype(str).str.strip().where(rows[name_col].notna(), '').to_numpy()
+                 if name_col is not None else np.full(len(rows), '', dtype=object))
+        stock = [g or name_of_key.get(k) or (w.strip() if w.strip() in known else None)
+                 for g, k, w in zip(given, src, src_well)]
+        for k, name in enumerate(stock):
+            if name is not None and counts.get(name, 0) > 1:
+                src[k] = f"pool:{name}"
+        dead_of = stock_slot.map(lambda slot: dead.get(slot, 0.0))
+        for name in {v[5:] for v in src if v.startswith('pool:')}:
+            members = names == name
+            initial[f"pool:{name}"] = float(stock_data.loc[members, 'volume(ul)'].astype(float).sum())
+            pool_floor[f"pool:{name}"] = float(dead_of[members].sum())
+
+    # Each row draws from its source, then fills its destination
+    n = len(rows)
+    vessel = np.empty(2 * n, dtype=object)
+    vessel[0::2], vessel[1::2] = src, dst
+    delta = np.empty(2 * n)
+    delta[0::2], delta[1::2] = -volume, volume
+    codes, uniques = pd.factorize(vessel)
+    start = np.array([initial.get(u, np.nan) for u in uniques])[codes]
+    # Running level per vessel: sort events by vessel (stable, so run order is kept within one)
+    order = np.argsort(codes, kind='stable')
+    new_vessel = np.r_[True, codes[order][1:] != codes[order][:-1]]
+    group = np.cumsum(new_vessel) - 1
+    group_start = np.flatnonzero(new_vessel)
+    running = np.cumsum(delta[order])
+    level = np.empty(2 * n)
+    level[order] = running - np.r_[0.0, running[group_start[1:] - 1]][group]
+    level += np.nan_to_num(start)
+    fills = delta > 0
+    last_fill = np.maximum.accumulate(np.where(fills[order], np.arange(2 * n), -1))
+    filled_before = np.empty(2 * n, dtype=bool)
+    filled_before[order] = last_fill >= group_start[group]
+
+    slot_of = np.array([int(u.split(':', 1)[0]) if not u.startswith('pool:') else -1 for u in uniques])
+    cap = np.full(len(uniques), np.nan)
+    for u in np.unique(codes[1::2]):
+        cap[u] = capacity(int(slot_of[u]), uniques[u].split(':', 1)[1])
+    floor = np.array([pool_floor[u] if slot_of[k] < 0 else dead.get(int(slot_of[k]), 0.0)
+                      for k, u in enumerate(uniques)])
+    over = fills & (level > cap[codes] + 1e-6)
+    under = ~fills & (~np.isnan(start) | filled_before) & (level < floor[codes] - 1e-6)
+
+    sheet_row = np.repeat(rows.index.to_numpy() + 1, 2)
+    problems = []
+    for e in np.flatnonzero(over | under):
+        v = vessel[e]
+        if over[e]:
+            slot = int(slot_of[codes[e]])
+            problems.append((sheet_row[e], f"transfers row {sheet_row[e]}: {v} ({labware_titles.get(slot, '?')}) "
+                                           f"reaches {level[e]:.1f} µL, over its {cap[codes[e]]:g} µL capacity"))
+        else:
+            problems.append((sheet_row[e], f"transfers row {sheet_row[e]}: {v} is drawn down to {level[e]:.1f} µL, "
+                                           f"below its {floor[codes[e]]:g} µL dead volume"))
+    return [message for _, message in sorted(problems, key=lambda p: p[0])]
+
+# ---------------- Replicate stock pooling ----------------
+
+_STOCK_NAME_SYNONYMS = ['stock name 1', 'stock name', 'stock_name', 'stock_name_1']
+POOL_MIN_HEIGHT_MM = 6.0  # below this the aspirate height sits on the 1 mm floor (surface - 5 mm)
+
+def _replicates(stocks_df: pd.DataFrame, name) -> list:
+    """Indices of all stock rows named 'name' (whitespace-insensitive)."""
+    names = stocks_df['stock name'].astype(str).str.strip()
+    return list(stocks_df.index[names == str(name).strip()])
+
+def _resolve_named_sources(ops_df: pd.DataFrame, stocks_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rows that give their source only by stock name (stock-name column, blank slot/well) get the
+    first replicate's slot and well, so every row has a concrete source. Raises for unknown names.
+    """
+    name_col = _col_lookup_case_insensitive(ops_df, _STOCK_NAME_SYNONYMS)
+    if name_col is None:
+        return ops_df
+    named = ops_df[name_col].notna() & ops_df[name_col].astype(str).str.strip().ne('')
+    for k in ops_df.index[named & ops_df['stock labware location 1'].isna()]:
+        reps = _replicates(stocks_df, ops_df.at[k, name_col])
+        if not reps:
+            raise RuntimeError(f"Transfer references unknown stock '{ops_df.at[k, name_col]}'.")
+        ops_df.at[k, 'stock labware location 1'] = stocks_df.at[reps[0], 'labware location']
+        ops_df.at[k, 'stock well location 1'] = str(stocks_df.at[reps[0], 'well location']).strip()
+    return ops_df
+
+def _stock_pool_of(op_row: pd.Series, stocks_df: pd.DataFrame):
+    """
+    (stock name, [replicate stock indices]) if the row's stock has more than one well: either named
+    in the stock-name column or addressed by (slot, well) of a replicated stock. Else None.
+    """
+    if _action_of(op_row):
+        return None
+    name_col = _row_col(op_row, _STOCK_NAME_SYNONYMS)
+    name = None
+    if name_col is not None and not pd.isna(op_row[name_col]) and str(op_row[name_col]).strip():
+        name = str(op_row[name_col]).strip()
+    else:
+        idx = _find_stock_row(stocks_df, op_row['stock labware location 1'], op_row['stock well location 1'])
+        if idx is not None:
+            name = str(stocks_df.at[idx, 'stock name']).strip()
+    if name is None:
+        return None
+    reps = _replicates(stocks_df, name)
+    return (name, reps) if len(reps) > 1 else None
+
+def _pick_replicate(stocks_df: pd.DataFrame, replicates: list, chunk_ul: float, labware_data: pd.DataFrame):
+    """
+    Choose the replicate to draw 'chunk_ul' from: the one with the highest liquid level among those that
+    stay above POOL_MIN_HEIGHT_MM after the draw; if none does, the highest one overall.
+    Returns (stock index, liquid height after the draw in mm).
+    """
+    best, best_ok = None, None
+    for idx in replicates:
+        slot = int(stocks_df.at[idx, 'labware location'])
+        id_cm = float(lookup_id({'stock labware location 1': slot}, labware_data))
+        area = math.pi * (id_cm * 0.5) ** 2
+        post_mm = (float(stocks_df.at[idx, 'volume(ul)']) - float(chunk_ul)) / 1000.0 / area * 10.0
+        if best is None or post_mm > best[1]:
+            best = (idx, post_mm)
+        if post_mm >= POOL_MIN_HEIGHT_MM and (best_ok is None or post_mm > best_ok[1]):
+            best_ok = (idx, post_mm)
+    return best_ok if best_ok is not None else best
+
+# ---------------- Tip compatibility ----------------
+
+_STOCK_CLASS_SYNONYMS = ['class', 'stock class', 'stock_class', 'liquid class', 'liquid_class', 'compatibility class']
+
+class TipCompatibility:
+    """
+    Which stocks may share a tip. A tip that has drawn stock A may go on to draw stock B if A and B
+    have the same name (e.g. MeCN in 7:A1 and in 7:A2), or, with same_class=True, the same class,
+    or if (A, B) is listed in 'safe_after' by name or class, e.g. ('diluent', 'reagent').
+    Classes come from 'classes' {stock name: class}, then from a 'class' column of the stock sheet.
+    Wells filled during the run are mixtures named '<slot>:<well>' and only match themselves.
+    """
+
+    def __init__(self, classes=None, same_class=False, safe_after=()):
+        self.classes = dict(classes or {})
+        self.same_class = bool(same_class)
+        self.safe_after = {tuple(pair) for pair in safe_after}
+
+    def with_sheet_classes(self, stocks_df: pd.DataFrame):
+        """Copy with classes from the stock sheet's class column filled in (explicit ones win)."""
+        col = _col_lookup_case_insensitive(stocks_df, _STOCK_CLASS_SYNONYMS)
+        new = TipCompatibility(self.classes, self.same_class, self.safe_after)
+        if col is not None:
+            for name, cls in zip(stocks_df['stock name'], stocks_df[col]):
+                if not pd.isna(cls) and str(cls).strip():
+                    new.classes.setdefault(str(name).strip(), str(cls).strip())
+        return new
+
+    def compatible(self, drawn: str, nxt: str) -> bool:
+        """True if a tip that drew 'drawn' may draw 'nxt' without contaminating it."""
+        if drawn == nxt:
+            return True
+        a, b = self.classes.get(drawn), self.classes.get(nxt)
+        if self.same_class and a is not None and a == b:
+            return True
+        return any(pair in self.safe_after for pair in ((drawn, nxt), (a, nxt), (drawn, b), (a, b)))
+
+def _tip_compatibility(spec):
+    """TipCompatibility from build_plan's option: None, True (same name only), a dict of keyword args or an instance."""
+    if spec is None or spec is False:
+        return None
+    if spec is True:
+        return TipCompatibility()
+    if isinstance(spec, dict):
+        return TipCompatibility(**spec)
+    return spec
+
+# ---------------- Plate-map front end ----------------
+
+_PLATE_MAP_KEY_COLS = ['receiving labware location', 'receiving well location']
+_FINAL_VOLUME_SYNONYMS = ['final volume', 'final volume (ul)', 'final_volume', 'total volume']
+_STOCK_CONC_SYNONYMS = ['concentration', 'conc', 'stock concentration', 'stock_concentration']
+
+def plate_map_to_transfers(plate_map: pd.DataFrame, stock_data: pd.DataFrame, final_volume_ul=None,
+                           mode: str = 'concentration', stock_concentrations: dict = None,
+                           diluent: str = None, mix: bool = False) -> pd.DataFrame:
+    """
+    Expand a wide plate map into the long-form transfers table build_plan consumes.
+
+    plate_map: one row per destination ('receiving labware location', 'receiving well location'),
+      one column per stock name. Values are target concentrations (mode='concentration') or
+      volumes in µL (mode='volume'); blank/0 means the stock is not added. Wells are made canonical
+      ('a01' -> 'A1'); names that aren't wells, and negative or non-numeric values, are errors.
+    final_volume_ul: scalar, or None to use the map's 'final volume' column. Needed for
+      concentrations (C1V1 = C2V2) and for diluent make-up.
+    stock_concentrations: {stock name: concentration}; defaults to a 'concentration' column in stock_data.
+    diluent: stock name that tops every well up to the final volume (added first).
+    mix: flag each well's last addition for mixing.
+
+    Additions are ordered diluent first, then stock by stock (plate-map column order), so each
+    source is used in one run. Sources resolve to the stock's first well; the 'stock name' column
+    lets pool_stocks spread the draw over replicates.
+    """
+    missing = [c for c in _PLATE_MAP_KEY_COLS if c not in plate_map.columns]
+    if missing:
+        raise RuntimeError(f"Plate map is missing required columns: {missing}")
+    final_col = _col_lookup_case_insensitive(plate_map, _FINAL_VOLUME_SYNONYMS)
+    stock_cols = [c for c in plate_map.columns if c not in _PLATE_MAP_KEY_COLS and c != final_col]
+    if not stock_cols:
+        raise RuntimeError("Plate map has no stock columns.")
+
+    n = len(plate_map)
+    dst_slot = plate_map['receiving labware location'].to_numpy()
+    raw_wells = plate_map['receiving well location'].astype(str).str.strip()
+    dst_well = raw_wells.map(canonical_well).to_numpy()
+
+    def where(k):
+        return f"{dst_slot[k]}:{raw_wells.iloc[k]}"
+
+    bad = [where(k) for k in range(n) if pd.isna(dst_well[k])]
+    if bad:
+        raise RuntimeError(f"Plate map has {len(bad)} rows whose well is not a well name, e.g. {bad[:10]}")
+    cells = plate_map[stock_cols]
+    values = cells.apply(pd.to_numeric, errors='coerce')
+    blank = cells.isna() | cells.astype(str).apply(lambda col: col.str.strip().eq(''))
+    bad = [f"{where(k)} {stock_cols[j]}={cells.iat[k, j]}"
+           for k, j in zip(*np.nonzero(((values.isna() & ~blank) | (values < 0)).to_numpy()))]
+    if bad:
+        raise RuntimeError(f"Plate map has {len(bad)} non-numeric or negative values, e.g. {bad[:10]}")
+    values = values.fillna(0.0).to_numpy(dtype='float64')
+    if final_volume_ul is not None:
+        final = np.full(n, float(final_volume_ul))
+    elif final_col is not None:
+        final = pd.to_numeric(plate_map[final_col], errors='coerce').to_numpy(dtype='float64')
+    else:
+        final = None
+
+    if mode == 'concentration':
+        if final is None:
+            raise RuntimeError("Concentration plate maps need a final volume.")
+        if stock_concentrations is None:
+            conc_col = _col_lookup_case_insensitive(stock_data, _STOCK_CONC_SYNONYMS)
+            if conc_col is None:
+                raise RuntimeError("No stock concentrations given and the stock table has no 'concentration' column.")
+            by_name = stock_data.assign(_n=stock_data['stock name'].astype(str).str.strip()).groupby('_n')[conc_col].first()
+            stock_concentrations = by_name.to_dict()
+        unknown = [c for c in stock_cols if str(c).strip() not in stock_concentrations]
+        if unknown:
+            raise RuntimeError(f"No concentration for stocks: {unknown}")
+        conc = np.array([float(stock_concentrations[str(c).strip()]) for c in stock_cols])
+        volumes = values / conc[None, :] * final[:, None]   # C1V1 = C2V2
+    elif mode == 'volume':
+        volumes = values
+    else:
+        raise ValueError(f"Unknown plate map mode '{mode}'")
+    volumes = np.round(volumes, 2)
+
+    names = [str(c).strip() for c in stock_cols]
+    if diluent is not None:
+        if final is None:
+            raise RuntimeError("Diluent make-up needs a final volume.")
+        makeup = np.round(final - volumes.sum(axis=1), 2)
+        over = np.flatnonzero(makeup < 0)
+        if len(over):
+            wells = [where(k) for k in over[:10]]
+            raise RuntimeError(f"{len(over)} wells need more than the final volume before diluent, e.g. {wells}")
+        volumes = np.column_stack([makeup, volumes])
+        names = [str(diluent).strip()] + names
+
+    # Source (slot, well) per stock name: first listed well
+    src_slot, src_well = [], []
+    for name in names:
+        reps = _replicates(stock_data, name)
+        if not reps:
+            raise RuntimeError(f"Plate map uses stock '{name}', which is not in the stock table.")
+        src_slot.append(int(stock_data.at[reps[0], 'labware location']))
+        src_well.append(str(stock_data.at[reps[0], 'well location']).strip())
+
+    # Long form, stock-major: all additions of one stock before the next
+    stock_idx, well_idx = np.nonzero(volumes.T > 0)
+    names_arr = np.array(names, dtype=object)
+    transfers = pd.DataFrame({
+        'receiving labware location': dst_slot[well_idx].astype(int),
+        'receiving well location': dst_well[well_idx],
+        'stock labware location 1': np.array(src_slot)[stock_idx],
+        'stock well location 1': np.array(src_well, dtype=object)[stock_idx],
+        'stock name': names_arr[stock_idx],
+        'volume 1': volumes.T[stock_idx, well_idx],
+        'priority': stock_idx + 1,
+    })
+    if mix:
+        last = ~pd.Series(well_idx).duplicated(keep='last').to_numpy()
+        transfers['mix'] = np.where(last, 'yes', '')
+    return transfers
+
+# ---------------- Serial-dilution planner ----------------
+
+MIN_ACCURATE_FRACTION = 0.1  # smallest volume a pipette handles accurately, as a fraction of its max hold
+MIN_ACCURATE_UL = MIN_ACCURATE_FRACTION * min(MAX_P300_HOLD_UL, MAX_P1000_HOLD_UL)
+
+def _dilution_ok(c_target, c_source, volume_ul, min_ul):
+    """Can 'volume_ul' of c_target be made from c_source with accurate source and diluent volumes?"""
+    v_src = c_target / c_source * volume_ul
+    v_dil = volume_ul - v_src
+    return v_src >= min_ul and (v_dil < 0.005 or v_dil >= min_ul)
+
+def plan_dilution_series(targets: dict, stock_conc: float, final_volume_ul: float,
+                         stock: tuple, diluent: tuple, dest_slot: int, spare_wells=(),
+                         dead_volume_ul: float = 50.0, max_well_ul: float = None,
+                         min_volume_ul: float = MIN_ACCURATE_UL) -> pd.DataFrame:
+    """
+    Plan calibration standards {well: concentration} in 'dest_slot' from one stock (slot, well) and a
+    diluent (slot, well), as transfers rows for build_plan.
+
+    Each standard is made from the most concentrated available source (stock or an already planned
+    well) whose source and diluent volumes are both >= min_volume_ul, so direct dilution is used
+    whenever it is accurate. Only when nothing qualifies is an intermediate planned in one of
+    'spare_wells' (serial chain). Wells that feed others are prepared with extra volume: the draws
+    plus 'dead_volume_ul' for intermediates; targets keep 'final_volume_ul' after the draws.
+    Blanks (concentration 0) get 'final_volume_ul' of diluent only.
+
+    Rows: all diluent additions first (one tip), then concentrate additions level by level, each
+    mixed once (one mix per well). A summary dict is in result.attrs['summary'].
+    """
+    stock_conc = float(stock_conc)
+    spare = [str(w).strip() for w in spare_wells]
+    wells = {}  # well -> {'conc', 'source' (well or None for stock), 'target': bool}
+    by_conc = sorted(((float(c), str(w).strip()) for w, c in targets.items()), reverse=True)
+    negative = [w for c, w in by_conc if c < 0]
+    if negative:
+        raise RuntimeError(f"Negative target concentrations for {negative}.")
+    blanks = [w for c, w in by_conc if c == 0]
+
+    def best_source(c, volume_ul):
+        # Highest-concentration source first: smallest draw, shortest chain
+        cands = [(stock_conc, None)] + sorted(((v['conc'], w) for w, v in wells.items()), reverse=True)
+        for c_src, w in cands:
+            if c_src > c and _dilution_ok(c, c_src, volume_ul, min_volume_ul):
+                return w
+        return False
+
+    def place(c, well, target):
+        """Plan 'well' at concentration c, with intermediates as needed; 'target' is the (c, well) being made."""
+        if c > stock_conc:
+            raise RuntimeError(f"Target {c} for {well} exceeds the stock concentration {stock_conc}.")
+        if abs(c - stock_conc) < 1e-12:
+            wells[well] = {'conc': c, 'source': None, 'target': well == target[1]}
+            return
+        src = best_source(c, final_volume_ul)
+        if src is False:
+            # Most concentrated intermediate the target can still draw an accurate volume from
+            c_mid = c * final_volume_ul / min_volume_ul
+            if not spare:
+                raise RuntimeError(f"Standard {target[0]} in {target[1]} needs an intermediate dilution "
+                                   f"but no spare wells are left.")
+            mid = spare.pop(0)
+            place(min(c_mid, stock_conc), mid, target)
+            src = mid
+        wells[well] = {'conc': c, 'source': src, 'target': well == target[1]}
+
+    for c, w in by_conc:
+        if c > 0:
+            place(c, w, (c, w))
+
+    # Prepared volumes, least concentrated first (children before parents)
+    draws = {w: 0.0 for w in wells}
+    prepared = {}
+    for w in sorted(wells, key=lambda k: wells[k]['conc']):
+        base = final_volume_ul if wells[w]['target'] else dead_volume_ul
+        prepared[w] = base + draws[w]
+        src = wells[w]['source']
+        ratio = wells[w]['conc'] / (stock_conc if src is None else wells[src]['conc'])
+        if ratio < 1:
+            # Scale up small preparations until both the concentrate and the diluent volume are accurate
+            prepared[w] = max(prepared[w], min_volume_ul / ratio, min_volume_ul / (1 - ratio))
+        if max_well_ul is not None and prepared[w] > max_well_ul:
+            raise RuntimeError(f"{w} would need {prepared[w]:.1f} µL, more than the {max_well_ul} µL well capacity.")
+        if src is not None:
+            draws[src] += wells[w]['conc'] / wells[src]['conc'] * prepared[w]
+
+    def depth(w):
+        src = wells[w]['source']
+        return 0 if src is None else 1 + depth(src)
+
+    for w in blanks:
+        prepared[w] = float(final_volume_ul)
+    rows = [(dest_slot, w, diluent[0], diluent[1], round(prepared[w], 2), 1, '') for w in blanks]
+    for w in wells:
+        src = wells[w]['source']
+        c_src = stock_conc if src is None else wells[src]['conc']
+        v_src = round(wells[w]['conc'] / c_src * prepared[w], 2)
+        v_dil = round(prepared[w] - v_src, 2)
+        if v_dil > 0:
+            rows.append((dest_slot, w, diluent[0], diluent[1], v_dil, 1, ''))
+        src_loc = stock if src is None else (dest_slot, src)
+        rows.append((dest_slot, w, src_loc[0], src_loc[1], v_src, 2 + depth(w), 'yes'))
+    transfers = pd.DataFrame(rows, columns=[
+        'receiving labware location', 'receiving well location',
+        'stock labware location 1', 'stock well location 1', 'volume 1', 'priority', 'mix'])
+    transfers = transfers.sort_values('priority', kind='stable').reset_index(drop=True)
+    transfers.attrs['summary'] = {
+        'standards': len(targets),
+        'intermediates': sum(1 for v in wells.values() if not v['target']),
+        'transfers': len(transfers),
+        'mixes': int((transfers['mix'] == 'yes').sum()),
+        'prepared_ul': {w: round(v, 2) for w, v in prepared.items()},
+    }
+    return transfers
+
+# ---------------- Timing model ----------------
+
+# Rough OT-2 gen2 timings used for scheduling and runtime estimates (seconds, µL/s)
+T_PICK_S = 7.0
+T_DROP_S = 5.0
+T_MOVE_S = 2.5     # gantry move to a well, incl. descent
+T_TOUCH_S = 2.0
+T_AIR_GAP_S = 1.0
+T_MODULE_START_S = 5.0
+FLOW_UL_S = {'p300': 92.86, 'p1000': 274.7, 'p300m': 94.0}
+_TIMING_PARAMS = ('T_PICK_S', 'T_DROP_S', 'T_MOVE_S', 'T_TOUCH_S', 'T_AIR_GAP_S', 'T_MODULE_START_S')
+
+def timing_model(params: dict = None) -> dict:
+    """
+    Timing parameters {name: seconds, 'FLOW_UL_S': {pipette: µL/s}}: the defaults above with those
+    given in 'params' (e.g. the result of fit_timing) on top. Every estimate and schedule takes the
+    result as its 'timing' argument; None means the defaults.
+    """
+    params = params or {}
+    timing = {name: float(params.get(name, default)) for name, default in zip(_TIMING_PARAMS, (
+        T_PICK_S, T_DROP_S, T_MOVE_S, T_TOUCH_S, T_AIR_GAP_S, T_MODULE_START_S))}
+    timing['FLOW_UL_S'] = {**FLOW_UL_S, **params.get('FLOW_UL_S', {})}
+    return timing
+
+def _estimate_row_seconds(op_row: pd.Series, timing: dict = None) -> float:
+    """Rough duration of one transfer row (tip change, chunks, mix) for scheduling decisions."""
+    timing = timing or timing_model()
+    flow = timing['FLOW_UL_S']
+    if _action_of(op_row):
+        return 0.0
+    total = float(op_row['volume 1'])
+    pip = 'p1000' if total > MAX_P300_HOLD_UL else 'p300'
+    max_hold = MAX_P1000_HOLD_UL if pip == 'p1000' else MAX_P300_HOLD_UL
+    n_chunks = max(1, math.ceil(total / max_hold))
+    seconds = timing['T_PICK_S'] + timing['T_DROP_S']
+    seconds += n_chunks * (2 * timing['T_MOVE_S'] + timing['T_TOUCH_S']) + 2 * total / flow[pip]
+    do_mix, reps, mix_vol, _ = _extract_mix_params(op_row, max_hold, total)
+    if do_mix:
+        seconds += 2 * reps * mix_vol / flow[pip]
+    return seconds
+
+# ---------------- Modules ----------------
+
+HEATER_SHAKER = 'heaterShakerModuleV1'
+_MODULE_NAME_HINTS = ('module', 'thermocycler')
+
+_ACTION_SYNONYMS = ['action', 'module action', 'module_action', 'step']
+_RPM_SYNONYMS = ['rpm', 'shake rpm', 'shake_rpm', 'speed (rpm)']
+_TEMP_SYNONYMS = ['temperature', 'temp', 'temperature (c)', 'temp (c)']
+_DURATION_S_SYNONYMS = ['duration (s)', 'duration_s', 'duration', 'time (s)']
+_DURATION_MIN_SYNONYMS = ['duration (min)', 'duration_min', 'time (min)']
+
+# OT-2 deck: 1-2-3 / 4-5-6 / 7-8-9 / 10-11-12. No pipetting east/west of a shaking heater-shaker.
+def _east_west_neighbours(slot: int) -> set:
+    row_start = 3 * ((int(slot) - 1) // 3) + 1
+    return {s for s in (int(slot) - 1, int(slot) + 1) if row_start <= s < row_start + 3}
+
+def _is_module_row(lw: pd.Series) -> bool:
+    kind = str(lw.get('type', '')).strip().lower()
+    title = str(lw['labware_title']).strip().lower()
+    return kind == 'module' or any(h in title for h in _MODULE_NAME_HINTS)
+
+def _action_of(op_row: pd.Series):
+    """Return the module action ('shake', 'heat', 'incubate', ...) of a transfers row, or None for a transfer."""
+    col = _row_col(op_row, _ACTION_SYNONYMS)
+    if col is None or pd.isna(op_row[col]) or not str(op_row[col]).strip():
+        return None
+    return str(op_row[col]).strip().lower()
+
+def _action_mask(ops: pd.DataFrame) -> np.ndarray:
+    """Boolean array: which rows of a transfers table are module actions (see _action_of)."""
+    col = _col_lookup_case_insensitive(ops, _ACTION_SYNONYMS)
+    if col is None:
+        return np.zeros(len(ops), dtype=bool)
+    return (ops[col].notna() & ops[col].astype(str).str.strip().ne('')).to_numpy()
+
+def _action_params(op_row: pd.Series):
+    """(rpm, temperature_c, duration_s) of a module action row; missing values are 0."""
+    def number(cands, scale=1.0):
+        col = _row_col(op_row, cands)
+        if col is None or pd.isna(op_row[col]):
+            return 0.0
+        return float(op_row[col]) * scale
+
+    rpm = number(_RPM_SYNONYMS)
+    temp = number(_TEMP_SYNONYMS)
+    duration = number(_DURATION_S_SYNONYMS) or number(_DURATION_MIN_SYNONYMS, 60.0)
+    return rpm, temp, duration
+
+def _row_slots(op_row: pd.Series) -> set:
+    return {int(op_row['stock labware location 1']), int(op_row['receiving labware location'])}
+
+def _row_vessels(op_row: pd.Series):
+    """(reads, writes) sets of (slot, well) for a row; an action reads and writes its whole slot (well None)."""
+    if _action_of(op_row):
+        v = {(int(op_row['receiving labware location']), None)}
+        return v, v
+    src = (int(op_row['stock labware location 1']), str(op_row['stock well location 1']).strip())
+    dst = (int(op_row['receiving labware location']), str(op_row['receiving well location']).strip())
+    return {src}, {dst}
+
+def _vessels_conflict(a, b) -> bool:
+    """True if two rows' (reads, writes) must keep their relative order."""
+    def overlap(x, y):
+        return any(p[0] == q[0] and (p[1] is None or q[1] is None or p[1] == q[1]) for p in x for q in y)
+    (ra, wa), (rb, wb) = a, b
+    return overlap(wa, rb) or overlap(wa, wb) or overlap(ra, wb)
+
+_SCHEDULE_LOOKAHEAD = 200
+
+def _schedule_around_modules(ops_df: pd.DataFrame, module_slots: set, timing: dict = None) -> pd.DataFrame:
+    """
+    Reorder operations so pipetting continues while a module runs a timed step.
+    The (priority-sorted) order is kept, except that a row which needs a busy module's slot
+    (or a slot east/west of it) is postponed behind later rows that are independent of it
+    and of everything else postponed. Module run times are tracked against _estimate_row_seconds.
+    Without module actions the order is unchanged.
+    """
+    timing = timing_model(timing)
+    n = len(ops_df)
+    rows = [ops_df.iloc[k] for k in range(n)]
+    vessels = [_row_vessels(r) for r in rows]
+    pending = list(range(n))
+    order = []
+    clock = 0.0
+    busy_until = {}
+
+    def busy_zone():
+        zone = set()
+        for m, t in busy_until.items():
+            if t > clock:
+                zone |= {m} | _east_west_neighbours(m)
+        return zone
+
+    while pending:
+        zone = busy_zone()
+        chosen = 0
+        if zone:
+            skipped = []
+            for pos, k in enumerate(pending[:_SCHEDULE_LOOKAHEAD]):
+                blocked = bool(_row_slots(rows[k]) & zone)
+                if not blocked and not any(_vessels_conflict(vessels[s], vessels[k]) for s in skipped):
+                    chosen = pos
+                    break
+                skipped.append(k)
+            else:
+                # Nothing independent left: the next row waits for the module(s)
+                clock = max([clock] + [t for t in busy_until.values()])
+                busy_until.clear()
+        k = pending.pop(chosen)
+        row = rows[k]
+        if _action_of(row):
+            slot = int(row['receiving labware location'])
+            if slot in module_slots:
+                busy_until[slot] = clock + _action_params(row)[2]
+        clock += _estimate_row_seconds(row, timing)
+        order.append(k)
+    return ops_df.iloc[order]
+
+# ---------------- Sheet compaction ----------------
+
+def compact_transfers(ops_df: pd.DataFrame):
+    """
+    Merge duplicate transfer rows (normalized, see _normalize_ops) into one row with the summed volume,
+    so split additions and corrections are chunked, touched and tipped once. A row joins an earlier one
+    when every other column (source, destination, priority, mix, consolidate group, ...) matches and no
+    row in between writes its source, or reads or writes its destination, or runs a module action on
+    either slot. Rows are compared in run order (priority sorted, see _apply_priority_sort), so only rows
+    of the same priority group can come between. Rows with zero or negative volume are dropped with a
+    warning; module actions are kept as they are. Returns (compacted rows in run order, report).
+    """
+    ops_df = _apply_priority_sort(ops_df)
+    others = [c for c in ops_df.columns if c != 'volume 1']
+    keep, volumes, dropped = [], [], []
+    open_rows = {}  # other-column values -> position in 'keep' of the row duplicates merge into
+    last_read, last_write, last_action = {}, {}, {}
+    merged = 0
+    for k in range(len(ops_df)):
+        row = ops_df.iloc[k]
+        if _action_of(row):
+            last_action[int(row['receiving labware location'])] = len(keep)
+            keep.append(k)
+            volumes.append(float(row['volume 1']))
+            continue
+        vol = float(row['volume 1'])
+        if vol <= 0:
+            dropped.append(ops_df.index[k])
+            continue
+        (src,), (dst,) = _row_vessels(row)
+        key = tuple(None if pd.isna(v) else v for v in row[others])
+        at = open_rows.get(key)
+        if (at is not None
+                and max(last_write.get(src, -1), last_write.get(dst, -1), last_read.get(dst, -1)) <= at
+                and max(last_action.get(src[0], -1), last_action.get(dst[0], -1)) < at):
+            volumes[at] += vol
+            merged += 1
+            continue
+        open_rows[key] = len(keep)
+        last_read[src] = last_write[dst] = len(keep)
+        keep.append(k)
+        volumes.append(vol)
+    if dropped:
+        warnings.warn(f"Dropped {len(dropped)} transfer row(s) with zero or negative volume: "
+                      f"rows {', '.join(str(k + 1) for k in dropped)}.")
+    out = ops_df.iloc[keep].copy()
+    out['volume 1'] = volumes
+    report = {'rows_before': len(ops_df), 'rows_merged': merged, 'rows_dropped': len(dropped), 'rows_after': len(out)}
+    return out, report
+
+# ---------------- Deferred mixing ----------------
+
+def defer_mixing(ops_df: pd.DataFrame):
+    """
+    Move mixing to the last addition a destination gets (rows in run order, normalized). The mixes
+    asked for by the rows filling a well are replaced by a single one on the last of them, with the
+    largest reps and mix volume asked for, so the well is mixed once with that row's tip. A well that
+    is aspirated from (or whose plate gets a module action) before its last addition is mixed by the
+    addition just before, then collects again. Rows that mix each chunk are left as they are.
+    Returns (rows, report).
+    """
+    flag_col = _col_lookup_case_insensitive(ops_df, _MIX_FLAG_SYNONYMS)
+    if flag_col is None:
+        return ops_df, {'mixes_before': 0, 'mixes_after': 0}
+    ops = ops_df.copy()
+    labels = ops.index
+    reps_col = _col_lookup_case_insensitive(ops, _MIX_REPS_SYNONYMS) or 'mix reps'
+    vol_col = _col_lookup_case_insensitive(ops, _MIX_VOL_SYNONYMS) or 'mix volume'
+    for col in (flag_col, reps_col, vol_col):
+        ops[col] = ops[col].astype(object) if col in ops.columns else None
+
+    rows = [ops.iloc[k] for k in range(len(ops))]
+    mixes = {}   # row -> (reps, mix volume) for rows that ask for a deferrable mix
+    for k, row in enumerate(rows):
+        if _action_of(row):
+            continue
+        vol = float(row['volume 1'])
+        hold = MAX_P1000_HOLD_UL if vol > MAX_P300_HOLD_UL else MAX_P300_HOLD_UL
+        do_mix, reps, mix_vol, each_chunk = _extract_mix_params(row, hold, vol)
+        if do_mix and not each_chunk:
+            mixes[k] = (reps, mix_vol)
+    before = sum(1 for row in rows if not _action_of(row) and _truthy(row[flag_col]))
+
+    pending = {}  # destination -> [rows filling it since it was last mixed]
+
+    def flush(dst):
+        fills = pending.pop(dst)
+        asked = [k for k in fills if k in mixes]
+        if not asked or asked == [fills[-1]]:
+            return
+        for k in asked:
+            ops.at[labels[k], flag_col] = False
+        last = labels[fills[-1]]
+        ops.at[last, flag_col] = True
+        ops.at[last, reps_col] = max(mixes[k][0] for k in asked)
+        ops.at[last, vol_col] = max(mixes[k][1] for k in asked)
+
+    for k, row in enumerate(rows):
+        if _action_of(row):
+            slot = int(row['receiving labware location'])
+            for dst in [d for d in pending if d[0] == slot]:
+                flush(dst)
+            continue
+        (src,), (dst,) = _row_vessels(row)
+        if src in pending:
+            flush(src)
+        if _truthy(row[flag_col]) and k not in mixes:
+            # Mixes each chunk: keep it, after settling what the well collected so far
+            if dst in pending:
+                flush(dst)
+            continue
+        pending.setdefault(dst, []).append(k)
+    for dst in list(pending):
+        flush(dst)
+
+    after = sum(1 for k in range(len(ops)) if not _action_of(rows[k]) and _truthy(ops.at[labels[k], flag_col]))
+    return ops, {'mixes_before': before, 'mixes_after': after}
+
+# ---------------- Step IR ----------------
+
+# Opcodes of the step intermediate representation
+OP_PICK, OP_ASPIRATE, OP_DISPENSE, OP_MIX, OP_TOUCH, OP_DROP, OP_COMMENT, OP_MODULE_START, OP_MODULE_WAIT, OP_AIR_GAP = range(10)
+OP_NAMES = ('pick', 'aspirate', 'dispense', 'mix', 'touch', 'drop', 'comment', 'module_start', 'module_wait', 'air_gap')
+
+# Pipette ids; the id's name is also the variable name in the emitted protocol
+PIPETTES = ('p300', 'p1000', 'p300m')
+PIPETTE_ID = {name: i for i, name in enumerate(PIPETTES)}
+
+DISPENSE_TOP_Z_MM = -3.0
+TOUCH_RADIUS = 0.8
+TOUCH_V_OFFSET = -1
+TOUCH_SPEED = 60
+
+@dataclass(slots=True)
+class Step:
+    """
+    One robot command. 'arg' is the mix repetition count, or the comment index for OP_COMMENT.
+    OP_AIR_GAP draws 'volume' µL of air at the pipette's current position.
+    Module steps use 'slot' for the module, 'volume' for rpm, 'z' for °C and 'arg' for the duration (s).
+    """
+    op: int
+    pipette: int
+    slot: int
+    well: str
+    volume: float
+    z: float
+    arg: int = 0
+
+class StepPlan:
+    """
+    Struct-of-arrays store for a generated plan: one typed array per Step field (~27 bytes/step,
+    so 10^6 steps fit in a few tens of MB). Well names and comments are interned.
+    Also carries the deck setup (labware and instruments) that emitters need for the header.
+    """
+
+    def __init__(self):
+        self.op = array('b')
+        self.pipette = array('b')
+        self.slot = array('b')
+        self.well = array('i')
+        self.volume = array('d')
+        self.z = array('d')
+        self.arg = array('i')
+        self.well_names = []
+        self._well_ids = {}
+        self.comments = []
+        # Deck setup: [(var, title, slot)], [(var, model, mount, [tiprack vars])], {slot: var}, {slot: (var, model)}
+        self.labware = []
+        self.instruments = []
+        self.labware_map = {}
+        self.modules = {}
+        self.name = 'Automatic Protocol'
+        self.report = {}  # run statistics: tips saved by the compatibility model, optimizer counts
+        self.start_tips = {}  # tips already used per pipette before the first step (resumed runs)
+        self.volume_events = None  # draws and fills recorded by build_plan (see VolumeTimeline)
+
+    def __len__(self):
+        return len(self.op)
+
+    def __getitem__(self, i):
+        op = self.op[i]
+        return Step(op, self.pipette[i], self.slot[i], self.well_names[self.well[i]],
+                    self.volume[i], self.z[i], self.arg[i])
+
+    def __iter__(self):
+        for i in range(len(self.op)):
+            yield self[i]
+
+    def _well_id(self, well):
+        wid = self._well_ids.get(well)
+        if wid is None:
+            wid = self._well_ids[well] = len(self.well_names)
+            self.well_names.append(well)
+        return wid
+
+    def add(self, op, pipette='p300', slot=0, well='', volume=0.0, z=0.0, arg=0):
+        self.op.append(op)
+        self.pipette.append(PIPETTE_ID[pipette])
+        self.slot.append(int(slot))
+        self.well.append(self._well_id(well))
+        self.volume.append(float(volume))
+        self.z.append(float(z))
+        self.arg.append(int(arg))
+
+    def comment(self, text):
+        self.comments.append(text)
+        self.add(OP_COMMENT, arg=len(self.comments) - 1)
+
+    def extend(self, other):
+        """Append all steps of another plan that shares this plan's deck setup."""
+        for s in other:
+            if s.op == OP_COMMENT:
+                self.comment(other.comments[s.arg])
+            else:
+                self.add(s.op, PIPETTES[s.pipette], s.slot, s.well, s.volume, s.z, s.arg)
+
+    def copy_setup(self):
+        """Return an empty plan with the same deck setup."""
+        new = StepPlan()
+        new.labware = list(self.labware)
+        new.instruments = list(self.instruments)
+        new.labware_map = dict(self.labware_map)
+        new.modules = dict(self.modules)
+        new.name = self.name
+        new.report = dict(self.report)
+        new.start_tips = dict(self.start_tips)
+        return new
+
+    def slice(self, start, end):
+        """Steps [start, end) as a new plan with the same deck setup."""
+        new = self.copy_setup()
+        for col in ('op', 'pipette', 'slot', 'well', 'volume', 'z', 'arg'):
+            setattr(new, col, getattr(self, col)[start:end])
+        new.well_names = list(self.well_names)
+        new._well_ids = dict(self._well_ids)
+        new.comments = list(self.comments)
+        if self.volume_events is not None:
+            # Events inside the slice, with the volumes as they stand at 'start' as the initial ones
+            ev = self.volume_events
+            before, inside = ev['step'] < start, (ev['step'] >= start) & (ev['step'] < end)
+            initial = ev['initial'] + np.bincount(ev['vessel'][before], weights=ev['delta'][before],
+                                                  minlength=len(ev['initial']))
+            new.volume_events = {'step': ev['step'][inside] - start, 'vessel': ev['vessel'][inside],
+                                 'delta': ev['delta'][inside], 'vessels': ev['vessels'], 'initial': initial}
+        return new
+
+    def clear_steps(self):
+        """Drop all steps (e.g. once written out); deck setup and interned wells are kept."""
+        for col in ('op', 'pipette', 'slot', 'well', 'volume', 'z', 'arg'):
+            setattr(self, col, array(getattr(self, col).typecode))
+        self.comments = []
+
+    def nbytes(self):
+        cols = (self.op, self.pipette, self.slot, self.well, self.volume, self.z, self.arg)
+        return sum(c.itemsize * len(c) for c in cols)
+
+def plan_stats(plan: StepPlan) -> dict:
+    """Count steps per opcode name (plus 'total')."""
+    counts = {name: 0 for name in OP_NAMES}
+    for op in plan.op:
+        counts[OP_NAMES[op]] += 1
+    counts['total'] = len(plan)
+    return counts
+
+# ---------------------------------------------------
+
+def _setup_deck(plan: StepPlan, labware_data: pd.DataFrame, multichannel: bool):
+    """
+    Fill the plan's deck setup (modules, labware, instruments) from the labware sheet.
+    Returns (labware rows without modules, {slot: title}, p1000_loaded).
+    """
+    labware_map = plan.labware_map
+    labware_titles = {}
     tiprack_200_vars = []
     tiprack_1000_vars = []
     tiprack_any = []
 
+    module_mask = labware_data.apply(_is_module_row, axis=1) if len(labware_data) else pd.Series(dtype=bool)
+    for _, mod in labware_data[module_mask].iterrows():
+        loc = int(mod['location'])
+        plan.modules[loc] = (f"module_{loc}", str(mod['labware_title']).strip())
+    labware_data = labware_data[~module_mask]
+
     for _, lw in labware_data.iterrows():
         title = str(lw['labware_title']).strip()
         loc = int(lw['location'])
@@ -243,7 +1329,7 @@ def generate_protocol(stock_data: pd.DataFrame, labware_data: pd.DataFrame, oper
             m = re.search(r'(\d{2,4})\s*ul', title, re.IGNORECASE)
             size = (m.group(1) + 'ul') if m else 'tips'
             var = f"tiprack_{size}"
-            content.append(f"    {var} = protocol.load_labware('{title}', {loc})")
+            var = var if var not in tiprack_any else f"{var}_{loc}"
             tiprack_any.append(var)
             if '200' in size:
                 tiprack_200_vars.append(var)
@@ -251,35 +1337,493 @@ def generate_protocol(stock_data: pd.DataFrame, labware_data: pd.DataFrame, oper
                 tiprack_1000_vars.append(var)
         else:
             var = f"labware_{loc}"
-            content.append(f"    {var} = protocol.load_labware('{title}', {loc})")
+        plan.labware.append((var, title, loc))
         labware_map[loc] = var
+        labware_titles[loc] = title
 
     # Load instruments
     if not tiprack_200_vars and not tiprack_any:
         raise RuntimeError("No tipracks found in labware CSV. Please include at least one tiprack.")
 
+    # P300 multi (right) needs a 200 µL tiprack of its own: single and multi pickups can't share a rack
+    multi_tipracks = []
+    if multichannel:
+        if len(tiprack_200_vars) < 2:
+            raise RuntimeError("Multichannel mode needs two 200 µL tipracks (one for the p300 single, one for the p300 multi).")
+        multi_tipracks = tiprack_200_vars[-1:]
+        tiprack_200_vars = tiprack_200_vars[:-1]
+
     # P300 (left) prefers 200 µL tipracks; else fallback to any tiprack
     p300_tipracks = tiprack_200_vars if tiprack_200_vars else tiprack_any[:1]
-    content.append("")
-    content.append(f"    p300 = protocol.load_instrument('p300_single_gen2', 'left', tip_racks=[{', '.join(p300_tipracks)}])")
+    plan.instruments.append(('p300', 'p300_single_gen2', 'left', p300_tipracks))
 
-    # P1000 (right) only if 1000 µL tipracks are present
-    p1000_loaded = len(tiprack_1000_vars) > 0
+    # P1000 (right) only if 1000 µL tipracks are present and the right mount isn't taken by the multi
+    p1000_loaded = len(tiprack_1000_vars) > 0 and not multichannel
     if p1000_loaded:
-        content.append(f"    p1000 = protocol.load_instrument('p1000_single_gen2', 'right', tip_racks=[{', '.join(tiprack_1000_vars)}])")
-    content.append("")
-
-    # Normalize and sort operations with PRIORITY
-    ops = operation_data.copy()
+        plan.instruments.append(('p1000', 'p1000_single_gen2', 'right', tiprack_1000_vars))
+    if multichannel:
+        plan.instruments.append(('p300m', 'p300_multi_gen2', 'right', multi_tipracks))
+
+    return labware_data, labware_titles, p1000_loaded
+
+def _normalize_ops(ops: pd.DataFrame, stock_data: pd.DataFrame) -> pd.DataFrame:
+    """Resolve named sources, neutralize module-action rows and make slot columns int (modifies 'ops')."""
+    ops = _resolve_named_sources(ops, stock_data)
+    is_action = _action_mask(ops)
+    if is_action.any():
+        # Module actions only name the module slot; give them a neutral source and volume
+        ops.loc[is_action, 'stock labware location 1'] = ops.loc[is_action, 'receiving labware location']
+        ops.loc[is_action, 'volume 1'] = 0.0
     ops['stock labware location 1'] = ops['stock labware location 1'].astype(int)
     ops['receiving labware location'] = ops['receiving labware location'].astype(int)
+    for col in ('stock well location 1', 'receiving well location'):
+        ops[col] = ops[col].map(lambda w: w if pd.isna(w) else (canonical_well(w) or str(w).strip()))
+    return ops
 
-    # ---- priority sort (optional) ----
-    ops = _apply_priority_sort(ops).reset_index(drop=True)
+# ---------------- Memory profiling ----------------
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+class MemoryBudgetExceeded(RuntimeError):
+    """Raised by MemoryProfiler when a generation goes over its budget; 'report' holds the profile so far."""
+
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
+
+def _rss_mb():
+    """(current RSS, peak RSS) of this process in MB; None where the platform doesn't say."""
+    current = peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 1024  # bytes on macOS, KB elsewhere
+    return current, peak
+
+class MemoryProfiler:
+    """
+    Opt-in memory profile of one generation:
+        with MemoryProfiler(budget_mb=2000) as mem:
+            generate_protocol(..., memory=mem)
+        mem.write_report('memory.json')
+    For each phase it records the Python heap peak and growth (tracemalloc), the top allocating lines
+    and the process RSS. With frames > 1 (slower: ~20x at 8 frames) allocations inside pandas are
+    folded onto the line of this module that called them. 'budget_mb' fails the run with
+    MemoryBudgetExceeded as soon as the RSS (or, where RSS can't be read, the traced heap) goes over it;
+    planning checks after every row. The report is JSON to attach to bug tickets.
+    """
+
+    def __init__(self, budget_mb: float = None, top: int = 10, frames: int = 1):
+        self.budget_mb = budget_mb
+        self.top = top
+        self.frames = frames
+        self.phases = []
+        self._phase = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+        return self
+
+    def __exit__(self, *exc):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return False
+
+    def check(self, *_):
+        """Raise MemoryBudgetExceeded if over budget (usable as an after_row callback)."""
+        if self.budget_mb is None:
+            return
+        rss, _ = _rss_mb()
+        used = rss if rss is not None else tracemalloc.get_traced_memory()[0] / 2**20
+        if used > self.budget_mb:
+            raise MemoryBudgetExceeded(f"Memory budget exceeded: {used:.1f} MB used, budget {self.budget_mb:g} MB "
+                                       f"(phase '{self._phase or 'between phases'}').", self.report())
+
+    def phase(self, name: str):
+        """Context manager profiling one phase; phases don't nest."""
+        profiler = self
+
+        class _Phase:
+            def __enter__(self):
+                if not tracemalloc.is_tracing():
+                    profiler.__enter__()
+                profiler._phase = name
+                tracemalloc.reset_peak()
+                self.start = _snapshot()
+                self.start_mem = tracemalloc.get_traced_memory()[0]
+                return profiler
+
+            def __exit__(self, *exc):
+                current, peak = tracemalloc.get_traced_memory()
+                stats = _snapshot().compare_to(self.start, 'traceback')
+                rss, peak_rss = _rss_mb()
+                profiler.phases.append({
+                    'phase': name,
+                    'heap_peak_mb': round(peak / 2**20, 3),
+                    'heap_growth_mb': round((current - self.start_mem) / 2**20, 3),
+                    'rss_mb': None if rss is None else round(rss, 1),
+                    'peak_rss_mb': None if peak_rss is None else round(peak_rss, 1),
+                    'top_allocators': _top_allocators(stats, profiler.top),
+                })
+                if exc[0] is None:
+                    profiler.check()
+                profiler._phase = None
+                return False
+
+        return _Phase()
+
+    def report(self) -> dict:
+        import platform
+        rss, peak_rss = _rss_mb()
+        return {
+            'python': sys.version.split()[0], 'platform': platform.platform(),
+            'pandas': pd.__version__, 'numpy': np.__version__,
+            'budget_mb': self.budget_mb, 'rss_mb': rss, 'peak_rss_mb': peak_rss,
+            'phases': list(self.phases),
+        }
+
+    def write_report(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+
+def _snapshot():
+    """tracemalloc snapshot without the profiler's own allocations."""
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+def _top_allocators(stats, top: int) -> list:
+    """Fold tracemalloc traceback diffs onto the innermost frame in this module; largest growth first."""
+    here = os.path.abspath(__file__)
+    by_line = {}
+    for st in stats:
+        frames = list(st.traceback)
+        ours = next((f for f in reversed(frames) if os.path.abspath(f.filename) == here), None)
+        where = f"{os.path.basename(here)}:{ours.lineno}" if ours else str(frames[-1]) if frames else '?'
+        entry = by_line.setdefault(where, {'where': where, 'size_diff_kb': 0.0, 'count_diff': 0, 'innermost': None})
+        entry['size_diff_kb'] += st.size_diff / 1024
+        entry['count_diff'] += st.count_diff
+        if entry['innermost'] is None and frames:
+            entry['innermost'] = str(frames[-1])
+    out = sorted(by_line.values(), key=lambda e: -e['size_diff_kb'])[:top]
+    for e in out:
+        e['size_diff_kb'] = round(e['size_diff_kb'], 1)
+    return out
+
+class _NoPhase:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+def _phase(memory, name):
+    """memory.phase(name), or a no-op when profiling is off."""
+    return memory.phase(name) if memory is not None else _NoPhase()
+
+# ---------------- Batch aspirate heights ----------------
+
+DEFAULT_ASPIRATE_Z_MM = 10.0  # used when a source has no stock row (see _calc_height_and_update)
+_SHORT_RUN = 64               # vessels with at most this many events are summed side by side
+
+def _aspirate_z(pre_ul: np.ndarray, transfer_ul: np.ndarray, id_cm: np.ndarray) -> np.ndarray:
+    """Vectorized _calc_height_and_update height model; same operations in the same order, so identical values."""
+    area = np.pi * (id_cm * 0.5) * (id_cm * 0.5)
+    post_h_cm = np.maximum(0.0, (pre_ul / 1000.0) / area - (transfer_ul / 1000.0) / area)
+    raw = post_h_cm * 10.0 - 5.0
+    z = np.round(raw, 1)
+    # np.round scales by 10 before rounding; redo values near a .x5 tie with Python's exact round()
+    scaled = raw * 10.0
+    ties = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    for i in ties:
+        z[i] = round(float(raw[i]), 1)
+    return np.maximum(1.0, z)
+
+def aspirate_heights(vessels: np.ndarray, deltas: np.ndarray, initial_ul: np.ndarray, id_cm: np.ndarray):
+    """
+    Batch kernel for aspirate heights. Events are in plan order: 'vessels' are vessel numbers,
+    'deltas' signed volumes (negative = aspirate, positive = liquid added), 'id_cm' the inner diameter
+    used for each aspirate. Running volumes are signed cumulative sums per vessel (sequential, so
+    bit-identical to updating one chunk at a time); volumes clamp at 0 like _calc_height_and_update.
+    Returns (z per event, NaN for additions; final volume per vessel).
+    """
+    vessels = np.asarray(vessels, dtype=np.int64)
+    deltas = np.asarray(deltas, dtype=float)
+    final = np.array(initial_ul, dtype=float)
+    n = len(vessels)
+    z = np.full(n, np.nan)
+    if n == 0:
+        return z, final
+
+    order = np.argsort(vessels, kind='stable')
+    v_sorted, d_sorted = vessels[order], deltas[order]
+    starts = np.flatnonzero(np.r_[True, v_sorted[1:] != v_sorted[:-1]])
+    lengths = np.diff(np.r_[starts, n])
+    pre = np.empty(n)
+
+    start_vol = final[v_sorted[starts]]
+    long_runs = np.flatnonzero(lengths > _SHORT_RUN)
+    short_runs = np.flatnonzero(lengths <= _SHORT_RUN)
+    over = np.zeros(len(starts), dtype=bool)
+    # Short runs: step through event j of every vessel at once (exactly sequential per vessel)
+    vol = start_vol[short_runs].copy()
+    for j in range(int(lengths[short_runs].max()) if len(short_runs) else 0):
+        live = np.flatnonzero(lengths[short_runs] > j)
+        at = starts[short_runs[live]] + j
+        pre[at] = vol[live]
+        vol[live] += d_sorted[at]
+        over[short_runs[live[vol[live] < 0]]] = True
+    final[v_sorted[starts[short_runs]]] = vol
+    # Long runs: one cumulative sum each
+    for g in long_runs:
+        a, length = starts[g], lengths[g]
+        run = np.cumsum(np.r_[start_vol[g], d_sorted[a:a + length]])
+        pre[a:a + length] = run[:-1]
+        final[v_sorted[a]] = run[-1]
+        over[g] = (run[1:] < 0).any()
+    clamped = np.flatnonzero(over)
+
+    for g in clamped:
+        # Over-drawn vessel: replay it one event at a time with the clamp
+        a, length = starts[g], lengths[g]
+        vol = float(initial_ul[v_sorted[a]])
+        for k in range(a, a + length):
+            pre[k] = vol
+            vol = max(0.0, vol + d_sorted[k]) if d_sorted[k] < 0 else vol + d_sorted[k]
+        final[v_sorted[a]] = vol
+
+    draws = np.flatnonzero(d_sorted < 0)
+    z[order[draws]] = _aspirate_z(pre[draws], -d_sorted[draws], np.asarray(id_cm, dtype=float)[order[draws]])
+    return z, final
+
+class _VolumeLedger:
+    """
+    Stock volumes as the planner draws from and fills wells. Live mode updates the stock table chunk by
+    chunk (needed when decisions depend on volumes, e.g. replicate pools). Batch mode only records the
+    events; aspirate heights are placeholders until finish() runs aspirate_heights over the whole plan
+    and writes the final volumes back. Both give the same heights and stock table.
+    With timeline=True every draw and fill is also kept as (step, stock row, µL) and finish() hands
+    them to the plan as plan.volume_events (see VolumeTimeline).
+    """
+
+    def __init__(self, stocks_df: pd.DataFrame, batch: bool = False, timeline: bool = False):
+        self.df = stocks_df
+        self.batch = batch
+        self.timeline = timeline
+        if timeline:
+            self._t_initial = dict(zip(stocks_df.index, stocks_df['volume(ul)'].astype(float)))
+            self._t_ids = {}
+            self._t_step, self._t_row, self._t_delta = array('q'), array('q'), array('d')
+            self._t_unbound = 0
+        if not batch:
+            return
+        # Same lookups as _find_stock_row (slot as text, legacy name fallback) and upsert_destination_stock (int slot)
+        self._slot_type = stocks_df['labware location'].dtype
+        self._by_text = {}
+        self._by_int = {}
+        self._by_name = {}
+        wells = stocks_df['well location'].astype(str).str.strip()
+        for label, loc, well, name in zip(stocks_df.index, stocks_df['labware location'], wells, stocks_df['stock name']):
+            self._by_text.setdefault((str(loc), well), label)
+            self._by_int.setdefault((int(loc), well), []).append(label)
+            self._by_name.setdefault(str(name).strip(), label)
+        self._labels = list(stocks_df.index)
+        self._pos = {label: k for k, label in enumerate(self._labels)}
+        self._initial = list(stocks_df['volume(ul)'].astype(float))
+        self._new_rows = []
+        self._vessel, self._delta, self._id_cm, self._step = [], [], [], []
+        self._fixed = []          # [step, z] for sources without a stock row
+        self._unbound = 0
+        self._unbound_fixed = 0
+
+    def _find(self, slot, well):
+        well = str(well).strip()
+        label = self._by_text.get((str(slot), well))
+        return label if label is not None else self._by_name.get(well)
+
+    def _record(self, label, step, delta):
+        if self.timeline:
+            self._t_step.append(step)
+            self._t_row.append(self._t_ids.setdefault(label, len(self._t_ids)))
+            self._t_delta.append(delta)
+
+    def draw(self, slot, well, chunk_ul, id_cm):
+        """Aspirate 'chunk_ul' from (slot, well). Returns (z, found); z is NaN in batch mode until finish()."""
+        if not self.batch:
+            idx = _find_stock_row(self.df, slot, well)
+            if idx is not None:
+                self._record(idx, -1, -float(chunk_ul))
+            return _calc_height_and_update(self.df, idx, chunk_ul, ID_CM=float(id_cm)), idx is not None
+        label = self._find(slot, well)
+        if label is None:
+            self._fixed.append([None, DEFAULT_ASPIRATE_Z_MM])
+            return math.nan, False
+        self._vessel.append(self._pos[label])
+        self._delta.append(-float(chunk_ul))
+        self._id_cm.append(float(id_cm))
+        self._step.append(None)
+        self._record(label, -1, -float(chunk_ul))
+        return math.nan, True
+
+    def fill(self, slot, well, volume_ul, step: int = -1):
+        """Add 'volume_ul' to (slot, well) at dispense step 'step', creating its stock row on first use."""
+        if not self.batch:
+            if self.timeline:
+                on_well = (self.df['labware location'].astype(int).eq(int(slot)) &
+                           self.df['well location'].astype(str).str.strip().eq(str(well).strip()))
+                for label in list(self.df.index[on_well]) or [len(self.df)]:
+                    self._record(label, step, float(volume_ul))
+            upsert_destination_stock(self.df, slot, well, volume_ul)
+            return
+        key = (int(slot), str(well).strip())
+        labels = self._by_int.get(key)
+        if labels is None:
+            label = len(self._labels)
+            labels = self._by_int[key] = [label]
+            self._by_text.setdefault((str(np.array([key[0]]).astype(self._slot_type)[0]), key[1]), label)
+            self._pos[label] = len(self._labels)
+            self._labels.append(label)
+            self._initial.append(0.0)
+            self._new_rows.append((label, key))
+        for label in labels:
+            self._vessel.append(self._pos[label])
+            self._delta.append(float(volume_ul))
+            self._id_cm.append(0.0)
+            self._step.append(-1)
+            self._record(label, step, float(volume_ul))
+
+    def bind(self, step: int):
+        """Attach the draws since the last bind to aspirate step 'step' (its z is their minimum)."""
+        if self.timeline:
+            for k in range(self._t_unbound, len(self._t_step)):
+                if self._t_step[k] < 0 and self._t_delta[k] < 0:
+                    self._t_step[k] = step
+            self._t_unbound = len(self._t_step)
+        if not self.batch:
+            return
+        for k in range(self._unbound, len(self._step)):
+            if self._step[k] is None:
+                self._step[k] = step
+        for f in self._fixed[self._unbound_fixed:]:
+            f[0] = step
+        self._unbound = len(self._step)
+        self._unbound_fixed = len(self._fixed)
+
+    def finish(self, plan: StepPlan):
+        """Batch mode: fill in every aspirate height of 'plan' and write final volumes to the stock table."""
+        if not self.batch:
+            self._finish_timeline(plan)
+            return
+        z, final = aspirate_heights(np.array(self._vessel, dtype=np.int64), np.array(self._delta),
+                                    np.array(self._initial), np.array(self._id_cm))
+        step = np.array(self._step, dtype=np.int64)
+        draws = np.flatnonzero(step >= 0)
+        steps = np.r_[step[draws], np.array([f[0] for f in self._fixed], dtype=np.int64)]
+        values = np.r_[z[draws], np.array([f[1] for f in self._fixed], dtype=float)]
+        if len(steps):
+            order = np.argsort(steps, kind='stable')
+            steps, values = steps[order], values[order]
+            first = np.flatnonzero(np.r_[True, steps[1:] != steps[:-1]])
+            zs = np.frombuffer(plan.z, dtype='d')
+            zs[steps[first]] = np.minimum.reduceat(values, first)
+
+        touched = sorted({self._labels[v] for v in self._vessel})
+        existing = [label for label in touched if label in self.df.index]
+        if existing:
+            self.df.loc[existing, 'volume(ul)'] = [final[self._pos[label]] for label in existing]
+        # New destination rows go onto the caller's table in place, the way upsert_destination_stock adds them
+        for label, (slot, well) in self._new_rows:
+            self.df.loc[label] = {'stock name': f'{slot}:{well}', 'volume(ul)': final[self._pos[label]],
+                                  'labware location': slot, 'well location': well}
+        self._finish_timeline(plan)
+
+    def _finish_timeline(self, plan: StepPlan):
+        """Hand the recorded events to 'plan' keyed by (slot, well) of their stock rows."""
+        if not self.timeline:
+            return
+        labels = sorted(self._t_ids, key=self._t_ids.get)
+        plan.volume_events = {
+            'step': np.frombuffer(self._t_step, dtype=np.int64).copy(),
+            'vessel': np.frombuffer(self._t_row, dtype=np.int64).copy(),
+            'delta': np.frombuffer(self._t_delta, dtype='d').copy(),
+            'vessels': list(zip(self.df.loc[labels, 'labware location'].astype(int).tolist(),
+                                self.df.loc[labels, 'well location'].astype(str).str.strip().tolist())),
+            'initial': np.array([self._t_initial.get(label, 0.0) for label in labels]),
+        }
+
+class _RowStream:
+    """Operation rows in execution order, with on-demand lookahead. Only unconsumed rows that were peeked at are held."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buf = deque()
+
+    def peek(self, k=0):
+        """The k-th upcoming row (0 = next), or None past the end."""
+        while len(self._buf) <= k:
+            nxt = next(self._rows, None)
+            if nxt is None:
+                return None
+            self._buf.append(nxt)
+        return self._buf[k]
+
+    def peek_block(self, k, n):
+        """Upcoming rows k..k+n-1, or None if fewer remain."""
+        if self.peek(k + n - 1) is None:
+            return None
+        return [self._buf[j] for j in range(k, k + n)]
+
+    def take(self, n=1):
+        return [self._buf.popleft() for _ in range(n)]
+
+def _plan_rows(plan: StepPlan, rows: _RowStream, stock_data: pd.DataFrame, labware_data: pd.DataFrame,
+               labware_titles: dict, p1000_loaded: bool, multichannel: bool, pool_stocks: bool,
+               compatibility: TipCompatibility = None, after_row=None, ledger: _VolumeLedger = None):
+    """
+    Append the steps for every row of 'rows' to 'plan'. 'after_row(plan)' is called after each row.
+    Stock volumes go through 'ledger' (default: a live one on 'stock_data'); a batch ledger leaves
+    aspirate heights to its finish().
+    With a 'compatibility' model, single-channel tips are reused across compatible sources; the
+    number of tips saved is counted in plan.report['tips_saved'].
+    """
+    ledger = ledger or _VolumeLedger(stock_data)
     # One-tip-per-source-well policy, tracked per pipette (overridden by mix logic)
-    current_source = {'p300': None, 'p1000': None}
-    picked = {'p300': False, 'p1000': False}
+    current_source = {'p300': None, 'p1000': None, 'p300m': None}
+    picked = {'p300': False, 'p1000': False, 'p300m': False}
+    # Stock names each held tip has drawn or mixed in (for the compatibility model)
+    drawn = {'p300': set(), 'p1000': set(), 'p300m': set()}
+    if compatibility is not None:
+        plan.report.setdefault('tips_saved', 0)
+
+    def source_name(key):
+        """Stock name behind a single-channel source key ('<slot>:<well>' for wells without a stock row)."""
+        if key[0] == 'pool':
+            return key[1]
+        idx = _find_stock_row(stock_data, key[0], key[1])
+        return str(stock_data.at[idx, 'stock name']).strip() if idx is not None else f'{key[0]}:{key[1]}'
+
+    inner_ids = {}
+
+    def id_cm_of(slot):
+        """lookup_id for a source slot, once per slot."""
+        if slot not in inner_ids:
+            inner_ids[slot] = lookup_id({'stock labware location 1': slot}, labware_data)
+        return inner_ids[slot]
+
+    def can_reuse_tip(pip_name, key):
+        if compatibility is None or not picked[pip_name] or not drawn[pip_name]:
+            return False
+        name = source_name(key)
+        return all(compatibility.compatible(d, name) for d in drawn[pip_name])
 
     def select_pipette(total_vol_ul: float) -> str:
         """Choose 'p1000' for >200 µL if available; else 'p300'."""
@@ -287,21 +1831,195 @@ def generate_protocol(stock_data: pd.DataFrame, labware_data: pd.DataFrame, oper
             return 'p1000'
         return 'p300'
 
-    def _next_source_for_pipette(ops_df: pd.DataFrame, start_row_idx: int, pip_name: str):
+    def multichannel_block_at(k):
+        """Rows k..k+7 if they form an 8-channel group, else None."""
+        if not multichannel:
+            return None
+        block = rows.peek_block(k, MULTI_CHANNELS)
+        if block is not None and _is_multichannel_block(block, labware_titles):
+            return block
+        return None
+
+    def _next_source_for_pipette(pip_name: str):
         """
-        Find the next operation (after start_row_idx) that uses 'pip_name',
+        Find the next upcoming operation that uses 'pip_name' (skipping 8-channel groups),
         and return its (slot, well) *source*. If none, return None.
         """
-        for k in range(start_row_idx + 1, len(ops_df)):
-            nxt = ops_df.iloc[k]
+        k = 0
+        while True:
+            nxt = rows.peek(k)
+            if nxt is None:
+                return None
+            if multichannel_block_at(k) is not None:
+                k += MULTI_CHANNELS
+                continue
+            k += 1
+            if _action_of(nxt):
+                continue
             pn = select_pipette(float(nxt['volume 1']))
             if pn != pip_name:
                 continue
             return (int(nxt['stock labware location 1']),
                     str(nxt['stock well location 1']).strip())
-        return None
 
-    for row_idx, op in ops.iterrows():
+    def emit_multichannel_group(block):
+        """Plan one 8-channel pass for the grouped rows (all A..H of a column, equal volumes)."""
+        first = block[0]
+        src_slot = int(first['stock labware location 1'])
+        dst_slot = int(first['receiving labware location'])
+        src_wells = [str(r['stock well location 1']).strip() for r in block]
+        dst_wells = [str(r['receiving well location']).strip() for r in block]
+        from_reservoir = len(set(src_wells)) == 1
+        src_key = (src_slot, src_wells[0] if from_reservoir else tuple(src_wells))
+
+        if current_source['p300m'] != src_key:
+            if picked['p300m']:
+                plan.add(OP_DROP, 'p300m')
+            plan.add(OP_PICK, 'p300m')
+            picked['p300m'] = True
+            current_source['p300m'] = src_key
+
+        id_cm = id_cm_of(src_slot)
+        for chunk in chunk_volumes(float(first['volume 1']), MAX_P300_HOLD_UL):
+            if from_reservoir:
+                # All 8 tips draw from the same trough
+                z, found = ledger.draw(src_slot, src_wells[0], chunk * MULTI_CHANNELS, id_cm)
+                missing = not found
+            else:
+                # One aspirate height for the whole column: use the deepest one so no tip draws air
+                zs = []
+                missing = False
+                for w in src_wells:
+                    zw, found = ledger.draw(src_slot, w, chunk, id_cm)
+                    missing = missing or not found
+                    zs.append(zw)
+                z = min(zs)
+            if missing:
+                plan.comment(f"WARNING: No stock specified for some source wells in slot {src_slot}; using default aspirate height.")
+            plan.add(OP_ASPIRATE, 'p300m', src_slot, src_wells[0], chunk, z)
+            ledger.bind(len(plan) - 1)
+            plan.add(OP_DISPENSE, 'p300m', dst_slot, dst_wells[0], chunk, DISPENSE_TOP_Z_MM)
+            dispensed = len(plan) - 1
+            plan.add(OP_TOUCH, 'p300m', dst_slot, dst_wells[0])
+            for w in dst_wells:
+                ledger.fill(dst_slot, w, chunk, dispensed)
+
+    def consolidation_block():
+        """The next rows if two or more share a consolidate group and destination (and don't mix), else None."""
+        first = rows.peek()
+        group = _consolidate_group(first)
+        if group is None:
+            return None
+        dst = (int(first['receiving labware location']), str(first['receiving well location']).strip())
+        block = []
+        while True:
+            nxt = rows.peek(len(block))
+            if nxt is None or _action_of(nxt) or _consolidate_group(nxt) != group:
+                break
+            if (int(nxt['receiving labware location']), str(nxt['receiving well location']).strip()) != dst:
+                break
+            if _extract_mix_params(nxt, MAX_P300_HOLD_UL, float(nxt['volume 1']))[0]:
+                break
+            if pool_stocks and _stock_pool_of(nxt, stock_data):
+                break
+            block.append(nxt)
+        return block if len(block) > 1 else None
+
+    def emit_consolidated(block):
+        """
+        Collect the block's sources into its destination: aspirate several sources in a row, each
+        followed by an air gap, as long as liquid plus air fits the tip, then dispense once.
+        """
+        first = block[0]
+        dst_slot = int(first['receiving labware location'])
+        dst_well = str(first['receiving well location']).strip()
+        pip_name = select_pipette(sum(float(r['volume 1']) for r in block))
+        max_hold = MAX_P1000_HOLD_UL if pip_name == 'p1000' else MAX_P300_HOLD_UL
+        air = CONSOLIDATE_AIR_GAP_UL
+
+        src_key = ('consolidate', _consolidate_group(first), dst_slot, dst_well)
+        if current_source[pip_name] != src_key:
+            if picked[pip_name]:
+                plan.add(OP_DROP, pip_name)
+            plan.add(OP_PICK, pip_name)
+            picked[pip_name] = True
+            current_source[pip_name] = src_key
+            drawn[pip_name] = set()
+        if compatibility is not None:
+            # The tip now carries every source of the group (it only dispenses at the top of the destination)
+            drawn[pip_name] |= {source_name((int(r['stock labware location 1']), str(r['stock well location 1']).strip()))
+                                for r in block}
+
+        def trip(pieces):
+            liquid = 0.0
+            for r, chunk in pieces:
+                src_slot = int(r['stock labware location 1'])
+                src_well = str(r['stock well location 1']).strip()
+                z, found = ledger.draw(src_slot, src_well, chunk, id_cm_of(src_slot))
+                if not found:
+                    plan.comment(f"WARNING: No stock specified for slot {src_slot} well {src_well}; using default aspirate height.")
+                plan.add(OP_ASPIRATE, pip_name, src_slot, src_well, chunk, z)
+                ledger.bind(len(plan) - 1)
+                plan.add(OP_AIR_GAP, pip_name, volume=air)
+                liquid += chunk
+            plan.add(OP_DISPENSE, pip_name, dst_slot, dst_well, round(liquid + air * len(pieces), 2), DISPENSE_TOP_Z_MM)
+            plan.add(OP_TOUCH, pip_name, dst_slot, dst_well)
+            ledger.fill(dst_slot, dst_well, liquid, len(plan) - 2)
+
+        pieces, held = [], 0.0
+        for r in block:
+            for chunk in chunk_volumes(float(r['volume 1']), max_hold - air):
+                if pieces and held + chunk + air > max_hold:
+                    trip(pieces)
+                    pieces, held = [], 0.0
+                pieces.append((r, chunk))
+                held += chunk + air
+        trip(pieces)
+
+    # Heater-shaker steps in progress: module slot -> (rpm, temperature)
+    running = {}
+
+    def wait_for_modules(slots):
+        """Finish running module steps that block any of 'slots' (the plate itself or an east/west neighbour)."""
+        for m in sorted(running):
+            if slots & ({m} | _east_west_neighbours(m)):
+                rpm, temp = running.pop(m)
+                plan.add(OP_MODULE_WAIT, slot=m, volume=rpm, z=temp)
+
+    def start_module_step(op):
+        slot = int(op['receiving labware location'])
+        if slot not in plan.modules:
+            raise RuntimeError(f"Action '{_action_of(op)}' targets slot {slot}, which has no module in the labware sheet.")
+        if plan.modules[slot][1] != HEATER_SHAKER:
+            raise RuntimeError(f"Timed actions are only supported on {HEATER_SHAKER} (slot {slot} has {plan.modules[slot][1]}).")
+        rpm, temp, duration = _action_params(op)
+        plan.add(OP_MODULE_START, slot=slot, volume=rpm, z=temp, arg=int(round(duration)))
+        running[slot] = (rpm, temp)
+
+    while rows.peek() is not None:
+        op = rows.peek()
+        if running:
+            wait_for_modules(_row_slots(op))
+        if _action_of(op):
+            rows.take()
+            start_module_step(op)
+            continue
+        block = multichannel_block_at(0)
+        if block is not None:
+            rows.take(MULTI_CHANNELS)
+            emit_multichannel_group(block)
+            if after_row:
+                after_row(plan)
+            continue
+        block = consolidation_block()
+        if block is not None:
+            rows.take(len(block))
+            emit_consolidated(block)
+            if after_row:
+                after_row(plan)
+            continue
+        rows.take()
+
         src_slot = int(op['stock labware location 1'])
         src_well = str(op['stock well location 1']).strip()
         dst_slot = int(op['receiving labware location'])
@@ -310,37 +2028,48 @@ def generate_protocol(stock_data: pd.DataFrame, labware_data: pd.DataFrame, oper
 
         pip_name = select_pipette(total_vol)
         max_hold = MAX_P1000_HOLD_UL if pip_name == 'p1000' else MAX_P300_HOLD_UL
-        pip_var = 'p1000' if pip_name == 'p1000' else 'p300'
 
         # Mix parameters for this op (decided at op level)
         do_mix, mix_reps, mix_vol, mix_each_chunk = _extract_mix_params(op, max_hold, total_vol)
 
-        src_key = (src_slot, src_well)
-        if current_source[pip_name] != src_key:
+        pool = _stock_pool_of(op, stock_data) if pool_stocks else None
+        src_key = ('pool', pool[0]) if pool else (src_slot, src_well)
+        if current_source[pip_name] != src_key and can_reuse_tip(pip_name, src_key):
+            plan.report['tips_saved'] += 1
+            drawn[pip_name].add(source_name(src_key))
+            current_source[pip_name] = src_key
+        elif current_source[pip_name] != src_key:
             if picked[pip_name]:
-                content.append(f"    {pip_var}.drop_tip()")
+                plan.add(OP_DROP, pip_name)
                 picked[pip_name] = False
-            content.append(f"    {pip_var}.pick_up_tip()")
+            plan.add(OP_PICK, pip_name)
             picked[pip_name] = True
             current_source[pip_name] = src_key
+            drawn[pip_name] = {source_name(src_key)} if compatibility is not None else set()
 
         chunks = chunk_volumes(total_vol, max_hold)
         for i, chunk in enumerate(chunks):
-            idx = _find_stock_row(stock_data, src_slot, src_well)
-            id_cm = lookup_id(op, labware_data)
-            z = _calc_height_and_update(stock_data, idx, chunk, ID_CM=float(id_cm))
-            if idx is None:
-                content.append(f"    # WARNING: No stock specified for slot {src_slot} well {src_well}; using default aspirate height.")
-            content.append(f"    {pip_var}.aspirate({chunk}, {labware_map[src_slot]}['{src_well}'].bottom(z={z}))")
-            content.append(f"    {pip_var}.dispense({chunk}, {labware_map[dst_slot]}['{dst_well}'].top(z=-3))")
+            if pool:
+                # Replicate choice depends on current volumes, so pools always use a live ledger
+                idx = _pick_replicate(stock_data, pool[1], chunk, labware_data)[0]
+                src_slot = int(stock_data.at[idx, 'labware location'])
+                src_well = str(stock_data.at[idx, 'well location']).strip()
+            id_cm = id_cm_of(src_slot)
+            z, found = ledger.draw(src_slot, src_well, chunk, id_cm)
+            if not found:
+                plan.comment(f"WARNING: No stock specified for slot {src_slot} well {src_well}; using default aspirate height.")
+            plan.add(OP_ASPIRATE, pip_name, src_slot, src_well, chunk, z)
+            ledger.bind(len(plan) - 1)
+            plan.add(OP_DISPENSE, pip_name, dst_slot, dst_well, chunk, DISPENSE_TOP_Z_MM)
+            dispensed = len(plan) - 1
 
             # Determine if we should mix now (per-chunk or only after the final chunk)
             mix_now = do_mix and (mix_each_chunk or i == len(chunks) - 1)
 
             if mix_now:
                 # Touch BEFORE mixing on the destination vessel
-                content.append(f"    {pip_var}.mix({int(mix_reps)}, {round(float(mix_vol),2)}, {labware_map[dst_slot]}['{dst_well}'].bottom(z={DEFAULT_MIX_Z_MM}))")
-                content.append(f"    {pip_var}.touch_tip({labware_map[dst_slot]}['{dst_well}'], radius=0.8, v_offset=-1, speed=60)")
+                plan.add(OP_MIX, pip_name, dst_slot, dst_well, round(float(mix_vol), 2), DEFAULT_MIX_Z_MM, int(mix_reps))
+                plan.add(OP_TOUCH, pip_name, dst_slot, dst_well)
 
                 # --- NEW: conditional tip keep/drop after mix ---
                 keep_tip = False
@@ -350,46 +2079,1727 @@ def generate_protocol(stock_data: pd.DataFrame, labware_data: pd.DataFrame, oper
                     keep_tip = False
                 else:
                     # Final chunk (or only mixing at end). Look ahead to the next op that uses this pipette.
-                    next_src = _next_source_for_pipette(ops, row_idx, pip_name)
+                    next_src = _next_source_for_pipette(pip_name)
                     keep_tip = (next_src is not None and next_src == (dst_slot, dst_well))
 
                 if keep_tip:
                     # Keep the tip because the very next aspiration by this pipette is from the just-mixed solution.
                     # Update current_source so the next op doesn't force a tip change.
                     current_source[pip_name] = (dst_slot, dst_well)
+                    if compatibility is not None:
+                        drawn[pip_name].add(source_name((dst_slot, dst_well)))
                     # Do NOT drop the tip here.
                 else:
                     # Drop now; a different solution will be aspirated next time this pipette is used.
-                    content.append(f"    {pip_var}.drop_tip()")
+                    plan.add(OP_DROP, pip_name)
                     picked[pip_name] = False
                     current_source[pip_name] = None
 
                 # If we dropped the tip due to mix_each_chunk and there are more chunks, pick up for the next chunk.
                 if mix_each_chunk and i < len(chunks) - 1:
-                    content.append(f"    {pip_var}.pick_up_tip()")
+                    plan.add(OP_PICK, pip_name)
                     picked[pip_name] = True
                     current_source[pip_name] = src_key
+                    drawn[pip_name] = {source_name(src_key)} if compatibility is not None else set()
             else:
                 # No mix yet → still touch tip after dispense
-                content.append(f"    {pip_var}.touch_tip({labware_map[dst_slot]}['{dst_well}'], radius=0.8, v_offset=-1, speed=60)")
+                plan.add(OP_TOUCH, pip_name, dst_slot, dst_well)
 
             # Track destination volume so it becomes a valid 'stock' for later steps
-            stock_data = upsert_destination_stock(stock_data, dst_slot, dst_well, chunk)
+            ledger.fill(dst_slot, dst_well, chunk, dispensed)
+
+        if after_row:
+            after_row(plan)
 
     # Drop any remaining picked tips (only if not already dropped during mixing logic)
     if picked['p300']:
-        content.append("    p300.drop_tip()")
+        plan.add(OP_DROP, 'p300')
     if p1000_loaded and picked['p1000']:
-        content.append("    p1000.drop_tip()")
+        plan.add(OP_DROP, 'p1000')
+    if picked['p300m']:
+        plan.add(OP_DROP, 'p300m')
+    wait_for_modules(set(running))
+
+def build_plan(stock_data: pd.DataFrame, labware_data: pd.DataFrame, operation_data: pd.DataFrame,
+               multichannel: bool = False, pool_stocks: bool = False, labware_dirs=(),
+               tip_compatibility=None, compact: bool = False, defer_mix: bool = False,
+               check_volumes: bool = True, memory: MemoryProfiler = None, timing: dict = None) -> StepPlan:
+    """
+    Turn the three input tables into a StepPlan. 'stock_data' is updated in place as volumes are drawn.
+    multichannel=True loads a p300_multi_gen2 on the right mount (in place of the p1000) and runs
+    column-aligned groups of transfers (see _is_multichannel_block) with it; everything else stays single-channel.
+    Modules in the labware sheet (type 'module') are loaded first and carry the labware listed on their slot.
+    Transfer rows with an 'action' (shake/heat/incubate plus rpm, temperature, duration) start a timed
+    heater-shaker step without blocking; pipetting continues elsewhere and waits only when a row needs that plate.
+    pool_stocks=True treats all stock rows with the same name as one pool: each chunk is drawn from the
+    fullest replicate (see _pick_replicate) and one tip serves the whole pool. Rows can then name the
+    stock in a 'stock name' column instead of giving slot and well.
+    Well names are canonicalized ('a01' -> 'A1') and, for labware whose definition JSON is found
+    (see labware_search_dirs; 'labware_dirs' is searched first), checked against the definition up front.
+    Consecutive rows with the same label in a 'consolidate' column and the same destination are
+    collected in as few trips as the tip allows, with an air gap after each source (one tip per group).
+    tip_compatibility (True, a TipCompatibility or its keyword args as a dict) relaxes the one-tip-per-source
+    policy: a held tip moves on to a compatible source instead of being swapped. Tips saved are counted
+    in plan.report['tips_saved'].
+    compact=True merges duplicate rows and drops empty ones first (see compact_transfers); its counts
+    go to plan.report['compaction'].
+    defer_mix=True mixes each destination once, after its last addition (see defer_mixing); mix
+    counts go to plan.report['deferred_mixing'].
+    check_volumes=True (default) fails before planning if, in the final row order, a destination would
+    overflow its wells or a source be drawn below its dead volume (see volume_violations).
+    memory (a MemoryProfiler) records each phase (setup, normalize, plan, heights) and enforces its budget.
+    timing (see timing_model) is the timing model used to overlap module steps with pipetting.
+    """
+    plan = StepPlan()
+    with _phase(memory, 'setup'):
+        labware_data, labware_titles, p1000_loaded = _setup_deck(plan, labware_data, multichannel)
+        well_indexes = _deck_well_indexes(labware_titles, labware_dirs)
+        _prepare_stocks(stock_data, labware_titles, well_indexes)
+
+    with _phase(memory, 'normalize'):
+        # Normalize and sort operations with PRIORITY
+        # Index = sheet row (0-based) through every reordering, for row numbers in messages
+        ops = _normalize_ops(operation_data.reset_index(drop=True), stock_data)
+        _check_ops_wells(ops, labware_titles, well_indexes)
+        if compact:
+            ops, plan.report['compaction'] = compact_transfers(ops)
+
+        # ---- priority sort (optional) ----
+        ops = _apply_priority_sort(ops)
+
+        # ---- overlap timed module steps with unrelated pipetting ----
+        if _col_lookup_case_insensitive(ops, _ACTION_SYNONYMS) is not None:
+            ops = _schedule_around_modules(ops, set(plan.modules), timing)
+        if defer_mix:
+            ops, plan.report['deferred_mixing'] = defer_mixing(ops)
+        if check_volumes:
+            problems = volume_violations(ops, stock_data, labware_data, well_indexes, labware_titles, pool_stocks)
+            if problems:
+                raise RuntimeError("Volumes out of range:\n  " + '\n  '.join(problems))
+
+    with _phase(memory, 'plan'):
+        rows = _RowStream(ops.to_dict('records'))
+        compatibility = _tip_compatibility(tip_compatibility)
+        if compatibility is not None:
+            compatibility = compatibility.with_sheet_classes(stock_data)
+        # Heights are computed in one batch after planning, unless replicate choice needs live volumes
+        ledger = _VolumeLedger(stock_data, batch=not pool_stocks, timeline=True)
+        _plan_rows(plan, rows, stock_data, labware_data, labware_titles, p1000_loaded, multichannel, pool_stocks,
+                   compatibility, after_row=memory.check if memory is not None else None, ledger=ledger)
+    with _phase(memory, 'heights'):
+        ledger.finish(plan)
+    return plan
+
+# ---------------- Streaming ingestion ----------------
+
+DEFAULT_CHUNK_ROWS = 50_000
+_MERGE_READ_ROWS = 2_048   # rows read at a time from each sorted run during the merge
+_FLUSH_STEPS = 20_000      # steps kept in memory before a streaming emitter writes them out
+
+def iter_transfer_chunks(path: str, chunksize: int = DEFAULT_CHUNK_ROWS):
+    """
+    Yield the transfers table at 'path' as DataFrames of at most 'chunksize' rows.
+    CSV is read with pandas; .parquet/.pq and Arrow IPC (.arrow/.feather/.ipc) are memory-mapped
+    through pyarrow (optional dependency, only needed for those formats).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.parquet', '.pq', '.arrow', '.feather', '.ipc'):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Reading Parquet/Arrow transfers needs pyarrow (pip install pyarrow).")
+        if ext in ('.parquet', '.pq'):
+            for batch in pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+        else:
+            with pa.memory_map(path) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    batch = reader.get_batch(i)
+                    for start in range(0, batch.num_rows, chunksize):
+                        yield batch.slice(start, chunksize).to_pandas()
+        return
+    yield from pd.read_csv(path, chunksize=chunksize)
+
+def _external_priority_sort(chunks):
+    """
+    Yield the rows of all 'chunks' ordered by (priority, original row) with bounded memory:
+    each chunk is sorted and spilled to a CSV run on disk, then the runs are merged lazily.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = []
+        offset = 0
+        for chunk in chunks:
+            chunk = chunk.assign(__priority__=_coerce_priority_series(chunk).fillna(float('inf')).to_numpy(),
+                                 __row__=np.arange(offset, offset + len(chunk)))
+            offset += len(chunk)
+            path = os.path.join(tmp, f"run_{len(runs)}.csv")
+            chunk.sort_values(['__priority__', '__row__'], kind='stable').to_csv(path, index=False)
+            runs.append(path)
+
+        def run_rows(path):
+            for part in pd.read_csv(path, chunksize=_MERGE_READ_ROWS):
+                for _, r in part.iterrows():
+                    yield float(r['__priority__']), int(r['__row__']), r
+
+        for _, _, r in heapq.merge(*(run_rows(p) for p in runs), key=lambda t: (t[0], t[1])):
+            yield r.drop(['__priority__', '__row__'])
+
+def _stream_rows(chunks, stock_data: pd.DataFrame, module_slots: set, chunksize: int,
+                 labware_titles: dict, well_indexes: dict):
+    """Normalized rows in execution order: externally sorted when a priority column exists, module-scheduled per chunk."""
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return
+    chunks = itertools.chain([first], chunks)
+
+    def normalized_chunks():
+        offset = 0
+        for c in chunks:
+            c = _normalize_ops(c.set_axis(range(offset, offset + len(c))), stock_data)
+            _check_ops_wells(c, labware_titles, well_indexes)
+            offset += len(c)
+            yield c
+    normalized = normalized_chunks()
+
+    if _col_lookup_case_insensitive(first, _PRIORITY_SYNONYMS) is not None:
+        sorted_rows = _external_priority_sort(normalized)
+        ordered = (pd.DataFrame(list(batch)) for batch in iter(lambda: list(itertools.islice(sorted_rows, chunksize)), []))
+    else:
+        ordered = normalized
+
+    scheduled = _col_lookup_case_insensitive(first, _ACTION_SYNONYMS) is not None
+    for frame in ordered:
+        if scheduled:
+            frame = _schedule_around_modules(frame.reset_index(drop=True), module_slots)
+        yield from frame.to_dict('records')
+
+def generate_protocol_streaming(stock_data: pd.DataFrame, labware_data: pd.DataFrame, transfers, save_path: str,
+                                chunksize: int = DEFAULT_CHUNK_ROWS, emitter: str = 'python',
+                                multichannel: bool = False, pool_stocks: bool = False, labware_dirs=(),
+                                tip_compatibility=None) -> dict:
+    """
+    Generate a protocol from a transfers sheet too large to hold in memory.
+    'transfers' is a path (see iter_transfer_chunks) or an iterable of DataFrames. Rows are planned as
+    they stream in and steps are written out every _FLUSH_STEPS, so memory stays flat as the sheet grows.
+    A priority column triggers an external sort; module actions are scheduled within each chunk.
+    Output matches generate_protocol for the 'python' and 'loop' emitters. Returns step/tip counts
+    (plus 'tips_saved' with a tip_compatibility model, see build_plan).
+    """
+    if emitter not in STREAM_EMITTERS:
+        raise ValueError(f"Emitter '{emitter}' can't stream; use one of {sorted(STREAM_EMITTERS)}.")
+    head, body, tail = STREAM_EMITTERS[emitter]
+    chunks = iter_transfer_chunks(transfers, chunksize) if isinstance(transfers, str) else transfers
 
-    content_string = ''
-    for i in range(len(content)):
-        content_string += content[i] + '\n'
+    plan = StepPlan()
+    labware_data, labware_titles, p1000_loaded = _setup_deck(plan, labware_data, multichannel)
+    well_indexes = _deck_well_indexes(labware_titles, labware_dirs)
+    _prepare_stocks(stock_data, labware_titles, well_indexes)
+    summary = {'steps': 0, 'tips': {}}
+
+    with open(save_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(head(plan)) + '\n')
+
+        def flush(p, force=False):
+            if len(p) < _FLUSH_STEPS and not force:
+                return
+            lines = body(p)
+            if lines:
+                f.write('\n'.join(lines) + '\n')
+            summary['steps'] += len(p)
+            for name, n in tip_counts(p).items():
+                summary['tips'][name] = summary['tips'].get(name, 0) + n
+            p.clear_steps()
+
+        compatibility = _tip_compatibility(tip_compatibility)
+        if compatibility is not None:
+            compatibility = compatibility.with_sheet_classes(stock_data)
+        rows = _RowStream(_stream_rows(chunks, stock_data, set(plan.modules), chunksize, labware_titles, well_indexes))
+        _plan_rows(plan, rows, stock_data, labware_data, labware_titles, p1000_loaded, multichannel, pool_stocks,
+                   compatibility, after_row=flush)
+        flush(plan, force=True)
+        lines = tail(plan)
+        if lines:
+            f.write('\n'.join(lines) + '\n')
+    summary.update(plan.report)
+    return summary
+
+# ---------------- Emitters ----------------
+
+def _protocol_header(plan: StepPlan) -> list:
+    """Metadata, labware and instrument loading lines shared by the Python emitters."""
+    content = [
+        "from opentrons import protocol_api",
+    ]
+    if plan.modules:
+        content.append("import time")
+    content += [
+        "",
+        "metadata = {",
+        "    'apiLevel': '2.15',",
+        f"    'protocolName': '{plan.name}',",
+        "    'author': 'Generated'",
+        "}",
+        "",
+        "def run(protocol: protocol_api.ProtocolContext):",
+    ]
+    if plan.modules:
+        content.append("    # Load modules")
+        for loc, (var, model) in plan.modules.items():
+            content.append(f"    {var} = protocol.load_module('{model}', {loc})")
+    content.append("    # Load labware")
+    for var, title, loc in plan.labware:
+        if loc in plan.modules:
+            content.append(f"    {var} = {plan.modules[loc][0]}.load_labware('{title}')")
+        else:
+            content.append(f"    {var} = protocol.load_labware('{title}', {loc})")
+    for loc, (var, model) in plan.modules.items():
+        if model == HEATER_SHAKER:
+            content.append(f"    {var}.close_labware_latch()")
+    content.append("")
+    for var, model, mount, tipracks in plan.instruments:
+        content.append(f"    {var} = protocol.load_instrument('{model}', '{mount}', tip_racks=[{', '.join(tipracks)}])")
+    for var, _, _, tipracks in plan.instruments:
+        if plan.start_tips.get(var):
+            content.append(f"    {var}.starting_tip = {_tip_well(var, tipracks, plan.start_tips[var])}")
+    content.append("")
+    return content
+
+def _tip_well(var: str, tipracks: list, used: int) -> str:
+    """Expression for the first unused tip of pipette 'var' after 'used' pick-ups."""
+    per_rack = TIPS_PER_RACK[var]
+    if used >= per_rack * len(tipracks):
+        raise RuntimeError(f"{var} has used all {per_rack * len(tipracks)} tips of its racks before this step.")
+    rack = tipracks[used // per_rack]
+    # The multichannel picks up a whole column: its k-th tip is the k-th well of row A
+    return f"{rack}.rows()[0][{used % per_rack}]" if var == 'p300m' else f"{rack}.wells()[{used % per_rack}]"
+
+def _module_step_lines(plan: StepPlan, s: Step) -> list:
+    """Heater-shaker start/wait as protocol lines. The timer lives in '<module>_until' at run time."""
+    mod = plan.modules[s.slot][0]
+    if s.op == OP_MODULE_START:
+        lines = []
+        if s.z:
+            lines.append(f"{mod}.set_target_temperature({s.z})")
+        if s.volume:
+            lines.append(f"{mod}.set_and_wait_for_shake_speed({s.volume:g})")
+        lines.append(f"{mod}_until = time.monotonic() + {s.arg}")
+        return lines
+    lines = []
+    if s.z:
+        lines.append(f"{mod}.wait_for_temperature()")
+    lines.append(f"protocol.delay(seconds=max(0, {mod}_until - time.monotonic()))")
+    if s.volume:
+        lines.append(f"{mod}.deactivate_shaker()")
+    if s.z:
+        lines.append(f"{mod}.deactivate_heater()")
+    return lines
+
+def _step_line(plan: StepPlan, s: Step, loc: str = None, z=None) -> str:
+    """
+    Format one step as a protocol line (without indentation); module steps may span several lines.
+    'loc' and 'z' replace the well expression and the aspirate height (see emit_python_stamped).
+    """
+    pip = PIPETTES[s.pipette]
+    if s.op in (OP_MODULE_START, OP_MODULE_WAIT):
+        return '\n    '.join(_module_step_lines(plan, s))
+    if s.op == OP_COMMENT:
+        return f"# {plan.comments[s.arg]}"
+    if s.op == OP_PICK:
+        return f"{pip}.pick_up_tip()"
+    if s.op == OP_DROP:
+        return f"{pip}.drop_tip()"
+    if s.op == OP_AIR_GAP:
+        return f"{pip}.air_gap({s.volume})"
+    loc = loc or f"{plan.labware_map[s.slot]}['{s.well}']"
+    if s.op == OP_ASPIRATE:
+        return f"{pip}.aspirate({s.volume}, {loc}.bottom(z={s.z if z is None else z}))"
+    if s.op == OP_DISPENSE:
+        return f"{pip}.dispense({s.volume}, {loc}.top(z={s.z:g}))"
+    if s.op == OP_MIX:
+        return f"{pip}.mix({s.arg}, {s.volume}, {loc}.bottom(z={s.z}))"
+    if s.op == OP_TOUCH:
+        return f"{pip}.touch_tip({loc}, radius={TOUCH_RADIUS}, v_offset={TOUCH_V_OFFSET}, speed={TOUCH_SPEED})"
+    raise ValueError(f"Unknown opcode {s.op}")
+
+def _python_body(plan: StepPlan) -> list:
+    return ["    " + _step_line(plan, s) for s in plan]
+
+def emit_python(plan: StepPlan) -> str:
+    """Fully unrolled protocol: one line per step."""
+    return '\n'.join(_protocol_header(plan) + _python_body(plan)) + '\n'
+
+def _loop_head(plan: StepPlan) -> list:
+    content = _protocol_header(plan)
+    pips = ', '.join(f"'{var}': {var}" for var, _, _, _ in plan.instruments)
+    wells = ', '.join(f"{loc}: {var}" for var, _, loc in plan.labware)
+    mods = ', '.join(f"{loc}: {var}" for loc, (var, _) in plan.modules.items())
+    content += [
+        f"    pipettes = {{{pips}}}",
+        f"    labware = {{{wells}}}",
+        f"    modules = {{{mods}}}",
+        "    until = {}",
+        "    STEPS = [",
+    ]
+    return content
+
+def _loop_body(plan: StepPlan) -> list:
+    content = []
+    for s in plan:
+        if s.op == OP_COMMENT:
+            content.append(f"        # {plan.comments[s.arg]}")
+            continue
+        content.append(f"        ({s.op}, '{PIPETTES[s.pipette]}', {s.slot}, '{s.well}', {s.volume}, {s.z}, {s.arg}),")
+    return content
+
+def _loop_tail(plan: StepPlan) -> list:
+    content = [
+        "    ]",
+        "    for op, pip_name, slot, well, vol, z, arg in STEPS:",
+        "        pip = pipettes[pip_name]",
+        f"        if op == {OP_PICK}:",
+        "            pip.pick_up_tip()",
+        f"        elif op == {OP_DROP}:",
+        "            pip.drop_tip()",
+        f"        elif op == {OP_ASPIRATE}:",
+        "            pip.aspirate(vol, labware[slot][well].bottom(z=z))",
+        f"        elif op == {OP_DISPENSE}:",
+        "            pip.dispense(vol, labware[slot][well].top(z=z))",
+        f"        elif op == {OP_MIX}:",
+        "            pip.mix(arg, vol, labware[slot][well].bottom(z=z))",
+        f"        elif op == {OP_TOUCH}:",
+        f"            pip.touch_tip(labware[slot][well], radius={TOUCH_RADIUS}, v_offset={TOUCH_V_OFFSET}, speed={TOUCH_SPEED})",
+        f"        elif op == {OP_AIR_GAP}:",
+        "            pip.air_gap(vol)",
+    ]
+    if plan.modules:
+        # vol = rpm, z = temperature, arg = duration (s)
+        content += [
+            f"        elif op == {OP_MODULE_START}:",
+            "            if z:",
+            "                modules[slot].set_target_temperature(z)",
+            "            if vol:",
+            "                modules[slot].set_and_wait_for_shake_speed(vol)",
+            "            until[slot] = time.monotonic() + arg",
+            f"        elif op == {OP_MODULE_WAIT}:",
+            "            if z:",
+            "                modules[slot].wait_for_temperature()",
+            "            protocol.delay(seconds=max(0, until[slot] - time.monotonic()))",
+            "            if vol:",
+            "                modules[slot].deactivate_shaker()",
+            "            if z:",
+            "                modules[slot].deactivate_heater()",
+        ]
+    return content
+
+def emit_loop_compact(plan: StepPlan) -> str:
+    """Protocol whose steps are a data table walked by a small interpreter loop."""
+    return '\n'.join(_loop_head(plan) + _loop_body(plan) + _loop_tail(plan)) + '\n'
+
+def emit_json(plan: StepPlan) -> str:
+    """Machine-readable plan: deck setup plus one [op, pipette, slot, well, volume, z, arg] row per step."""
+    steps = []
+    for s in plan:
+        arg = plan.comments[s.arg] if s.op == OP_COMMENT else s.arg
+        steps.append([OP_NAMES[s.op], PIPETTES[s.pipette], s.slot, s.well, s.volume, s.z, arg])
+    doc = {
+        'modules': [{'var': v, 'model': m, 'slot': loc} for loc, (v, m) in plan.modules.items()],
+        'labware': [{'var': v, 'title': t, 'slot': loc} for v, t, loc in plan.labware],
+        'instruments': [{'var': v, 'model': m, 'mount': mt, 'tip_racks': tr} for v, m, mt, tr in plan.instruments],
+        'steps': steps,
+    }
+    return json.dumps(doc)
+
+def checkpoints(plan: StepPlan) -> list:
+    """Step indices a run can be resumed from (checkpoint k starts at the k-th); see resume_points."""
+    return [i for i, _, _ in resume_points(plan)]
+
+def _tips_before(plan: StepPlan, cuts: list) -> dict:
+    """{pipette name: [tips picked up before each cut]} for every loaded pipette."""
+    out = {var: [] for var, _, _, _ in plan.instruments}
+    used = {var: 0 for var in out}
+    k = 0
+    for i in range(len(plan) + 1):
+        while k < len(cuts) and cuts[k] == i:
+            for var in out:
+                out[var].append(used[var])
+            k += 1
+        if i < len(plan) and plan.op[i] == OP_PICK:
+            used[PIPETTES[plan.pipette[i]]] += 1
+    return out
+
+def emit_python_resumable(plan: StepPlan) -> str:
+    """
+    Unrolled protocol with numbered checkpoints (see resume_points) and a 'start_step' runtime
+    parameter (API 2.18+). start_step=k skips everything before checkpoint k and starts each pipette on
+    the first tip the aborted run had not used yet; a pipette that held a tip there picks up a fresh
+    one and a module step that was running is started again for its full duration. Aspirate heights
+    are those of the full plan, i.e. computed from the stock volumes left at each checkpoint.
+    Labware and tipracks must stay as they were.
+    """
+    points = resume_points(plan)
+    cuts = [i for i, _, _ in points]
+    tips = _tips_before(plan, cuts)
+    header = _protocol_header(plan)
+    header[header.index("    'apiLevel': '2.15',")] = "    'apiLevel': '2.18',"
+    run_at = header.index("def run(protocol: protocol_api.ProtocolContext):")
+    header[run_at:run_at] = [
+        "def add_parameters(parameters):",
+        "    parameters.add_int(",
+        "        variable_name='start_step',",
+        "        display_name='Start at checkpoint',",
+        "        description='Resume an aborted run: skip the steps before this checkpoint.',",
+        "        default=0,",
+        "        minimum=0,",
+        f"        maximum={len(cuts) - 1},",
+        "    )",
+        "",
+    ]
+    content = header + [
+        "    start = protocol.params.start_step",
+        "    # Tips used before each checkpoint, per pipette: (pipette, [counts], tipracks, tips per rack, by column)",
+    ]
+    rows = ', '.join(f"({var}, {tips[var]}, [{', '.join(racks)}], {TIPS_PER_RACK[var]}, {var == 'p300m'})"
+                     for var, _, _, racks in plan.instruments)
+    content += [
+        f"    for pip, used, racks, per_rack, by_column in [{rows}]:",
+        "        n = used[start]",
+        "        if n:",
+        "            rack = racks[min(n // per_rack, len(racks) - 1)]",
+        "            pip.starting_tip = (rack.rows()[0] if by_column else rack.wells())[n % per_rack]",
+        "",
+    ]
+    bounds = cuts + [len(plan)]
+    for k, ((a, held, running), b) in enumerate(zip(points, bounds[1:])):
+        content += [
+            f"    # ---- checkpoint {k} (step {a}) ----",
+            f"    if start <= {k}:",
+            f"        protocol.comment('Checkpoint {k}')",
+        ]
+        if held or running:
+            content.append(f"        if start == {k}:")
+            for i in running.values():
+                content += ["            " + line for line in _module_step_lines(plan, plan[i])]
+            content += [f"            {var}.pick_up_tip()" for var in held]
+        for i in range(a, b):
+            content.append("        " + _step_line(plan, plan[i]).replace('\n    ', '\n        '))
+    return '\n'.join(content) + '\n'
+
+def resume_plan(plan: StepPlan, checkpoint: int) -> StepPlan:
+    """
+    The steps from 'checkpoint' (see checkpoints) on, as a plan of its own for a recovery run: its
+    aspirate heights follow the stock volumes left at the checkpoint, each pipette starts on the
+    first tip the aborted run had not used, pipettes that held a tip pick up a fresh one first and
+    module steps that were running are started again.
+    """
+    points = resume_points(plan)
+    cuts = [i for i, _, _ in points]
+    if not 0 <= checkpoint < len(cuts):
+        raise RuntimeError(f"Checkpoint {checkpoint} out of range; this plan has checkpoints 0-{len(cuts) - 1}.")
+    _, held, running = points[checkpoint]
+    part = plan.copy_setup()
+    for i in running.values():
+        s = plan[i]
+        part.add(s.op, slot=s.slot, volume=s.volume, z=s.z, arg=s.arg)
+    for var in held:
+        part.add(OP_PICK, var)
+    part.extend(plan.slice(cuts[checkpoint], len(plan)))
+    part.start_tips = {var: plan.start_tips.get(var, 0) + used[checkpoint]
+                       for var, used in _tips_before(plan, cuts).items()}
+    part.name = f"{plan.name} (resumed at checkpoint {checkpoint})"
+    return part
+
+_STAMP_CANDIDATES = 8  # later occurrences of a group's shape tried as the start of its next copy
+
+def _block_shape(plan: StepPlan, a: int, b: int):
+    """
+    Shape of steps a..b-1 with their labware abstracted: (shape, [(slot, first column)] per slot in
+    order of use, [aspirate heights], lead). 'lead' is the [(op, pipette)] of the tip pick-ups and
+    drops before the first other step; they set the tip state the copy starts from and are left out
+    of the shape. Two copies of a pattern that differ only in slots, column offsets, stock heights and
+    lead have equal shapes. Comments are left out. None if the steps use a module or a well that is
+    not <row><column>.
+    """
+    first_col, order = {}, []
+    for i in range(a, b):
+        op = plan.op[i]
+        if op in (OP_MODULE_START, OP_MODULE_WAIT):
+            return None
+        if op in (OP_COMMENT, OP_PICK, OP_DROP, OP_AIR_GAP):
+            continue
+        rc = _split_well(plan.well_names[plan.well[i]])
+        if rc is None:
+            return None
+        slot = plan.slot[i]
+        if slot not in first_col:
+            order.append(slot)
+            first_col[slot] = rc[1]
+        first_col[slot] = min(first_col[slot], rc[1])
+    shape, zs, lead = [], [], []
+    for i in range(a, b):
+        s = plan[i]
+        if s.op == OP_COMMENT:
+            continue
+        if s.op in (OP_PICK, OP_DROP) and not shape:
+            lead.append((s.op, s.pipette))
+            continue
+        loc = None
+        if s.op not in (OP_PICK, OP_DROP, OP_AIR_GAP):
+            row, col = _split_well(s.well)
+            loc = (order.index(s.slot), row, col - first_col[s.slot])
+        z = None
+        if s.op == OP_ASPIRATE:
+            zs.append(s.z)
+        else:
+            z = s.z
+        shape.append((s.op, s.pipette, loc, s.volume, z, s.arg))
+    return tuple(shape), [(slot, first_col[slot]) for slot in order], zs, lead
+
+def stamp_patterns(plan: StepPlan) -> list:
+    """
+    Split a plan into regions [(a, b, copies)]: 'copies' is None for steps emitted as they are, or the
+    [(start, end)] step ranges of two or more consecutive copies of one pattern (see _block_shape).
+    Copies start and end on transfer boundaries (see resume_points). Transfers are hashed by shape; a
+    copy is only looked for where the shape of a transfer recurs, so the work grows with the number of
+    transfers, not with the size of the patterns.
+    """
+    cuts = checkpoints(plan) + [len(plan)]
+    segs = list(zip(cuts, cuts[1:]))
+    keys, seen = [], {}
+    for j, (a, b) in enumerate(segs):
+        found = _block_shape(plan, a, b)
+        keys.append(None if found is None or not found[0] else found[0])
+        if keys[-1] is not None:
+            seen.setdefault(keys[-1], []).append(j)
+
+    def shape(i, k):
+        return _block_shape(plan, segs[i][0], segs[i + k - 1][1])
+
+    regions = []
+    i = 0
+    while i < len(segs):
+        found = None
+        if keys[i] is not None:
+            later = [j for j in seen[keys[i]] if j > i][:_STAMP_CANDIDATES]
+            for j in later:
+                k = j - i
+                base = shape(i, k)
+                if base is None:
+                    continue
+                n = 1
+                while i + (n + 1) * k <= len(segs):
+                    nxt = shape(i + n * k, k)
+                    if nxt is None or nxt[0] != base[0]:
+                        break
+                    n += 1
+                if n >= 2 and (found is None or k * n > found[0] * found[1]):
+                    found = (k, n)
+        if found is None:
+            a, b = segs[i]
+            if regions and regions[-1][2] is None:
+                regions[-1] = (regions[-1][0], b, None)
+            else:
+                regions.append((a, b, None))
+            i += 1
+            continue
+        k, n = found
+        copies = [(segs[i + r * k][0], segs[i + r * k + k - 1][1]) for r in range(n)]
+        regions.append((copies[0][0], copies[-1][1], copies))
+        i += k * n
+    return regions
+
+def emit_python_stamped(plan: StepPlan) -> str:
+    """
+    Protocol with each repeated pattern (see stamp_patterns) written once as a loop over its copies.
+    Each copy supplies the labware and first column of every slot that differs between copies, its
+    own aspirate heights (so stock levels stay exact) and, where copies differ in it, the tip
+    pick-ups and drops it starts with; everything else is shared.
+    """
+    content = _protocol_header(plan)
+    for a, b, copies in stamp_patterns(plan):
+        if copies is None:
+            content += ["    " + _step_line(plan, plan[i]) for i in range(a, b)]
+            continue
+        shapes = [_block_shape(plan, c, d) for c, d in copies]
+        params = shapes[0][1]
+        varying = [j for j in range(len(params)) if any(sh[1][j] != params[j] for sh in shapes)]
+        same_lead = all(sh[3] == shapes[0][3] for sh in shapes)
+        names = [f"d{j}, o{j}" for j in varying] + ["z"] + ([] if same_lead else ["tips"])
+        rows = []
+        for _, slots, zs, lead in shapes:
+            values = [f"{plan.labware_map[slots[j][0]]}, {slots[j][1]}" for j in varying] + [f"{zs}"]
+            if not same_lead:
+                calls = [f"{PIPETTES[pip]}.{'pick_up_tip' if op == OP_PICK else 'drop_tip'}" for op, pip in lead]
+                values.append(f"({', '.join(calls)}{',' if len(calls) == 1 else ''})")
+            rows.append(f"        ({', '.join(values)}),")
+        content += [f"    # Pattern at steps {a}-{b - 1}: {len(copies)} copies",
+                    f"    for {', '.join(names)} in ["] + rows + ["    ]:"]
+        if not same_lead:
+            content += ["        for tip_step in tips:", "            tip_step()"]
+        position = {slot: j for j, (slot, _) in enumerate(params)}
+        first_col = dict(params)
+        c, d = copies[0]
+        k = 0
+        led = same_lead
+        for i in range(c, d):
+            s = plan[i]
+            if s.op == OP_COMMENT:
+                continue
+            if s.op in (OP_PICK, OP_DROP) and not led:
+                continue
+            led = True
+            loc = z = None
+            if s.op not in (OP_PICK, OP_DROP, OP_AIR_GAP) and position[s.slot] in varying:
+                j = position[s.slot]
+                row, col = _split_well(s.well)
+                shift = col - first_col[s.slot]
+                loc = f"d{j}[f'{row}{{o{j} + {shift}}}']" if shift else f"d{j}[f'{row}{{o{j}}}']"
+            if s.op == OP_ASPIRATE:
+                z = f"z[{k}]"
+                k += 1
+            content.append("        " + _step_line(plan, s, loc, z))
+    return '\n'.join(content) + '\n'
+
+TELEMETRY_MARKER = '@step'
+
+def emit_python_telemetry(plan: StepPlan) -> str:
+    """
+    Unrolled protocol with a "protocol.comment('@step <i>')" marker before every transfer and module
+    step (see resume_points) and at the end, so the run log shows when each one started. See
+    parse_run_log and fit_timing for reading the exported log back.
+    """
+    marks = set(checkpoints(plan))
+    content = _protocol_header(plan)
+    for i, s in enumerate(plan):
+        if i in marks:
+            content.append(f"    protocol.comment('{TELEMETRY_MARKER} {i}')")
+        content.append("    " + _step_line(plan, s))
+    content.append(f"    protocol.comment('{TELEMETRY_MARKER} {len(plan)}')")
+    return '\n'.join(content) + '\n'
+
+EMITTERS = {
+    'python': emit_python,
+    'loop': emit_loop_compact,
+    'json': emit_json,
+    'resumable': emit_python_resumable,
+    'telemetry': emit_python_telemetry,
+    'stamped': emit_python_stamped,
+}
+
+# (head, body, tail) line builders for emitters that can write a plan out in pieces
+STREAM_EMITTERS = {
+    'python': (_protocol_header, _python_body, lambda plan: []),
+    'loop': (_loop_head, _loop_body, _loop_tail),
+}
+
+# ---------------- Peephole optimizer ----------------
+
+HOLD_UL = {'p300': MAX_P300_HOLD_UL, 'p1000': MAX_P1000_HOLD_UL, 'p300m': MAX_P300_HOLD_UL}
+
+# The passes below work on the command list only; comments ride along with the next command kept.
+
+def _next_cmd_of(cmds: list, i: int, pipette: int):
+    """Index of the first pipetting command after 'i' that uses 'pipette', or None."""
+    for j in range(i + 1, len(cmds)):
+        if cmds[j].op <= OP_DROP and cmds[j].pipette == pipette:
+            return j
+    return None
+
+def _elide_tip_swaps(cmds: list, keep: list, stock_wells) -> int:
+    """
+    Drop drop/pick pairs whose next aspiration would not be contaminated by the old tip.
+    Each well's content is the set of stock wells that went into it; a tip is dirty with everything
+    it drew or mixed in (top dispenses and touch-tips don't count, matching the one-tip-per-source policy).
+    Wells are assumed empty until dispensed into unless listed in 'stock_wells'; None assumes any
+    well may already hold liquid of its own, so only unmixed tips are reused.
+    """
+    content = {}
+    tip = {}
+    removed = 0
+
+    def content_of(key, may_be_empty=False):
+        if key not in content and not (may_be_empty and stock_wells is not None and key not in stock_wells):
+            content[key] = {key}
+        return content.get(key, set())
+
+    for i, s in enumerate(cmds):
+        if not keep[i] or s.op > OP_DROP:
+            continue
+        key = (s.slot, s.well)
+        if s.op == OP_PICK:
+            tip[s.pipette] = set()
+        elif s.op in (OP_ASPIRATE, OP_MIX):
+            tip[s.pipette] = tip.get(s.pipette, set()) | content_of(key)
+        elif s.op == OP_DISPENSE:
+            content[key] = content_of(key, may_be_empty=True) | tip.get(s.pipette, set())
+        elif s.op == OP_DROP:
+            j = _next_cmd_of(cmds, i, s.pipette)
+            k = _next_cmd_of(cmds, j, s.pipette) if j is not None and cmds[j].op == OP_PICK else None
+            if k is not None and cmds[k].op == OP_ASPIRATE:
+                if tip.get(s.pipette, set()) <= content_of((cmds[k].slot, cmds[k].well)):
+                    keep[i] = keep[j] = False
+                    removed += 1
+    return removed
+
+def _transfer_at(cmds: list, keep: list, i: int, pipette: int = None):
+    """(aspirate, dispense) if cmds[i], cmds[i+1] are one by the same pipette (and 'pipette' if given)."""
+    if i + 1 >= len(cmds) or not (keep[i] and keep[i + 1]):
+        return None
+    asp, disp = cmds[i], cmds[i + 1]
+    if asp.op != OP_ASPIRATE or disp.op != OP_DISPENSE or asp.pipette != disp.pipette:
+        return None
+    if pipette is not None and asp.pipette != pipette:
+        return None
+    return asp, disp
+
+def _merge_dispenses(cmds: list, keep: list) -> int:
+    """
+    Merge back-to-back transfers from one source into one destination with one pipette
+    (aspirate, dispense, [touch], aspirate, dispense) into a single transfer when the sum fits the tip.
+    The merged aspirate uses the lower of the two heights.
+    """
+    merged = 0
+    i = 0
+    while i < len(cmds):
+        first = _transfer_at(cmds, keep, i)
+        if first is None:
+            i += 1
+            continue
+        asp, disp = first
+        j = i + 2
+        while j < len(cmds):
+            touch = cmds[j]
+            has_touch = (touch.op == OP_TOUCH and touch.pipette == asp.pipette
+                         and (touch.slot, touch.well) == (disp.slot, disp.well))
+            nxt = _transfer_at(cmds, keep, j + 1 if has_touch else j, asp.pipette)
+            if nxt is None or (nxt[0].slot, nxt[0].well) != (asp.slot, asp.well) \
+                    or (nxt[1].slot, nxt[1].well, nxt[1].z) != (disp.slot, disp.well, disp.z):
+                break
+            total = round(asp.volume + nxt[0].volume, 2)
+            if total > HOLD_UL[PIPETTES[asp.pipette]]:
+                break
+            asp = Step(OP_ASPIRATE, asp.pipette, asp.slot, asp.well, total, min(asp.z, nxt[0].z))
+            disp = Step(OP_DISPENSE, disp.pipette, disp.slot, disp.well, total, disp.z)
+            end = j + 3 if has_touch else j + 2
+            for k in range(j, end):
+                keep[k] = False
+            merged += 1
+            j = end
+        cmds[i], cmds[i + 1] = asp, disp
+        i = j
+    return merged
+
+def _drop_redundant_touches(cmds: list, keep: list) -> int:
+    """
+    Remove a touch-tip when the same pipette touches the same well again right after: either
+    immediately, or after one more transfer (aspirate, dispense) into that well.
+    """
+    def same_well(c, s):
+        return c.pipette == s.pipette and (c.slot, c.well) == (s.slot, s.well)
+
+    live = [i for i, k in enumerate(keep) if k]
+    removed = 0
+    for n, i in enumerate(live):
+        s = cmds[i]
+        if s.op != OP_TOUCH:
+            continue
+        ahead = [cmds[j] for j in live[n + 1:n + 4]]
+        touch_again = len(ahead) >= 1 and ahead[0].op == OP_TOUCH and same_well(ahead[0], s)
+        refill_again = (len(ahead) == 3 and ahead[0].op == OP_ASPIRATE and ahead[0].pipette == s.pipette
+                        and ahead[1].op == OP_DISPENSE and same_well(ahead[1], s)
+                        and ahead[2].op == OP_TOUCH and same_well(ahead[2], s))
+        if touch_again or refill_again:
+            keep[i] = False
+            removed += 1
+    return removed
+
+def optimize_plan(plan: StepPlan, stock_wells=None):
+    """
+    Peephole pass over the step stream. Returns (optimized plan, report), where the report gives the
+    command count (comments excluded) before and after plus what was changed. Delivered volumes are unchanged:
+      - drop/pick pairs are elided when the old tip is clean for the next aspiration (see _elide_tip_swaps;
+        'stock_wells' is the set of (slot, well) holding liquid before the run),
+      - back-to-back transfers from one source into one well are merged when the sum fits the tip,
+      - touch-tips repeated on the same well are removed.
+    """
+    cmds, notes, pending, at = [], [], [], []
+    for i, s in enumerate(plan):
+        if s.op == OP_COMMENT:
+            pending.append(plan.comments[s.arg])
+        else:
+            cmds.append(s)
+            notes.append(pending)
+            at.append(i)
+            pending = []
+    keep = [True] * len(cmds)
+    report = {'before': len(cmds)}
+    report['tip_swaps_elided'] = _elide_tip_swaps(cmds, keep, stock_wells)
+    report['dispenses_merged'] = _merge_dispenses(cmds, keep)
+    report['touches_removed'] = _drop_redundant_touches(cmds, keep)
+    report['after'] = sum(keep)
+
+    new = plan.copy_setup()
+    moved = np.full(len(plan), -1, dtype=np.int64)  # old step -> new step, for the volume events
+    last = {}
+    carry = []
+    for s, texts, k, i in zip(cmds, notes, keep, at):
+        carry += texts
+        if k:
+            for text in carry:
+                new.comment(text)
+            carry = []
+            last[(s.op, s.pipette)] = moved[i] = len(new)
+            new.add(s.op, PIPETTES[s.pipette], s.slot, s.well, s.volume, s.z, s.arg)
+        else:
+            # A merged transfer's aspirate and dispense fold into the kept ones before them
+            moved[i] = last.get((s.op, s.pipette), -1)
+    for text in carry + pending:
+        new.comment(text)
+    if plan.volume_events is not None:
+        step = plan.volume_events['step']
+        new.volume_events = dict(plan.volume_events, step=np.where(step >= 0, moved[step], step))
+    return new, report
+
+# ---------------- Runtime estimates and splitting ----------------
+
+TIPS_PER_RACK = {'p300': 96, 'p1000': 96, 'p300m': 12}
+
+def _step_seconds(s: Step, timing: dict) -> float:
+    """Estimated duration of one step, excluding module waits (see estimate_runtime)."""
+    flow = timing['FLOW_UL_S'][PIPETTES[s.pipette]]
+    if s.op == OP_PICK:
+        return timing['T_PICK_S']
+    if s.op == OP_DROP:
+        return timing['T_DROP_S']
+    if s.op in (OP_ASPIRATE, OP_DISPENSE):
+        return timing['T_MOVE_S'] + s.volume / flow
+    if s.op == OP_MIX:
+        return timing['T_MOVE_S'] + 2 * s.arg * s.volume / flow
+    if s.op == OP_TOUCH:
+        return timing['T_TOUCH_S']
+    if s.op == OP_AIR_GAP:
+        return timing['T_AIR_GAP_S']
+    if s.op == OP_MODULE_START:
+        return timing['T_MODULE_START_S']
+    return 0.0
+
+def step_end_times(plan: StepPlan, timing: dict = None) -> array:
+    """
+    Estimated clock (s) at the end of every step, including time spent waiting on module timers.
+    'timing' is a timing model (see timing_model); None means the defaults.
+    """
+    timing = timing_model(timing)
+    ends = array('d')
+    clock = 0.0
+    until = {}
+    for i in range(len(plan)):
+        op = plan.op[i]
+        if op == OP_MODULE_WAIT:
+            clock = max(clock, until.pop(plan.slot[i], clock))
+        else:
+            clock += _step_seconds(plan[i], timing)
+            if op == OP_MODULE_START:
+                until[plan.slot[i]] = clock + plan.arg[i]
+        ends.append(clock)
+    return ends
+
+def estimate_runtime(plan: StepPlan, timing: dict = None) -> float:
+    """Estimated run time of a plan in seconds (see step_end_times for 'timing')."""
+    ends = step_end_times(plan, timing)
+    return ends[-1] if len(ends) else 0.0
+
+def tip_counts(plan: StepPlan) -> dict:
+    """Tips picked up per pipette name."""
+    counts = {}
+    for i in range(len(plan)):
+        if plan.op[i] == OP_PICK:
+            name = PIPETTES[plan.pipette[i]]
+            counts[name] = counts.get(name, 0) + 1
+    return counts
+
+def tip_capacity(plan: StepPlan) -> dict:
+    """Tips available per pipette name from the tipracks assigned to it."""
+    return {var: TIPS_PER_RACK[var] * len(racks) for var, _, _, racks in plan.instruments}
+
+def resume_points(plan: StepPlan) -> list:
+    """
+    [(step, held, running)] for every step a run can be resumed from or cut before: step 0 and the
+    start of every transfer (a tip pick-up, or an aspirate while no pipette holds liquid) and of
+    every module step, taking along the comments just before it. 'held' lists the pipettes holding
+    a tip there (PIPETTES order) and 'running' maps each module slot with a step still running to
+    the step that started it. A run resumed or split there picks up fresh tips for 'held' and
+    restarts the 'running' module steps (see resume_plan).
+    """
+    held, loaded, running = set(), set(), {}
+    points = [(0, [], {})]
+    lead = None   # first of the comments right before step i
+    prev = None   # last non-comment opcode
+    for i in range(len(plan)):
+        op, pip = plan.op[i], plan.pipette[i]
+        if op == OP_COMMENT:
+            lead = i if lead is None else lead
+            continue
+        starts = op in (OP_PICK, OP_MODULE_START, OP_MODULE_WAIT) or (op == OP_ASPIRATE and prev != OP_PICK)
+        at = i if lead is None else lead
+        if starts and not loaded and at > points[-1][0]:
+            points.append((at, [PIPETTES[p] for p in sorted(held)], dict(running)))
+        lead, prev = None, op
+        if op == OP_PICK:
+            held.add(pip)
+        elif op == OP_DROP:
+            held.discard(pip)
+        elif op in (OP_ASPIRATE, OP_AIR_GAP):
+            loaded.add(pip)
+        elif op == OP_DISPENSE:
+            loaded.discard(pip)
+        elif op == OP_MODULE_START:
+            running[plan.slot[i]] = i
+        elif op == OP_MODULE_WAIT:
+            running.pop(plan.slot[i], None)
+    return points
+
+def split_plan(plan: StepPlan, max_seconds: float = None, max_steps: int = None, max_tips: dict = None,
+               timing: dict = None) -> list:
+    """
+    Split a plan into sequential parts at resume_points where no module step is running. A part ends
+    before it would exceed the tips its racks hold (or 'max_tips' {pipette: n}), 'max_seconds' of
+    estimated runtime or 'max_steps' steps. A pipette that holds a tip at a cut drops it at the end
+    of its part and picks up a fresh one at the start of the next; these steps count towards the
+    limits. Raises if a single transfer (or a stretch spanning a module step) exceeds a limit on its
+    own. Parts keep the deck setup; since the plan was built in one pass, each part's aspirate
+    heights already follow the stock state left by the parts before it. Seconds are estimated with
+    'timing' (see timing_model).
+    """
+    timing = timing_model(timing)
+    capacity = dict(tip_capacity(plan))
+    capacity.update(max_tips or {})
+    ends = np.r_[0.0, np.frombuffer(step_end_times(plan, timing), dtype='d')]
+    ops, pips = np.frombuffer(plan.op, dtype=np.int8), np.frombuffer(plan.pipette, dtype=np.int8)
+    picks = {name: np.r_[0, np.cumsum((ops == OP_PICK) & (pips == PIPETTE_ID[name]))] for name in PIPETTES}
+    cuts = [(i, held) for i, held, running in resume_points(plan) if not running] + [(len(plan), [])]
+
+    def over(a, b):
+        """Limits a part from cut a to cut b would exceed, as text (empty if it fits)."""
+        (i, held_i), (j, held_j) = cuts[a], cuts[b]
+        problems = []
+        for name in PIPETTES:
+            n = int(picks[name][j] - picks[name][i]) + held_i.count(name)
+            if n > capacity.get(name, float('inf')):
+                problems.append(f"{n} {name} tips (capacity {capacity[name]})")
+        seconds = ends[j] - ends[i] + len(held_i) * timing['T_PICK_S'] + len(held_j) * timing['T_DROP_S']
+        if max_seconds is not None and seconds > max_seconds:
+            problems.append(f"{seconds:.0f} s (max_seconds {max_seconds})")
+        steps = j - i + len(held_i) + len(held_j)
+        if max_steps is not None and steps > max_steps:
+            problems.append(f"{steps} steps (max_steps {max_steps})")
+        return ', '.join(problems)
+
+    parts = []
+    start = 0
+    for b in range(1, len(cuts)):
+        if not over(start, b):
+            continue
+        if b - 1 > start:
+            parts.append((start, b - 1))
+            start = b - 1
+        problems = over(start, b)
+        if problems:
+            raise RuntimeError(f"Steps {cuts[start][0]}-{cuts[b][0]} can't be split further and need {problems}.")
+    parts.append((start, len(cuts) - 1))
+
+    out = []
+    for k, (a, b) in enumerate(parts, start=1):
+        (i, held_i), (j, held_j) = cuts[a], cuts[b]
+        part = plan.copy_setup()
+        for name in held_i:
+            part.add(OP_PICK, name)
+        part.extend(plan.slice(i, j))
+        for name in held_j:
+            part.add(OP_DROP, name)
+        if len(parts) > 1:
+            part.name = f"{plan.name} (part {k} of {len(parts)})"
+        out.append(part)
+    return out
+
+def generate_protocol_parts(stock_data: pd.DataFrame, labware_data: pd.DataFrame, operation_data: pd.DataFrame,
+                            save_path: str, emitter: str = 'python', max_seconds: float = None,
+                            max_steps: int = None, max_tips: dict = None, **options) -> list:
+    """
+    Like generate_protocol, but split into sequential runs (see split_plan). Part k is written to
+    '<save_path stem>_part<k><suffix>'; a single part goes to 'save_path'. Returns [(path, plan)].
+    """
+    plan = build_plan(stock_data, labware_data, operation_data, **options)
+    parts = split_plan(plan, max_seconds=max_seconds, max_steps=max_steps, max_tips=max_tips,
+                       timing=options.get('timing'))
+    stem, suffix = os.path.splitext(save_path)
+    written = []
+    for k, part in enumerate(parts, start=1):
+        path = save_path if len(parts) == 1 else f"{stem}_part{k}{suffix}"
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(EMITTERS[emitter](part))
+        written.append((path, part))
+    return written
+
+# ---------------- Run telemetry ----------------
+
+def _timing_features(plan: StepPlan, a: int, b: int, inv_flow: dict):
+    """
+    Steps a..b-1 as counts of the timing model's terms (see _step_seconds), or None if they wait on a
+    module timer. 'inv_flow' maps pipette name to the column of its 1/flow term.
+    """
+    x = np.zeros(len(_TIMING_PARAMS) + len(inv_flow))
+    for i in range(a, b):
+        op = plan.op[i]
+        name = PIPETTES[plan.pipette[i]]
+        if op == OP_MODULE_WAIT:
+            return None
+        if op == OP_PICK:
+            x[0] += 1
+        elif op == OP_DROP:
+            x[1] += 1
+        elif op in (OP_ASPIRATE, OP_DISPENSE):
+            x[2] += 1
+            x[inv_flow[name]] += plan.volume[i]
+        elif op == OP_MIX:
+            x[2] += 1
+            x[inv_flow[name]] += 2 * plan.arg[i] * plan.volume[i]
+        elif op == OP_TOUCH:
+            x[3] += 1
+        elif op == OP_AIR_GAP:
+            x[4] += 1
+        elif op == OP_MODULE_START:
+            x[5] += 1
+    return x
+
+def parse_run_log(log) -> pd.DataFrame:
+    """
+    Read a run log exported from the Opentrons App (a path, JSON text or the parsed dict) into one
+    row per executed command: step (last @step marker seen, -1 before the first), marker (the command
+    is that marker), type, pipette model, labware load name, slot, volume, started (s since the first
+    command) and seconds.
+    """
+    if isinstance(log, str):
+        if os.path.exists(log):
+            with open(log, encoding='utf-8') as f:
+                log = json.load(f)
+        else:
+            log = json.loads(log)
+    commands = log.get('commands') if isinstance(log, dict) else log
+    if commands is None and isinstance(log.get('data'), dict):
+        commands = log['data'].get('commands')
+    if not commands:
+        raise RuntimeError("Run log has no commands.")
+
+    pipettes, labware, rows = {}, {}, []
+    step = -1
+    for cmd in commands:
+        kind = cmd.get('commandType', '')
+        params = cmd.get('params') or {}
+        result = cmd.get('result') or {}
+        if kind == 'loadPipette':
+            pipettes[result.get('pipetteId', params.get('pipetteId'))] = params.get('pipetteName')
+        elif kind == 'loadLabware':
+            slot = (params.get('location') or {}).get('slotName')
+            labware[result.get('labwareId', params.get('labwareId'))] = (params.get('loadName'), slot)
+        words = str(params.get('message', '')).split() if kind == 'comment' else ()
+        marker = len(words) == 2 and words[0] == TELEMETRY_MARKER and words[1].isdigit()
+        if marker:
+            step = int(words[1])
+        load_name, slot = labware.get(params.get('labwareId'), (None, None))
+        rows.append({'step': step, 'marker': marker, 'type': kind, 'pipette': pipettes.get(params.get('pipetteId')),
+                     'labware': load_name, 'slot': slot, 'volume': params.get('volume'),
+                     'started': cmd.get('startedAt'), 'completed': cmd.get('completedAt')})
+    df = pd.DataFrame(rows)
+    started = pd.to_datetime(df['started'], utc=True, format='ISO8601')
+    completed = pd.to_datetime(df['completed'], utc=True, format='ISO8601')
+    df['seconds'] = (completed - started).dt.total_seconds()
+    df['started'] = (started - started.min()).dt.total_seconds()
+    return df.drop(columns='completed')
+
+def command_durations(log_df: pd.DataFrame) -> pd.DataFrame:
+    """Measured command durations (count, mean, median, total in s) per command type, pipette and labware."""
+    timed = log_df.dropna(subset=['seconds'])
+    keys = timed[['type', 'pipette', 'labware']].fillna('')
+    return (timed.groupby([keys['type'], keys['pipette'], keys['labware']])['seconds']
+            .agg(['count', 'mean', 'median', 'sum']).rename(columns={'sum': 'total'}).reset_index())
+
+_LOG_OVERHEADS = {'pickUpTip': 'T_PICK_S', 'dropTip': 'T_DROP_S', 'touchTip': 'T_TOUCH_S', 'airGapInPlace': 'T_AIR_GAP_S'}
+
+def _pipette_name(model) -> str:
+    """Pipette name used by the timing model for a loaded model ('p300_multi_gen2' -> 'p300m')."""
+    model = str(model)
+    return 'p300m' if model.startswith('p300_multi') else model.split('_')[0]
+
+def fit_timing(log_df: pd.DataFrame, plan: StepPlan = None, timing: dict = None) -> dict:
+    """
+    Fit the timing model to a parsed run log (see parse_run_log). Overheads are the median measured
+    durations of their commands; T_MOVE_S and FLOW_UL_S come from a least-squares fit of
+    seconds = T_MOVE_S + volume / flow over all aspirates and dispenses. Parameters the log doesn't
+    cover keep their value in 'timing' (see timing_model) and are listed in 'unfitted'. With the 'plan' the run was emitted
+    from (emitter 'telemetry'), the stretches between @step markers that don't wait on a module are
+    re-estimated with the fitted values and the rms error against the measured times is reported.
+    The result can be passed as 'timing' to the estimates, schedules and build_plan.
+    """
+    timed = log_df.dropna(subset=['seconds'])
+    params = timing_model(timing)
+    unfitted = []
+    for kind, name in _LOG_OVERHEADS.items():
+        seconds = timed.loc[timed['type'].eq(kind), 'seconds']
+        if len(seconds):
+            params[name] = round(float(seconds.median()), 3)
+        else:
+            unfitted.append(name)
+
+    moves = timed[timed['type'].isin(('aspirate', 'dispense')) & timed['volume'].notna() & timed['pipette'].notna()]
+    names = sorted({_pipette_name(m) for m in moves['pipette']})
+    if moves.empty:
+        unfitted.append('T_MOVE_S')
+    else:
+        X = np.zeros((len(moves), 1 + len(names)))
+        X[:, 0] = 1.0
+        for k, name in enumerate(names, start=1):
+            mask = moves['pipette'].map(_pipette_name).eq(name).to_numpy()
+            X[mask, k] = moves['volume'].to_numpy(dtype=float)[mask]
+        coef = np.linalg.lstsq(X, moves['seconds'].to_numpy(dtype=float), rcond=None)[0]
+        if coef[0] > 0:
+            params['T_MOVE_S'] = round(float(coef[0]), 3)
+        else:
+            unfitted.append('T_MOVE_S')
+        for k, name in enumerate(names, start=1):
+            if coef[k] > 0:
+                params['FLOW_UL_S'][name] = round(1.0 / float(coef[k]), 2)
+            else:
+                unfitted.append(f'FLOW_UL_S[{name}]')
+    unfitted.append('T_MODULE_START_S')
+    unfitted += [f'FLOW_UL_S[{name}]' for name in params['FLOW_UL_S'] if name not in names]
+    params['unfitted'] = unfitted
+    params['commands'] = len(timed)
+
+    if plan is not None:
+        marks = log_df[log_df['marker']].drop_duplicates('step')
+        inv_flow = {name: len(_TIMING_PARAMS) + k for k, name in enumerate(PIPETTES)}
+        theta = np.array([params[n] for n in _TIMING_PARAMS] + [1.0 / params['FLOW_UL_S'][n] for n in PIPETTES])
+        errors = []
+        for (a, t0), (b, t1) in zip(zip(marks['step'], marks['started']), zip(marks['step'][1:], marks['started'][1:])):
+            if not 0 <= a < b <= len(plan):
+                raise RuntimeError(f"Run log marker {TELEMETRY_MARKER} {b} does not belong to this plan.")
+            x = _timing_features(plan, a, b, inv_flow)
+            if x is not None:
+                errors.append(float(x @ theta) - (t1 - t0))
+        params['stretches'] = len(errors)
+        params['rms_error_s'] = round(float(np.sqrt(np.mean(np.square(errors)))), 3) if errors else None
+    return params
+
+# ---------------- Deck layout ----------------
+
+# OT-2 deck geometry: slot origins are 132.5 mm apart in x and 90.5 mm in y, 1-2-3 at the front
+SLOT_PITCH_MM = (132.5, 90.5)
+SLOT_SIZE_MM = (127.76, 85.48)
+DECK_SLOTS = tuple(range(1, 12))
+TRASH_SLOT = 12
+GANTRY_MM_S = 400.0   # default OT-2 x/y speed
+
+def _slot_origin(slot: int) -> tuple:
+    """(x, y) of a slot's front-left corner in mm (the labware frame's origin)."""
+    col, row = (int(slot) - 1) % 3, (int(slot) - 1) // 3
+    return (col * SLOT_PITCH_MM[0], row * SLOT_PITCH_MM[1])
+
+_SLOT_ORIGINS = np.array([(0.0, 0.0)] + [_slot_origin(s) for s in range(1, TRASH_SLOT + 1)])
+
+def slot_center(slot: int) -> tuple:
+    """(x, y) of a slot's centre in mm."""
+    x, y = _slot_origin(slot)
+    return (x + SLOT_SIZE_MM[0] / 2, y + SLOT_SIZE_MM[1] / 2)
+
+def slot_transitions(plan: StepPlan, well_indexes: dict = None) -> dict:
+    """
+    {(from slot, to slot, dx, dy): count} of gantry moves, per pipette command sequence. (dx, dy) is
+    the from-well's offset in its labware minus the to-well's (mm), so a move's length under any layout
+    is |origin(from) - origin(to) + (dx, dy)|. Wells are placed with 'well_indexes' {slot: WellIndex};
+    wells without a definition, tipracks (racks are used in order) and the trash count at the slot centre.
+    """
+    rack_slots = {var: slot for var, _, slot in plan.labware}
+    racks = {PIPETTE_ID[var]: [rack_slots[r] for r in rs if r in rack_slots] for var, _, _, rs in plan.instruments}
+    per_rack = {PIPETTE_ID[name]: n for name, n in TIPS_PER_RACK.items()}
+    well_indexes = well_indexes or {}
+    centre = (SLOT_SIZE_MM[0] / 2, SLOT_SIZE_MM[1] / 2)
+    offsets = {}
+
+    def offset(slot, w):
+        key = (slot, w)
+        if key not in offsets:
+            index = well_indexes.get(slot)
+            name = plan.well_names[w]
+            k = index.index.get(canonical_well(name) or name) if index is not None else None
+            offsets[key] = centre if k is None else (float(index.xyz[k, 0]), float(index.xyz[k, 1]))
+        return offsets[key]
+
+    picks = {}
+    moves = {}
+    here = None
+    for i in range(len(plan)):
+        op, pip = plan.op[i], plan.pipette[i]
+        if op == OP_PICK:
+            k = picks.get(pip, 0)
+            picks[pip] = k + 1
+            slots = racks.get(pip) or [None]
+            there = slots[min(k // per_rack[pip], len(slots) - 1)]
+            there = None if there is None else (there, centre)
+        elif op == OP_DROP:
+            there = (TRASH_SLOT, centre)
+        elif op <= OP_DROP:
+            there = (plan.slot[i], offset(plan.slot[i], plan.well[i]))
+        else:
+            continue
+        if there is not None and here is not None and there != here:
+            (a, (xa, ya)), (b, (xb, yb)) = here, there
+            key = (a, b, round(xa - xb, 2), round(ya - yb, 2))
+            moves[key] = moves.get(key, 0) + 1
+        here = there if there is not None else here
+    return moves
+
+def _move_arrays(transitions: dict) -> tuple:
+    keys = list(transitions)
+    a = np.array([k[0] for k in keys], dtype=np.int64)
+    b = np.array([k[1] for k in keys], dtype=np.int64)
+    d = np.array([k[2:] for k in keys], dtype='float64').reshape(-1, 2)
+    return a, b, d, np.array([transitions[k] for k in keys], dtype='float64')
+
+def _travel_mm(moves: tuple, mapping: dict) -> float:
+    a, b, d, n = moves
+    renamed = np.arange(len(_SLOT_ORIGINS))
+    for old, new in mapping.items():
+        renamed[old] = new
+    delta = _SLOT_ORIGINS[renamed[a]] - _SLOT_ORIGINS[renamed[b]] + d
+    return float(n @ np.hypot(delta[:, 0], delta[:, 1]))
+
+def layout_travel_mm(transitions: dict, mapping: dict = None) -> float:
+    """Total gantry travel (mm) for 'transitions' (see slot_transitions) with slots renamed by 'mapping' {old: new}."""
+    return _travel_mm(_move_arrays(transitions), mapping or {})
+
+def _fixed_slots(plan: StepPlan, fixed) -> set:
+    """Slots whose labware must stay: modules (and what sits on them), their east/west neighbours, 'fixed'."""
+    out = {int(s) for s in fixed} | {TRASH_SLOT}
+    for slot, (_, model) in plan.modules.items():
+        out.add(slot)
+        if model == HEATER_SHAKER:
+            out |= _east_west_neighbours(slot)
+    return out
+
+def optimize_deck_layout(stock_data: pd.DataFrame, labware_data: pd.DataFrame, operation_data: pd.DataFrame,
+                         fixed=(), **options):
+    """
+    Propose slots for the labware that minimize gantry travel for this run. The current layout is
+    planned (see build_plan for 'options'); the well-to-well moves it makes are then measured on the
+    OT-2 deck (well positions from the labware definitions, slot centres without one) and improved by
+    swapping labware between slots (and into empty ones) until no swap helps. Modules, labware on them,
+    heater-shaker neighbours, the trash and 'fixed' slots stay put. Returns (mapping {old slot: new slot},
+    report with travel and runtime estimates); apply_deck_layout / export_deck_layout rewrite the sheets.
+    """
+    plan = build_plan(stock_data.copy(), labware_data, operation_data, **options)
+    well_indexes = _deck_well_indexes({slot: title for _, title, slot in plan.labware},
+                                      options.get('labware_dirs', ()))
+    moves = _move_arrays(slot_transitions(plan, well_indexes))
+    keep = _fixed_slots(plan, fixed)
+    used = {slot for _, _, slot in plan.labware}
+    movable = sorted(used - keep)
+    free = [s for s in DECK_SLOTS if s not in keep and (s in movable or s not in used)]
+
+    mapping = {s: s for s in movable}
+    best = _travel_mm(moves, mapping)
+    while True:
+        found = None
+        taken = {v: k for k, v in mapping.items()}
+        for a in movable:
+            for target in free:
+                if target == mapping[a]:
+                    continue
+                trial = dict(mapping)
+                b = taken.get(target)
+                trial[a] = target
+                if b is not None:
+                    trial[b] = mapping[a]
+                cost = _travel_mm(moves, trial)
+                if cost < best - 1e-9 and (found is None or cost < found[0]):
+                    found = (cost, trial)
+        if found is None:
+            break
+        best, mapping = found
+
+    before = _travel_mm(moves, {})
+    runtime = estimate_runtime(plan, options.get('timing'))
+    report = {
+        'travel_mm_before': round(before, 1),
+        'travel_mm_after': round(best, 1),
+        'travel_s_before': round(before / GANTRY_MM_S, 1),
+        'travel_s_after': round(best / GANTRY_MM_S, 1),
+        'runtime_s_before': round(runtime, 1),
+        'runtime_s_after': round(runtime - (before - best) / GANTRY_MM_S, 1),
+    }
+    return {a: b for a, b in mapping.items() if a != b}, report
+
+def apply_deck_layout(mapping: dict, stock_data: pd.DataFrame, labware_data: pd.DataFrame,
+                      operation_data: pd.DataFrame):
+    """Return copies of the three sheets with every slot renamed by 'mapping' {old slot: new slot}."""
+    def remap(col):
+        return col.map(lambda v: v if pd.isna(v) or str(v).strip() == '' else mapping.get(int(float(v)), int(float(v))))
+
+    stocks, labware, ops = stock_data.copy(), labware_data.copy(), operation_data.copy()
+    stocks['labware location'] = remap(stocks['labware location'])
+    labware['location'] = remap(labware['location'])
+    for col in ops.columns:
+        if col in ('receiving labware location', 'stock labware location 1'):
+            ops[col] = remap(ops[col])
+    return stocks, labware, ops
+
+DECK_LAYOUT_FILES = ('stock solutions.csv', 'labware information.csv', 'transfers.csv')
+
+def export_deck_layout(mapping: dict, stock_data: pd.DataFrame, labware_data: pd.DataFrame,
+                       operation_data: pd.DataFrame, folder: str) -> list:
+    """
+    Write the sheets remapped by apply_deck_layout to 'folder' (created if missing) under the use-case
+    file names (DECK_LAYOUT_FILES). Returns the paths written.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for name, sheet in zip(DECK_LAYOUT_FILES, apply_deck_layout(mapping, stock_data, labware_data, operation_data)):
+        path = os.path.join(folder, name)
+        sheet.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+# ---------------- Multi-robot sharding ----------------
+
+SHARD_BY = ('component', 'labware')
+
+def _shard_units(ops: pd.DataFrame, by: str) -> list:
+    """
+    Group the (normalized) transfer rows into units that must run on the same robot, as lists of row
+    positions ordered by their first row. Rows are tied when one reads or writes a well another writes,
+    and to every row touching a slot a module action runs on; by='labware' also ties rows that share
+    a destination slot.
+    """
+    n = len(ops)
+    parent = list(range(n))
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    rows = [ops.iloc[k] for k in range(n)]
+    vessels = [_row_vessels(r) for r in rows]
+    writer, slot_rows, action_slots = {}, {}, set()
+    for k, (reads, writes) in enumerate(vessels):
+        for v in writes:
+            union(k, writer.setdefault(v, k))
+        for v in reads | writes:
+            slot_rows.setdefault(v[0], []).append(k)
+        if _action_of(rows[k]):
+            action_slots.add(int(rows[k]['receiving labware location']))
+    for k, (reads, _) in enumerate(vessels):
+        for v in reads:
+            if v in writer:
+                union(k, writer[v])
+    for slot in action_slots:
+        for k in slot_rows[slot]:
+            union(k, slot_rows[slot][0])
+    if by == 'labware':
+        first = {}
+        for k, row in enumerate(rows):
+            union(k, first.setdefault(int(row['receiving labware location']), k))
+
+    units = {}
+    for k in range(n):
+        units.setdefault(find(k), []).append(k)
+    return list(units.values())
+
+def shard_transfers(stock_data: pd.DataFrame, operation_data: pd.DataFrame, robots: int, by: str = 'component',
+                    timing: dict = None):
+    """
+    Partition the transfer sheet across 'robots' identical robots, each with its own copy of the stock
+    table. Units of dependent rows (see _shard_units) are dealt out longest first to the robot with the
+    least estimated work (_estimate_row_seconds with 'timing', see timing_model, plus module action
+    durations). Rows keep their sheet order. Returns ([transfer sheet per robot], [estimated seconds per robot]).
+    """
+    if by not in SHARD_BY:
+        raise RuntimeError(f"Unknown shard mode '{by}'; expected one of {list(SHARD_BY)}.")
+    if robots < 1:
+        raise RuntimeError("Sharding needs at least one robot.")
+    original = operation_data.reset_index(drop=True)
+    ops = _normalize_ops(original.copy(), stock_data.copy())
+    timing = timing_model(timing)
+
+    def seconds(k):
+        row = ops.iloc[k]
+        return _action_params(row)[2] if _action_of(row) else _estimate_row_seconds(row, timing)
+
+    units = _shard_units(ops, by)
+    costs = [sum(seconds(k) for k in unit) for unit in units]
+    load = [0.0] * robots
+    assigned = [[] for _ in range(robots)]
+    for u in sorted(range(len(units)), key=lambda u: -costs[u]):
+        r = load.index(min(load))
+        load[r] += costs[u]
+        assigned[r] += units[u]
+    return [original.iloc[sorted(rows)].reset_index(drop=True) for rows in assigned], load
+
+def generate_protocol_shards(stock_data: pd.DataFrame, labware_data: pd.DataFrame, operation_data: pd.DataFrame,
+                             save_path: str, robots: int, by: str = 'component', emitter: str = 'python',
+                             **options):
+    """
+    Like generate_protocol, but split the campaign across 'robots' OT-2s running in parallel (see
+    shard_transfers). Robot k's protocol is written to '<save_path stem>_robot<k><suffix>' and a summary
+    to '<save_path stem>_shards.json'. Every robot gets the same deck and a full stock table; the summary
+    lists what each one actually draws. Returns ([(path, plan)], summary) with the makespan (slowest
+    robot) against the total robot time.
+    """
+    shards, _ = shard_transfers(stock_data, operation_data, robots, by, options.get('timing'))
+    stem, suffix = os.path.splitext(save_path)
+    written, runtimes, rows, drawn = [], [], [], []
+    for k, ops in enumerate(shards, start=1):
+        if ops.empty:
+            runtimes.append(0.0)
+            rows.append(0)
+            drawn.append({})
+            continue
+        stocks = stock_data.copy()
+        text, plan = generate_protocol_text(stocks, labware_data, ops, emitter=emitter, **options)
+        path = f"{stem}_robot{k}{suffix}"
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        written.append((path, plan))
+        runtimes.append(estimate_runtime(plan, options.get('timing')))
+        rows.append(len(ops))
+        used = {}
+        for i in stock_data.index:
+            ul = float(stock_data.at[i, 'volume(ul)']) - float(stocks.at[i, 'volume(ul)'])
+            if ul > 0:
+                used[f"{stocks.at[i, 'stock name']} ({stocks.at[i, 'labware location']}:{stocks.at[i, 'well location']})"] = round(ul, 1)
+        drawn.append(used)
+
+    total = sum(runtimes)
+    makespan = max(runtimes)
+    summary = {
+        'robots': robots,
+        'by': by,
+        'rows': rows,
+        'runtime_s': [round(t, 1) for t in runtimes],
+        'makespan_s': round(makespan, 1),
+        'total_robot_s': round(total, 1),
+        'speedup': round(total / makespan, 2) if makespan else 1.0,
+        'stock_drawn_ul': drawn,
+    }
+    with open(f"{stem}_shards.json", 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    return written, summary
+
+# ---------------- Stock state ----------------
+
+STOCK_STATE_SUFFIX = '_stock_state.csv'
+
+def stock_state(stock_data: pd.DataFrame, labware_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    The stock table after a run (as left by build_plan, which draws it down in place) with a predicted
+    liquid height in mm (same inner diameters as lookup_id). Besides the input stocks it has a row for
+    every destination well that received liquid, named '<slot>:<well>' and holding what was dispensed,
+    so a plate filled today can be drawn from tomorrow. It is a valid stock sheet: the next run reads
+    it as is and ignores the height column.
+    """
+    state = stock_data.copy()
+    labware = labware_data[~labware_data.apply(_is_module_row, axis=1)] if len(labware_data) else labware_data
+    slots = set(labware['location'].astype(int))
+
+    def height_mm(row):
+        slot = int(row['labware location'])
+        if slot not in slots:
+            return float('nan')
+        radius_cm = 0.5 * lookup_id({'stock labware location 1': slot}, labware)
+        return round(float(row['volume(ul)']) / 1000.0 / (math.pi * radius_cm * radius_cm) * 10.0, 1)
+
+    state['volume(ul)'] = state['volume(ul)'].astype(float).round(3)
+    state['height (mm)'] = state.apply(height_mm, axis=1) if len(state) else []
+    return state.reset_index(drop=True)
+
+def export_stock_state(stock_data: pd.DataFrame, labware_data: pd.DataFrame, path: str) -> pd.DataFrame:
+    """Write stock_state(...) as CSV to 'path' (the next run's stock sheet) and return it."""
+    state = stock_state(stock_data, labware_data)
+    state.to_csv(path, index=False)
+    return state
+
+def generate_protocol_days(stock_data: pd.DataFrame, labware_data: pd.DataFrame, days: list, save_path: str,
+                           emitter: str = 'python', **options) -> list:
+    """
+    Generate a multi-day campaign in one pass: 'days' is a list of transfer sheets, each run starting
+    from the predicted stock state the day before ends with (see stock_state: wells filled on one day are
+    stocks the next). Day k is written to '<save_path stem>_day<k><suffix>' with its end state in
+    '<stem>_day<k>_stock_state.csv'.
+    Returns [(protocol path, stock state path, plan)].
+    """
+    stem, suffix = os.path.splitext(save_path)
+    state = stock_data
+    written = []
+    for k, ops in enumerate(days, start=1):
+        stocks = state.copy()
+        path = f"{stem}_day{k}{suffix}"
+        plan = generate_protocol(stocks, labware_data, ops, path, emitter=emitter, **options)
+        state_path = f"{stem}_day{k}{STOCK_STATE_SUFFIX}"
+        state = export_stock_state(stocks, labware_data, state_path)
+        written.append((path, state_path, plan))
+    return written
+
+# ---------------- Volume timeline ----------------
+
+class VolumeTimeline:
+    """
+    Predicted volume of every vessel over a plan built by build_plan, from the draws and fills it
+    recorded (plan.volume_events). Events are sorted per vessel once; a query is a dict lookup plus a
+    binary search, so it stays fast on plans with millions of steps. Volumes are µL after the given
+    step (the starting volume before the first event); heights are the aspirate z (mm) the plan used.
+    """
+
+    def __init__(self, plan: StepPlan):
+        events = plan.volume_events
+        if events is None:
+            raise RuntimeError("Plan has no volume events; plans from build_plan have them (kept by "
+                               "optimize_plan and StepPlan.slice), split parts and streamed runs don't.")
+        vessel = events['vessel']
+        order = np.lexsort((events['step'], vessel))
+        vessel = vessel[order]
+        self.steps = events['step'][order]
+        delta = events['delta'][order]
+        self.initial = events['initial']
+        self.bounds = np.searchsorted(vessel, np.arange(len(events['vessels']) + 1))
+        level = np.cumsum(delta)
+        start = self.bounds[:-1][vessel]
+        self.volumes = self.initial[vessel] + level - np.r_[0.0, level][start]
+        self.z = np.where(delta < 0, np.frombuffer(plan.z, dtype='d')[self.steps], np.nan)
+        self.index = {key: v for v, key in enumerate(events['vessels'])}
+
+    def vessels(self) -> list:
+        """(slot, well) of every vessel that was drawn from or filled."""
+        return list(self.index)
+
+    def _span(self, slot, well):
+        v = self.index.get((int(slot), canonical_well(well) or str(well).strip()))
+        if v is None:
+            raise RuntimeError(f"No volume events for {slot}:{well}.")
+        return v, self.bounds[v], self.bounds[v + 1]
+
+    def volume_at(self, slot, well, step: int) -> float:
+        """Volume (µL) in (slot, well) once step 'step' has run."""
+        v, lo, hi = self._span(slot, well)
+        k = lo + np.searchsorted(self.steps[lo:hi], step, side='right')
+        return float(self.volumes[k - 1]) if k > lo else float(self.initial[v])
+
+    def height_at(self, slot, well, step: int) -> float:
+        """Aspirate height (mm) of the last draw from (slot, well) at or before 'step'; NaN if none."""
+        _, lo, hi = self._span(slot, well)
+        k = lo + np.searchsorted(self.steps[lo:hi], step, side='right')
+        drawn = np.flatnonzero(~np.isnan(self.z[lo:k]))
+        return float(self.z[lo + drawn[-1]]) if len(drawn) else math.nan
+
+    def history(self, slot, well) -> pd.DataFrame:
+        """Every event on (slot, well): step, volume after it (µL) and aspirate z (mm, NaN for fills)."""
+        _, lo, hi = self._span(slot, well)
+        return pd.DataFrame({'step': self.steps[lo:hi], 'volume (ul)': self.volumes[lo:hi].round(3),
+                             'z (mm)': self.z[lo:hi]})
+
+def timeline_cli(argv=None):
+    """
+    Command line: build the plan for three sheets and print the predicted volume and aspirate height
+    of one well at a step, or its full history.
+
+        python OpentronsProtocolGenerator_V1.py timeline stocks.csv labware.csv transfers.csv 5 A2 --step 1200
+    """
+    ap = argparse.ArgumentParser(prog='OpentronsProtocolGenerator_V1.py timeline',
+                                 description="Predicted well volumes over a generated plan.")
+    ap.add_argument('stocks')
+    ap.add_argument('labware')
+    ap.add_argument('transfers')
+    ap.add_argument('slot', type=int)
+    ap.add_argument('well')
+    ap.add_argument('--step', type=int, help="report the state after this step (default: full history)")
+    ap.add_argument('--multichannel', action='store_true')
+    ap.add_argument('--pool-stocks', action='store_true')
+    ap.add_argument('--optimize', action='store_true', help="as generated with optimize=True (see optimize_plan)")
+    args = ap.parse_args(argv)
+    stock_data = pd.read_csv(args.stocks)
+    stock_wells = {(int(slot), canonical_well(well))
+                   for slot, well in zip(stock_data['labware location'], stock_data['well location'])}
+    plan = build_plan(stock_data, pd.read_csv(args.labware), pd.read_csv(args.transfers),
+                      multichannel=args.multichannel, pool_stocks=args.pool_stocks)
+    if args.optimize:
+        plan, _ = optimize_plan(plan, stock_wells)
+    timeline = VolumeTimeline(plan)
+    if args.step is None:
+        print(timeline.history(args.slot, args.well).to_csv(index=False), end='')
+    else:
+        z = timeline.height_at(args.slot, args.well, args.step)
+        print(f"{args.slot}:{args.well} after step {args.step}: "
+              f"{timeline.volume_at(args.slot, args.well, args.step):.1f} µL, "
+              + ("not aspirated from yet" if math.isnan(z) else f"last aspirate z {z} mm"))
+
+# ---------------------------------------------------
+
+def generate_protocol_text(stock_data: pd.DataFrame, labware_data: pd.DataFrame, operation_data: pd.DataFrame,
+                           emitter: str = 'python', optimize: bool = False, memory: MemoryProfiler = None,
+                           **options):
+    """
+    Like generate_protocol, but return (protocol text, plan) instead of writing a file.
+    optimize=True runs optimize_plan on the plan; its report is added to 'plan.report'.
+    'memory' (a MemoryProfiler) profiles the build_plan phases plus 'optimize' and 'emit'.
+    """
+    if emitter not in EMITTERS:
+        raise RuntimeError(f"Unknown emitter '{emitter}'; expected one of {sorted(EMITTERS)}.")
+    stock_wells = {(int(slot), canonical_well(well))
+                   for slot, well in zip(stock_data['labware location'], stock_data['well location'])}
+    plan = build_plan(stock_data, labware_data, operation_data, memory=memory, **options)
+    if optimize:
+        with _phase(memory, 'optimize'):
+            plan, report = optimize_plan(plan, stock_wells)
+            plan.report.update(report)
+    with _phase(memory, 'emit'):
+        text = EMITTERS[emitter](plan)
+    return text, plan
+
+def generate_protocol(stock_data: pd.DataFrame, labware_data: pd.DataFrame, operation_data: pd.DataFrame, save_path: str,
+                      emitter: str = 'python', optimize: bool = False, stock_state_path: str = None,
+                      **options) -> StepPlan:
+    """
+    Build the step plan for 'operation_data' (see build_plan for 'options'), write it to 'save_path'
+    with one of EMITTERS and return the plan:
+      'python'     fully unrolled protocol, one line per step (emit_python)
+      'loop'       steps as a data table walked by an interpreter loop (emit_loop_compact)
+      'json'       deck setup and steps as JSON, not a protocol (emit_json)
+      'resumable'  unrolled with numbered checkpoints and a start_step run-time parameter (emit_python_resumable)
+      'telemetry'  unrolled with '@step' comment markers for timing the run (emit_python_telemetry)
+      'stamped'    repeated plate patterns written once as loops (emit_python_stamped)
+    optimize=True runs the peephole optimizer (see optimize_plan) and adds its report to 'plan.report'.
+    stock_state_path also writes the predicted end-of-run stock sheet there (see export_stock_state).
+    """
+    content_string, plan = generate_protocol_text(stock_data, labware_data, operation_data, emitter, optimize, **options)
 
     with open(save_path, 'w', encoding='utf-8') as f:
         f.write(content_string)
+    if stock_state_path:
+        export_stock_state(stock_data, labware_data, stock_state_path)
+    return plan
 
 def main():
+    if sys.argv[1:2] == ['timeline']:
+        timeline_cli(sys.argv[2:])
+        return
+    # Tk only for the file dialogs: importing this module (the service, the timeline CLI) works without it
+    import tkinter as tk
+    from tkinter import filedialog, messagebox
+
     root = tk.Tk()
     root.withdraw()
 
@@ -422,8 +3832,10 @@ def main():
             messagebox.showerror("Error", f"Transfers CSV is missing required columns: {required_ops_cols}"); return
 
         # Generate protocol
-        generate_protocol(stock_data.copy(), labware_data.copy(), operations_data.copy(), destination)
-        messagebox.showinfo("Success", "Protocol successfully generated.")
+        state_path = os.path.splitext(destination)[0] + STOCK_STATE_SUFFIX
+        generate_protocol(stock_data.copy(), labware_data.copy(), operations_data.copy(), destination,
+                          stock_state_path=state_path)
+        messagebox.showinfo("Success", f"Protocol successfully generated.\nPredicted stock state: {state_path}")
 
     except Exception as e:
         messagebox.showerror("Error", f"Failed: {e}")
@@ -0,0 +1,235 @@
+"""
+Local protocol-generation service for LIMS integration.
+
+A long-running process that keeps pandas, the labware definitions it has used and recent results warm,
+so a request pays only for the generation itself (or nothing, when the same tables were seen before).
+Each worker parses a definition the first time a request puts that labware on the deck.
+
+    python OpentronsProtocolService.py --port 8765 --workers 4
+    python OpentronsProtocolService.py --unix /tmp/opentrons-gen.sock
+
+POST /generate with a JSON body:
+    {"stocks": ..., "labware": ..., "transfers": ...,     # CSV text or a list of row objects each
+     "emitter": "python" | "loop" | "json" | ...,          # optional (see EMITTERS), default 'python'
+     "options": {"multichannel": true, ...}}              # optional, passed to build_plan
+The protocol is streamed back (chunked) as text/plain. Input errors answer 400 with a JSON message.
+GET /health reports worker and cache counts.
+"""
+import argparse
+import asyncio
+import functools
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import OpentronsProtocolGenerator_V1 as gen
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+CACHE_ENTRIES = 256            # generated protocols kept in memory
+STREAM_CHUNK_BYTES = 64 * 1024
+MAX_BODY_BYTES = 256 * 1024 * 1024
+_OPTIONS = {'multichannel', 'pool_stocks', 'optimize', 'tip_compatibility', 'compact',
+            'defer_mix', 'timing'}
+
+# ---------------- Worker side ----------------
+
+def _read_table(value, name: str) -> pd.DataFrame:
+    """A table from the payload: CSV text or a list of row objects."""
+    if isinstance(value, str):
+        return pd.read_csv(io.StringIO(value))
+    if isinstance(value, list):
+        return pd.DataFrame.from_records(value)
+    raise RuntimeError(f"'{name}' must be CSV text or a list of row objects.")
+
+def _generate(payload: dict, labware_dirs: tuple) -> str:
+    """Run one generation in a worker process and return the protocol text."""
+    for name in ('stocks', 'labware', 'transfers'):
+        if name not in payload:
+            raise RuntimeError(f"Missing '{name}' table.")
+    options = payload.get('options') or {}
+    unknown = set(options) - _OPTIONS
+    if unknown:
+        raise RuntimeError(f"Unknown options {sorted(unknown)}; expected some of {sorted(_OPTIONS)}.")
+    text, _ = gen.generate_protocol_text(_read_table(payload['stocks'], 'stocks'),
+                                         _read_table(payload['labware'], 'labware'),
+                                         _read_table(payload['transfers'], 'transfers'),
+                                         emitter=payload.get('emitter', 'python'),
+                                         labware_dirs=labware_dirs, **options)
+    return text
+
+# ---------------- Service ----------------
+
+def payload_key(payload: dict) -> str:
+    """Cache key: a hash of the canonical JSON of the request."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class GenerationService:
+    """Worker pool plus an LRU cache of finished protocols; identical in-flight requests share one run."""
+
+    def __init__(self, workers: int = None, labware_dirs=(), cache_entries: int = CACHE_ENTRIES):
+        self.labware_dirs = tuple(labware_dirs)
+        self.workers = workers or os.cpu_count() or 1
+        # Spawned, not forked: a worker forked inside a request would inherit (and hold open) its connection
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        self.cache = OrderedDict()
+        self.cache_entries = cache_entries
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def generate(self, payload: dict) -> str:
+        key = payload_key(payload)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key in self.pending:
+            self.hits += 1
+            return await asyncio.shield(self.pending[key])
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(self.pool, _generate, payload, self.labware_dirs)
+        self.pending[key] = fut
+        try:
+            text = await fut
+        finally:
+            del self.pending[key]
+        self.cache[key] = text
+        while len(self.cache) > self.cache_entries:
+            self.cache.popitem(last=False)
+        return text
+
+    def health(self) -> dict:
+        return {'status': 'ok', 'workers': self.workers, 'cached': len(self.cache),
+                'in_flight': len(self.pending), 'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+# ---------------- HTTP ----------------
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+async def _read_request(reader: asyncio.StreamReader):
+    """Return (method, path, headers, body) for one HTTP/1.1 request, or None at end of stream."""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        k, _, v = line.decode('latin-1').partition(':')
+        headers[k.strip().lower()] = v.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise OverflowError(length)
+    body = await reader.readexactly(length) if length else b''
+    return method, path.split('?', 1)[0], headers, body
+
+async def _respond(writer, status: int, body: bytes, content_type='application/json'):
+    head = (f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n")
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+async def _respond_streamed(writer, text: str):
+    """Send 'text' as a chunked text/plain response."""
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                 b"Transfer-Encoding: chunked\r\n\r\n")
+    data = text.encode('utf-8')
+    for i in range(0, len(data), STREAM_CHUNK_BYTES):
+        piece = data[i:i + STREAM_CHUNK_BYTES]
+        writer.write(f"{len(piece):x}\r\n".encode('latin-1') + piece + b"\r\n")
+        await writer.drain()
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+def _error(message: str) -> bytes:
+    return json.dumps({'error': message}).encode('utf-8')
+
+async def _handle(service: GenerationService, reader, writer):
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except OverflowError:
+                await _respond(writer, 413, _error(f"Body larger than {MAX_BODY_BYTES} bytes."))
+                break
+            except (ValueError, asyncio.IncompleteReadError):
+                await _respond(writer, 400, _error("Malformed HTTP request."))
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            if path == '/health':
+                await _respond(writer, 200, json.dumps(service.health()).encode('utf-8'))
+            elif path != '/generate':
+                await _respond(writer, 404, _error(f"No route {path}."))
+            elif method != 'POST':
+                await _respond(writer, 405, _error("Use POST /generate."))
+            else:
+                try:
+                    payload = json.loads(body)
+                    if not isinstance(payload, dict):
+                        raise RuntimeError("Body must be a JSON object.")
+                    text = await service.generate(payload)
+                except (RuntimeError, ValueError, TypeError, KeyError) as e:
+                    await _respond(writer, 400, _error(str(e)))
+                except Exception as e:
+                    await _respond(writer, 500, _error(f"{type(e).__name__}: {e}"))
+                else:
+                    await _respond_streamed(writer, text)
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(host='127.0.0.1', port=DEFAULT_PORT, unix_path=None, workers=None, labware_dirs=()):
+    service = GenerationService(workers, labware_dirs)
+    handler = functools.partial(_handle, service)
+    if unix_path:
+        server = await asyncio.start_unix_server(handler, path=unix_path)
+        where = unix_path
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        where = f"http://{host}:{port}"
+    log.info("Opentrons protocol service on %s with %d workers", where, service.workers)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+def main():
+    ap = argparse.ArgumentParser(description="Serve Opentrons protocol generation over HTTP.")
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=DEFAULT_PORT)
+    ap.add_argument('--unix', help="listen on this Unix socket path instead of TCP")
+    ap.add_argument('--workers', type=int, help="generation processes (default: CPU count)")
+    ap.add_argument('--labware-dir', action='append', default=[],
+                    help=f"extra labware definition directory (repeatable; also ${gen.LABWARE_DIRS_ENV})")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.labware_dir))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
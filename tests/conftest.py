@@ -0,0 +1,54 @@
+import os
+import sys
+import warnings
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+sys.path.insert(0, ROOT)
+
+# Bundled use cases: folder -> transfers sheet
+USE_CASES = {
+    'Example': 'transfers.csv',
+    'HTE_Reaction_SamplePrep': 'transfers_20_20_50.csv',
+    'CalibrationCurve_SamplePrep': 'transfers.csv',
+}
+# Small sheets in tests/data: name -> build_plan options
+SMALL_CASES = {
+    'consolidate': {'tip_compatibility': True},
+    'heater_shaker': {},
+    'multichannel': {'multichannel': True},
+    'plates': {},
+}
+
+def load_use_case(name):
+    """(stocks, labware, transfers) of a bundled use case."""
+    folder = os.path.join(ROOT, 'UseCases', name)
+    return (pd.read_csv(os.path.join(folder, 'stock solutions.csv')),
+            pd.read_csv(os.path.join(folder, 'labware information.csv')),
+            pd.read_csv(os.path.join(folder, USE_CASES[name])))
+
+def load_small_case(name):
+    """(stocks, labware, transfers) of a sheet set in tests/data."""
+    return tuple(pd.read_csv(os.path.join(DATA, f"{name}_{table}.csv"))
+                 for table in ('stocks', 'labware', 'transfers'))
+
+@pytest.fixture(params=sorted(USE_CASES))
+def use_case(request):
+    return load_use_case(request.param)
+
+@pytest.fixture(params=sorted(USE_CASES) + sorted(SMALL_CASES))
+def any_case(request):
+    """(stocks, labware, transfers, build_plan options) for every use case and small sheet."""
+    if request.param in USE_CASES:
+        return load_use_case(request.param) + ({},)
+    return load_small_case(request.param) + (SMALL_CASES[request.param],)
+
+@pytest.fixture(autouse=True)
+def _quiet_warnings():
+    # The use cases draw from wells without a stock row on purpose; their warnings are not under test
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
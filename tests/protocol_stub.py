@@ -0,0 +1,140 @@
+"""
+Recording stand-in for the Opentrons Protocol API: runs a generated protocol and returns the
+commands it issued, so emitters can be compared by what the robot would do rather than by text.
+"""
+import sys
+import types
+from types import SimpleNamespace
+
+_ROWS = 'ABCDEFGH'
+
+class Well:
+    def __init__(self, labware, name):
+        self.slot, self.name = labware.slot, name
+
+    def __eq__(self, other):
+        return isinstance(other, Well) and (self.slot, self.name) == (other.slot, other.name)
+
+    def __hash__(self):
+        return hash((self.slot, self.name))
+
+    def bottom(self, z=0.0):
+        return ('bottom', self.slot, self.name, round(float(z), 6))
+
+    def top(self, z=0.0):
+        return ('top', self.slot, self.name, round(float(z), 6))
+
+class Labware:
+    def __init__(self, title, slot):
+        self.title, self.slot = title, slot
+
+    def __getitem__(self, name):
+        return Well(self, name)
+
+    def wells(self):
+        return [Well(self, f"{r}{c}") for c in range(1, 13) for r in _ROWS]
+
+    def rows(self):
+        return [[Well(self, f"{r}{c}") for c in range(1, 13)] for r in _ROWS]
+
+class Module:
+    def __init__(self, log, model, slot):
+        self.log, self.model, self.slot = log, model, slot
+
+    def load_labware(self, title):
+        return Labware(title, self.slot)
+
+    def __getattr__(self, name):
+        return lambda *args: self.log.append((self.model, name) + args)
+
+class Pipette:
+    def __init__(self, log, model, tip_racks):
+        self.log, self.model = log, model
+        by_column = model.startswith('p300_multi')
+        self.tips = [w for rack in tip_racks for w in (rack.rows()[0] if by_column else rack.wells())]
+        self.next_tip = 0
+        self.has_tip = False
+
+    @property
+    def starting_tip(self):
+        return self.tips[self.next_tip]
+
+    @starting_tip.setter
+    def starting_tip(self, well):
+        self.next_tip = self.tips.index(well)
+
+    def _record(self, *cmd):
+        self.log.append((self.model,) + cmd)
+
+    def pick_up_tip(self):
+        assert not self.has_tip, f"{self.model} picks up a tip while holding one"
+        tip = self.tips[self.next_tip]
+        self.next_tip += 1
+        self.has_tip = True
+        self._record('pick_up_tip', tip.slot, tip.name)
+
+    def drop_tip(self):
+        assert self.has_tip, f"{self.model} drops a tip it doesn't hold"
+        self.has_tip = False
+        self._record('drop_tip')
+
+    def aspirate(self, volume, location):
+        assert self.has_tip, f"{self.model} aspirates without a tip"
+        self._record('aspirate', round(float(volume), 6), location)
+
+    def dispense(self, volume, location):
+        self._record('dispense', round(float(volume), 6), location)
+
+    def mix(self, reps, volume, location):
+        assert self.has_tip, f"{self.model} mixes without a tip"
+        self._record('mix', int(reps), round(float(volume), 6), location)
+
+    def touch_tip(self, well, radius=1.0, v_offset=-1.0, speed=60.0):
+        self._record('touch_tip', well.slot, well.name, radius, v_offset, speed)
+
+    def air_gap(self, volume):
+        self._record('air_gap', round(float(volume), 6))
+
+class Protocol:
+    def __init__(self, log, params):
+        self.log = log
+        self.params = SimpleNamespace(**params)
+
+    def load_module(self, model, slot):
+        return Module(self.log, model, slot)
+
+    def load_labware(self, title, slot):
+        return Labware(title, slot)
+
+    def load_instrument(self, model, mount, tip_racks=()):
+        return Pipette(self.log, model, tip_racks)
+
+    def comment(self, message):
+        self.log.append(('comment', message))
+
+    def delay(self, seconds=0.0):
+        self.log.append(('delay',))
+
+def run_protocol(text: str, comments: bool = False, **params) -> list:
+    """
+    Execute protocol 'text' against the stand-in API and return its commands in order.
+    'params' are the run-time parameters (e.g. start_step=3); comments are left out unless asked for.
+    """
+    api = types.ModuleType('opentrons.protocol_api')
+    api.ProtocolContext = Protocol
+    package = types.ModuleType('opentrons')
+    package.protocol_api = api
+    saved = {name: sys.modules.get(name) for name in ('opentrons', 'opentrons.protocol_api')}
+    sys.modules.update({'opentrons': package, 'opentrons.protocol_api': api})
+    try:
+        namespace = {}
+        exec(compile(text, '<protocol>', 'exec'), namespace)
+        log = []
+        namespace['run'](Protocol(log, params))
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+    return log if comments else [cmd for cmd in log if cmd[0] != 'comment']
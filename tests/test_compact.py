@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+
+_COLUMNS = ['receiving labware location', 'receiving well location', 'stock labware location 1',
+            'stock well location 1', 'volume 1', 'priority']
+
+def _sheet(*rows):
+    """Transfer rows (source well, destination well, µL, priority) on slot 7."""
+    return pd.DataFrame([(7, dst, 7, src, vol, prio) for src, dst, vol, prio in rows], columns=_COLUMNS)
+
+def test_duplicates_merge_into_the_summed_volume():
+    out, report = gen.compact_transfers(_sheet(('A1', 'A2', 100, 1), ('A1', 'A3', 40, 1), ('A1', 'A2', 50, 1)))
+    assert list(zip(out['receiving well location'], out['volume 1'])) == [('A2', 150.0), ('A3', 40.0)]
+    assert report == {'rows_before': 3, 'rows_merged': 1, 'rows_dropped': 0, 'rows_after': 2}
+
+@pytest.mark.parametrize('between', [('A3', 'A1', 20, 1),    # writes the source
+                                     ('A2', 'A3', 20, 1),    # reads the destination
+                                     ('A3', 'A2', 20, 1)])   # writes the destination
+def test_an_intervening_access_blocks_the_merge(between):
+    out, report = gen.compact_transfers(_sheet(('A1', 'A2', 100, 1), between, ('A1', 'A2', 50, 1)))
+    assert report['rows_merged'] == 0 and list(out['volume 1']) == [100.0, 20.0, 50.0]
+
+def test_rows_of_a_later_priority_do_not_block():
+    # In sheet order the A2 -> A3 row sits between the duplicates, but it runs after both of them
+    out, report = gen.compact_transfers(_sheet(('A1', 'A2', 100, 1), ('A2', 'A3', 20, 2), ('A1', 'A2', 50, 1)))
+    assert report['rows_merged'] == 1
+    assert list(zip(out['receiving well location'], out['volume 1'])) == [('A2', 150.0), ('A3', 20.0)]
+
+def test_empty_rows_are_dropped_with_a_warning():
+    with pytest.warns(UserWarning, match=r"Dropped 2 transfer row\(s\).*rows 2, 3"):
+        out, report = gen.compact_transfers(_sheet(('A1', 'A2', 100, 1), ('A1', 'A3', 0, 1), ('A1', 'A4', -5, 1)))
+    assert report['rows_dropped'] == 2 and list(out['receiving well location']) == ['A2']
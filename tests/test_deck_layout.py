@@ -0,0 +1,23 @@
+import pandas as pd
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+
+def test_wells_are_placed_from_their_definition():
+    plan = gen.build_plan(*load_use_case('Example'))
+    assert all(a != b for a, b, _, _ in gen.slot_transitions(plan))
+    plate = gen.WellIndex({'ordering': [['A1', 'A2']],
+                           'wells': {'A1': {'x': 14.4, 'y': 74.2, 'z': 1.0}, 'A2': {'x': 23.4, 'y': 74.2, 'z': 1.0}}})
+    moves = gen.slot_transitions(plan, {7: plate})
+    assert moves[(7, 7, -9.0, 0.0)] == 2 and moves[(7, 7, 9.0, 0.0)] == 1
+    assert gen.layout_travel_mm(moves) > gen.layout_travel_mm(gen.slot_transitions(plan))
+
+def test_exported_layout_plans_with_the_reported_travel(tmp_path):
+    tables = load_use_case('CalibrationCurve_SamplePrep')
+    mapping, report = gen.optimize_deck_layout(*tables)
+    assert mapping and report['travel_mm_after'] < report['travel_mm_before']
+    paths = gen.export_deck_layout(mapping, *tables, str(tmp_path / 'layout'))
+    assert [p.rsplit('/', 1)[1] for p in paths] == list(gen.DECK_LAYOUT_FILES)
+    plan = gen.build_plan(*(pd.read_csv(p) for p in paths))
+    assert gen.layout_travel_mm(gen.slot_transitions(plan)) == pytest.approx(report['travel_mm_after'], abs=0.1)
@@ -0,0 +1,50 @@
+import pandas as pd
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+
+_COLUMNS = ['receiving labware location', 'receiving well location', 'stock labware location 1',
+            'stock well location 1', 'volume 1', 'mix', 'mix reps', 'mix volume']
+
+def _sheet(*rows):
+    """Rows (source well, destination well, µL, mix, reps, mix µL) on slot 7."""
+    return pd.DataFrame([(7, dst, 7, src, vol, *mix) for src, dst, vol, *mix in rows], columns=_COLUMNS)
+
+def _mixes(ops):
+    return [(k, ops['mix reps'].iloc[k], ops['mix volume'].iloc[k]) for k in range(len(ops)) if ops['mix'].iloc[k]]
+
+def test_last_addition_mixes_with_the_largest_settings():
+    ops, report = gen.defer_mixing(_sheet(('A1', 'A3', 100, True, 3, 50),
+                                          ('A1', 'A4', 100, False, None, None),
+                                          ('A2', 'A3', 100, True, 5, 30),
+                                          ('A4', 'A3', 100, False, None, None)))
+    assert _mixes(ops) == [(3, 5, 50.0)]
+    assert report == {'mixes_before': 2, 'mixes_after': 1}
+
+def test_well_is_mixed_before_it_is_read():
+    ops, _ = gen.defer_mixing(_sheet(('A1', 'A3', 100, True, 3, 50),
+                                     ('A2', 'A3', 100, True, 3, 50),
+                                     ('A3', 'A4', 50, False, None, None),
+                                     ('A1', 'A3', 100, True, 3, 50)))
+    assert [k for k, _, _ in _mixes(ops)] == [1, 3]
+
+def test_source_keeps_its_earlier_mix():
+    ops, _ = gen.defer_mixing(_sheet(('A1', 'A3', 100, True, 4, 60),
+                                     ('A3', 'A4', 50, True, 3, 40),
+                                     ('A2', 'A3', 100, False, None, None)))
+    assert _mixes(ops) == [(0, 4, 60.0), (1, 3, 40.0)]
+
+def test_planned_aspirates_follow_the_mix_of_their_well():
+    stocks, labware, _ = load_use_case('Example')
+    sheet = _sheet(('A1', 'A3', 100, True, 3, 50), ('A1', 'A3', 100, True, 3, 50),
+                   ('A3', 'A4', 50, False, None, None), ('A1', 'A3', 100, True, 3, 50))
+    plan = gen.build_plan(stocks, labware, sheet, defer_mix=True)
+    unmixed = set()
+    for s in plan:
+        if s.op == gen.OP_DISPENSE:
+            unmixed.add((s.slot, s.well))
+        elif s.op == gen.OP_MIX:
+            unmixed.discard((s.slot, s.well))
+        elif s.op == gen.OP_ASPIRATE:
+            assert (s.slot, s.well) not in unmixed
+    assert plan.report['deferred_mixing'] == {'mixes_before': 3, 'mixes_after': 2}
@@ -0,0 +1,18 @@
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+
+STOCK, DILUENT = (7, 'A1'), (7, 'A2')
+
+def test_blank_gets_diluent_only():
+    rows = gen.plan_dilution_series({'A1': 100, 'A2': 10, 'B3': 0}, 1000, 1000, STOCK, DILUENT, 4,
+                                    spare_wells=['C1', 'C2'])
+    blank = rows[rows['receiving well location'] == 'B3']
+    assert len(blank) == 1
+    assert (blank['stock labware location 1'].iloc[0], blank['stock well location 1'].iloc[0]) == DILUENT
+    assert blank['volume 1'].iloc[0] == 1000
+    assert rows.attrs['summary']['intermediates'] == 0
+
+def test_missing_intermediate_names_the_target_well():
+    with pytest.raises(RuntimeError, match=r"Standard 0\.01 in A1 "):
+        gen.plan_dilution_series({'A1': 0.01}, 1000, 1000, STOCK, DILUENT, 4, spare_wells=['C1'])
@@ -0,0 +1,24 @@
+import json
+
+import OpentronsProtocolGenerator_V1 as gen
+from protocol_stub import run_protocol
+
+def _plan(stocks, labware, transfers, options):
+    return gen.build_plan(stocks, labware, transfers, **options)
+
+def test_loop_emitter_runs_the_same_commands(any_case):
+    *tables, options = any_case
+    plan = _plan(*tables, options)
+    assert run_protocol(gen.emit_loop_compact(plan)) == run_protocol(gen.emit_python(plan))
+
+def test_json_emitter_lists_every_step(any_case):
+    *tables, options = any_case
+    plan = _plan(*tables, options)
+    doc = json.loads(gen.emit_json(plan))
+    assert [step[0] for step in doc['steps']] == [gen.OP_NAMES[op] for op in plan.op]
+    assert [i['var'] for i in doc['instruments']] == [var for var, _, _, _ in plan.instruments]
+
+def test_python_emitter_issues_one_command_per_step(use_case):
+    plan = gen.build_plan(*use_case)
+    commands = run_protocol(gen.emit_python(plan))
+    assert len(commands) == sum(1 for op in plan.op if op != gen.OP_COMMENT)
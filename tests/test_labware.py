@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+
+VIALS = '20mlscintvials_12_wellplate_20000ul'   # the Example deck's slot 7
+
+def _definition(load_name, wells=('A1', 'B1', 'A2', 'B2'), capacity=20000):
+    columns = {}
+    for w in wells:
+        columns.setdefault(w[1:], []).append(w)
+    return {'parameters': {'loadName': load_name}, 'ordering': list(columns.values()),
+            'wells': {w: {'x': 10.0 + 9 * int(w[1:]), 'y': 70.0 - 9 * 'ABCDEFGH'.index(w[0]), 'z': 1.0,
+                          'depth': 40.0, 'diameter': 25.0, 'totalLiquidVolume': capacity} for w in wells}}
+
+def _write(path, definition):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(definition), encoding='utf-8')
+
+@pytest.mark.parametrize('name, canonical', [('A1', 'A1'), ('a01', 'A1'), (' b12 ', 'B12'), ('h 3', 'H3'),
+                                             ('A', None), ('1A', None), ('', None), ('AA1', None)])
+def test_canonical_well(name, canonical):
+    assert gen.canonical_well(name) == canonical
+
+def test_definition_from_labware_dirs(tmp_path):
+    _write(tmp_path / 'plate_a.json', _definition('plate_a'))
+    index = gen.load_well_index('plate_a', (str(tmp_path),))
+    assert index.load_name == 'plate_a' and len(index) == 4
+    assert 'a02' in index and 'C1' not in index
+    assert [index[w] for w in ('A1', 'b01', 'A2')] == [0, 1, 2]
+    assert list(index.capacity_ul) == [20000] * 4
+
+def test_latest_version_wins_and_first_dir_wins(tmp_path):
+    for version in (2, 10):
+        _write(tmp_path / 'first' / 'plate_b' / f'{version}.json', _definition('plate_b', capacity=version))
+    _write(tmp_path / 'second' / 'plate_b.json', _definition('plate_b', capacity=-1))
+    index = gen.load_well_index('plate_b', (str(tmp_path / 'first'), str(tmp_path / 'second')))
+    assert index.capacity_ul[0] == 10
+
+def test_env_var_dirs_come_after_explicit_ones(tmp_path, monkeypatch):
+    _write(tmp_path / 'env' / 'plate_c.json', _definition('plate_c'))
+    monkeypatch.setenv(gen.LABWARE_DIRS_ENV, str(tmp_path / 'env'))
+    dirs = gen.labware_search_dirs([tmp_path / 'extra'])
+    assert dirs[:2] == (str(tmp_path / 'extra'), str(tmp_path / 'env'))
+    assert gen.load_well_index('plate_c', dirs) is not None
+
+def test_unknown_load_name(tmp_path):
+    assert gen.load_well_index('no_such_plate', (str(tmp_path),)) is None
+
+def test_build_plan_checks_wells_against_the_definition(tmp_path):
+    _write(tmp_path / f'{VIALS}.json', _definition(VIALS))
+    stocks, labware, transfers = load_use_case('Example')
+    gen.build_plan(stocks.copy(), labware, transfers, labware_dirs=[str(tmp_path)])
+    with pytest.raises(RuntimeError, match=f"7:C1 is not a well of {VIALS}"):
+        gen.build_plan(stocks.assign(**{'well location': 'C1'}), labware, transfers, labware_dirs=[str(tmp_path)])
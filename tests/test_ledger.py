@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+
+class _LiveLedger(gen._VolumeLedger):
+    """The planner's batch ledger forced into live mode (stock table updated chunk by chunk)."""
+
+    def __init__(self, stocks_df, batch=False, timeline=False):
+        super().__init__(stocks_df, False, timeline)
+
+def _build(ledger, monkeypatch, tables, options):
+    stocks, labware, transfers = (t.copy() for t in tables)
+    monkeypatch.setattr(gen, '_VolumeLedger', ledger)
+    plan = gen.build_plan(stocks, labware, transfers, **options)
+    monkeypatch.undo()
+    return plan, stocks
+
+def test_batch_heights_match_live(any_case, monkeypatch):
+    *tables, options = any_case
+    if options.get('pool_stocks'):
+        pytest.skip("replicate pools always plan live")
+    batch, batch_stocks = _build(gen._VolumeLedger, monkeypatch, tables, options)
+    live, live_stocks = _build(_LiveLedger, monkeypatch, tables, options)
+    assert np.array_equal(np.frombuffer(batch.z, dtype='d'), np.frombuffer(live.z, dtype='d'))
+    assert batch_stocks.equals(live_stocks)
+    for key in ('step', 'vessel', 'delta', 'initial'):
+        assert np.array_equal(batch.volume_events[key], live.volume_events[key])
+    assert batch.volume_events['vessels'] == live.volume_events['vessels']
+
+def test_callers_stock_table_gets_the_new_rows():
+    stocks, labware, transfers = load_use_case('Example')
+    gen.build_plan(stocks, labware, transfers)
+    expected = pd.DataFrame({'stock name': ['H2O', '7:A2'], 'volume(ul)': [3500.0, 1500.0],
+                             'labware location': [7, 7], 'well location': ['A1', 'A2']})
+    pd.testing.assert_frame_equal(stocks, expected, check_dtype=False)
@@ -0,0 +1,39 @@
+import json
+import tracemalloc
+
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+
+_PHASE_KEYS = {'phase', 'heap_peak_mb', 'heap_growth_mb', 'rss_mb', 'peak_rss_mb', 'top_allocators'}
+
+def test_report_has_one_entry_per_phase(tmp_path):
+    with gen.MemoryProfiler(top=3) as mem:
+        gen.generate_protocol_text(*load_use_case('Example'), optimize=True, memory=mem)
+    assert not tracemalloc.is_tracing()
+    report = mem.report()
+    assert set(report) == {'python', 'platform', 'pandas', 'numpy', 'budget_mb', 'rss_mb', 'peak_rss_mb', 'phases'}
+    assert [p['phase'] for p in report['phases']] == ['setup', 'normalize', 'plan', 'heights', 'optimize', 'emit']
+    for phase in report['phases']:
+        assert set(phase) == _PHASE_KEYS
+        assert phase['heap_peak_mb'] >= 0 and len(phase['top_allocators']) <= 3
+        for entry in phase['top_allocators']:
+            assert set(entry) == {'where', 'size_diff_kb', 'count_diff', 'innermost'}
+    path = tmp_path / 'memory.json'
+    mem.write_report(str(path))
+    assert json.loads(path.read_text(encoding='utf-8'))['phases'] == json.loads(json.dumps(report['phases']))
+
+def test_budget_exceeded_stops_the_run_with_the_profile_so_far():
+    with gen.MemoryProfiler(budget_mb=1) as mem:
+        with pytest.raises(gen.MemoryBudgetExceeded, match=r"budget 1 MB \(phase 'setup'\)") as failure:
+            gen.build_plan(*load_use_case('Example'), memory=mem)
+    assert isinstance(failure.value, RuntimeError)
+    assert [p['phase'] for p in failure.value.report['phases']] == ['setup']
+    assert failure.value.report['budget_mb'] == 1
+
+def test_check_between_phases():
+    mem = gen.MemoryProfiler(budget_mb=1)
+    with pytest.raises(gen.MemoryBudgetExceeded, match="between phases"):
+        mem.check()
+    gen.MemoryProfiler().check()  # no budget: never raises
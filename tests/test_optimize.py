@@ -0,0 +1,31 @@
+from collections import Counter
+
+import pandas as pd
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+
+def _volumes(plan):
+    """µL aspirated from and dispensed into every (slot, well)."""
+    moved = Counter()
+    for s in plan:
+        if s.op in (gen.OP_ASPIRATE, gen.OP_DISPENSE):
+            moved[(s.op, s.slot, s.well)] += s.volume
+    return {k: round(v, 6) for k, v in moved.items()}
+
+def test_optimizer_moves_the_same_volumes(any_case):
+    *tables, options = any_case
+    _, plan = gen.generate_protocol_text(tables[0].copy(), *tables[1:], **options)
+    _, optimized = gen.generate_protocol_text(tables[0].copy(), *tables[1:], optimize=True, **options)
+    assert _volumes(optimized) == _volumes(plan)
+    assert optimized.report['after'] <= optimized.report['before']
+    tips = gen.tip_counts(plan)
+    assert all(n <= tips[p] for p, n in gen.tip_counts(optimized).items())
+
+def test_merged_dispenses_keep_the_total():
+    stocks, labware, transfers = load_use_case('Example')
+    repeated = pd.concat([transfers] * 3, ignore_index=True).assign(**{'volume 1': 100, 'mix': 'no'})
+    _, plan = gen.generate_protocol_text(stocks.copy(), labware, repeated)
+    _, optimized = gen.generate_protocol_text(stocks.copy(), labware, repeated, optimize=True)
+    assert optimized.report['dispenses_merged'] > 0
+    assert _volumes(optimized) == _volumes(plan)
@@ -0,0 +1,56 @@
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_small_case
+
+def _map(**columns):
+    wells = {'receiving labware location': [2, 2, 2], 'receiving well location': ['A1', 'b01', 'C1']}
+    return pd.DataFrame({**wells, **columns})
+
+def _delivered(plan):
+    """µL dispensed per (destination well, source well)."""
+    out, source = Counter(), None
+    for s in plan:
+        if s.op == gen.OP_ASPIRATE:
+            source = s.well
+        elif s.op == gen.OP_DISPENSE:
+            out[(s.well, source)] += s.volume
+    return {k: round(v, 6) for k, v in out.items()}
+
+def test_concentrations_round_trip_through_the_plan():
+    stocks, labware, _ = load_small_case('consolidate')
+    plate = _map(**{'X': [1.0, 0.0, 2.0], 'Y': [None, 5.0, 5.0]})
+    transfers = gen.plate_map_to_transfers(plate, stocks, final_volume_ul=200, diluent='MeCN',
+                                           stock_concentrations={'X': 10.0, 'Y': 20.0})
+    plan = gen.build_plan(stocks, labware, transfers)
+    assert _delivered(plan) == {('A1', 'A1'): 180.0, ('A1', 'A2'): 20.0,
+                                ('B1', 'A1'): 150.0, ('B1', 'A3'): 50.0,
+                                ('C1', 'A1'): 110.0, ('C1', 'A2'): 40.0, ('C1', 'A3'): 50.0}
+
+def test_key_columns_can_be_anywhere():
+    stocks, _, _ = load_small_case('consolidate')
+    plate = _map(X=[10.0, 20.0, 30.0])
+    reordered = plate[['X', 'receiving well location', 'receiving labware location']]
+    expected = gen.plate_map_to_transfers(plate, stocks, mode='volume')
+    pd.testing.assert_frame_equal(gen.plate_map_to_transfers(reordered, stocks, mode='volume'), expected)
+    assert list(expected['receiving well location']) == ['A1', 'B1', 'C1']
+
+def test_overfull_wells_are_named_by_their_key_columns():
+    stocks, _, _ = load_small_case('consolidate')
+    plate = _map(X=[10.0, 300.0, 30.0])[['X', 'receiving well location', 'receiving labware location']]
+    with pytest.raises(RuntimeError, match=r"\['2:b01'\]"):
+        gen.plate_map_to_transfers(plate, stocks, final_volume_ul=200, mode='volume', diluent='MeCN')
+
+@pytest.mark.parametrize('wells, values, message', [
+    (['A1', 'Z', 'C1'], [10.0, 20.0, 30.0], r"not a well name, e.g. \['2:Z'\]"),
+    (['A1', 'B1', 'C1'], [10.0, -5.0, 30.0], r"negative values, e.g. \['2:B1 X=-5.0'\]"),
+    (['A1', 'B1', 'C1'], [10.0, 'lots', ' '], r"1 non-numeric or negative values, e.g. \['2:B1 X=lots'\]"),
+])
+def test_bad_wells_and_values_are_rejected(wells, values, message):
+    stocks, _, _ = load_small_case('consolidate')
+    plate = pd.DataFrame({'receiving labware location': 2, 'receiving well location': wells, 'X': values})
+    with pytest.raises(RuntimeError, match=message):
+        gen.plate_map_to_transfers(plate, stocks, mode='volume')
@@ -0,0 +1,47 @@
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_small_case, load_use_case
+from protocol_stub import run_protocol
+
+_TIP_CMDS = ('pick_up_tip', 'drop_tip')
+
+def _commands_from(plan, step):
+    """Commands of the full run from 'step' on (comments excluded, one command per step)."""
+    return run_protocol(gen.emit_python(plan))[sum(1 for op in plan.op[:step] if op != gen.OP_COMMENT):]
+
+def _liquid(commands):
+    return [c for c in commands if c[1] not in _TIP_CMDS]
+
+@pytest.mark.parametrize('name', ['HTE_Reaction_SamplePrep', 'CalibrationCurve_SamplePrep'])
+def test_every_transfer_is_a_checkpoint(name):
+    plan = gen.build_plan(*load_use_case(name))
+    chunks = sum(1 for i, op in enumerate(plan.op)
+                 if op == gen.OP_ASPIRATE and plan.op[i - 1] != gen.OP_AIR_GAP)
+    assert len(gen.checkpoints(plan)) == chunks
+
+def test_start_zero_runs_the_full_protocol():
+    plan = gen.build_plan(*load_use_case('HTE_Reaction_SamplePrep'))
+    assert run_protocol(gen.emit_python_resumable(plan), start_step=0) == run_protocol(gen.emit_python(plan))
+
+@pytest.mark.parametrize('name', ['HTE_Reaction_SamplePrep', 'CalibrationCurve_SamplePrep'])
+def test_resumed_run_repeats_nothing_and_uses_fresh_tips(name):
+    plan = gen.build_plan(*load_use_case(name))
+    text = gen.emit_python_resumable(plan)
+    full = run_protocol(gen.emit_python(plan))
+    points = gen.resume_points(plan)
+    for k in (1, len(points) // 2, len(points) - 1):
+        step, held, _ = points[k]
+        resumed = run_protocol(text, start_step=k)
+        assert _liquid(resumed) == _liquid(_commands_from(plan, step))
+        done = len(full) - len(_commands_from(plan, step))
+        used = {c[2:] for c in full[:done] if c[1] == 'pick_up_tip'}
+        picked = [c for c in resumed if c[1] == 'pick_up_tip']
+        assert not used & {c[2:] for c in picked}
+        assert len(picked) == sum(1 for c in full[done:] if c[1] == 'pick_up_tip') + len(held)
+
+def test_resume_plan_matches_the_resumable_protocol():
+    plan = gen.build_plan(*load_small_case('heater_shaker'))
+    text = gen.emit_python_resumable(plan)
+    for k in range(len(gen.resume_points(plan))):
+        assert run_protocol(gen.emit_python(gen.resume_plan(plan, k))) == run_protocol(text, start_step=k)
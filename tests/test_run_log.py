@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta, timezone
+import json
+
+import pandas as pd
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+
+# The "robot" the synthetic log comes from
+TRUE = {'T_PICK_S': 9.0, 'T_DROP_S': 4.0, 'T_MOVE_S': 1.5, 'T_TOUCH_S': 0.5, 'FLOW_UL_S': 250.0}
+_COMMANDS = {gen.OP_PICK: 'pickUpTip', gen.OP_DROP: 'dropTip', gen.OP_ASPIRATE: 'aspirate',
+             gen.OP_DISPENSE: 'dispense', gen.OP_TOUCH: 'touchTip'}
+
+def _plan():
+    stocks, labware, transfers = load_use_case('Example')
+    sheet = pd.concat([transfers] * 3, ignore_index=True).assign(**{'volume 1': [500, 700, 900], 'mix': 'no'})
+    return gen.build_plan(stocks, labware, sheet)
+
+def _run_log(plan):
+    """App-style run log of 'plan' with @step markers before every checkpoint, timed by TRUE."""
+    clock = datetime(2026, 1, 5, 9, 0, tzinfo=timezone.utc)
+    commands = []
+
+    def command(kind, seconds=0.0, **params):
+        nonlocal clock
+        end = clock + timedelta(seconds=seconds)
+        commands.append({'commandType': kind, 'params': params, 'result': params.get('_result', {}),
+                         'startedAt': clock.isoformat(), 'completedAt': end.isoformat()})
+        clock = end
+
+    command('loadPipette', pipetteName='p1000_single_gen2', _result={'pipetteId': 'p1'})
+    command('loadLabware', loadName='vials', location={'slotName': '7'}, _result={'labwareId': 'lw7'})
+    marks = set(gen.checkpoints(plan))
+    for i, s in enumerate(plan):
+        if i in marks:
+            command('comment', message=f'{gen.TELEMETRY_MARKER} {i}')
+        if s.op in (gen.OP_ASPIRATE, gen.OP_DISPENSE):
+            command(_COMMANDS[s.op], TRUE['T_MOVE_S'] + s.volume / TRUE['FLOW_UL_S'],
+                    pipetteId='p1', labwareId='lw7', volume=s.volume)
+        elif s.op in _COMMANDS:
+            command(_COMMANDS[s.op], {gen.OP_PICK: TRUE['T_PICK_S'], gen.OP_DROP: TRUE['T_DROP_S'],
+                                      gen.OP_TOUCH: TRUE['T_TOUCH_S']}[s.op], pipetteId='p1', labwareId='lw7')
+    command('comment', message=f'{gen.TELEMETRY_MARKER} {len(plan)}')
+    for c in commands:
+        c['params'].pop('_result', None)
+    return {'data': {'commands': commands}}
+
+def test_parse_run_log(tmp_path):
+    plan = _plan()
+    log = _run_log(plan)
+    path = tmp_path / 'run.json'
+    path.write_text(json.dumps(log), encoding='utf-8')
+    df = gen.parse_run_log(str(path))
+    pd.testing.assert_frame_equal(df, gen.parse_run_log(json.dumps(log)))
+    assert len(df) == len(log['data']['commands'])
+    assert list(df['step'][:2]) == [-1, -1] and df['started'].iloc[0] == 0.0
+    assert list(df.loc[df['marker'], 'step']) == gen.checkpoints(plan) + [len(plan)]
+    picks = df[df['type'].eq('pickUpTip')]
+    assert (picks['seconds'] == TRUE['T_PICK_S']).all() and set(picks['pipette']) == {'p1000_single_gen2'}
+    aspirates = df[df['type'].eq('aspirate')]
+    assert list(aspirates['volume']) == [500, 700, 900]
+    assert list(aspirates['seconds']) == pytest.approx([TRUE['T_MOVE_S'] + v / TRUE['FLOW_UL_S'] for v in (500, 700, 900)])
+    assert set(aspirates['labware']) == {'vials'} and set(aspirates['slot']) == {'7'}
+
+def test_fit_recovers_the_robot_timing():
+    plan = _plan()
+    fitted = gen.fit_timing(gen.parse_run_log(_run_log(plan)), plan)
+    for name in ('T_PICK_S', 'T_DROP_S', 'T_MOVE_S', 'T_TOUCH_S'):
+        assert fitted[name] == pytest.approx(TRUE[name], abs=1e-3)
+    assert fitted['FLOW_UL_S']['p1000'] == pytest.approx(TRUE['FLOW_UL_S'], abs=0.01)
+    assert fitted['FLOW_UL_S']['p300'] == gen.FLOW_UL_S['p300']
+    assert set(fitted['unfitted']) == {'T_AIR_GAP_S', 'T_MODULE_START_S', 'FLOW_UL_S[p300]', 'FLOW_UL_S[p300m]'}
+    assert fitted['stretches'] == len(gen.checkpoints(plan)) and fitted['rms_error_s'] == pytest.approx(0, abs=0.01)
+    # The fitted model predicts the logged run
+    assert gen.estimate_runtime(plan, fitted) == pytest.approx(gen.parse_run_log(_run_log(plan))['seconds'].sum())
@@ -0,0 +1,91 @@
+import asyncio
+import functools
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+import OpentronsProtocolService as service_mod
+from conftest import load_use_case
+
+def _payload(**extra):
+    stocks, labware, transfers = load_use_case('Example')
+    return {'stocks': stocks.to_csv(index=False), 'labware': labware.to_dict('records'),
+            'transfers': transfers.to_csv(index=False), **extra}
+
+def _dechunk(data: bytes) -> bytes:
+    out = b''
+    while True:
+        size, _, data = data.partition(b'\r\n')
+        n = int(size, 16)
+        if n == 0:
+            return out
+        out, data = out + data[:n], data[n + 2:]
+
+async def _request(port, method, path, body=None):
+    """(status, headers, body) of one request on its own connection."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = b'' if body is None else json.dumps(body).encode('utf-8')
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: test\r\nConnection: close\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode('latin-1') + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b'\r\n\r\n')
+    status_line, *lines = head.decode('latin-1').split('\r\n')
+    headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(':') for line in lines)}
+    if headers.get('transfer-encoding') == 'chunked':
+        content = _dechunk(content)
+    return int(status_line.split()[1]), headers, content
+
+@pytest.fixture(scope='module')
+def service():
+    svc = service_mod.GenerationService(workers=1)
+    yield svc
+    svc.close()
+
+def _run(service, *requests):
+    """Serve 'service' on a free port for the given requests; returns their responses in order."""
+    async def go():
+        server = await asyncio.start_server(functools.partial(service_mod._handle, service), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return [await _request(port, *r) for r in requests]
+    return asyncio.run(go())
+
+def test_generate_streams_the_protocol(service):
+    [(status, headers, body)] = _run(service, ('POST', '/generate', _payload(emitter='loop')))
+    assert status == 200 and headers['transfer-encoding'] == 'chunked'
+    expected, _ = gen.generate_protocol_text(*load_use_case('Example'), emitter='loop')
+    assert body.decode('utf-8') == expected
+
+@pytest.mark.parametrize('payload, message', [
+    ({k: v for k, v in _payload().items() if k != 'labware'}, "Missing 'labware' table"),
+    (_payload(options={'fast': True}), "Unknown options \\['fast'\\]"),
+])
+def test_bad_payload_is_a_400(service, payload, message):
+    [(status, _, body)] = _run(service, ('POST', '/generate', payload))
+    assert status == 400
+    assert re.search(message, json.loads(body)['error'])
+
+def test_unknown_route_and_method(service):
+    (missing, _, _), (wrong, _, _) = _run(service, ('GET', '/nope'), ('GET', '/generate'))
+    assert (missing, wrong) == (404, 405)
+
+def test_repeated_request_is_served_from_the_cache(service):
+    payload = _payload(emitter='json')
+    before = service.health()
+    first, second, (_, _, health) = _run(service, ('POST', '/generate', payload), ('POST', '/generate', payload),
+                                         ('GET', '/health'))
+    assert first[0] == second[0] == 200 and first[2] == second[2]
+    health = json.loads(health)
+    assert (health['misses'] - before['misses'], health['hits'] - before['hits']) == (1, 1)
+
+def test_service_imports_without_tk():
+    script = "import sys; sys.modules['tkinter'] = None; import OpentronsProtocolService"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', script], cwd=root, check=True)
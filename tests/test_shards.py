@@ -0,0 +1,56 @@
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+from protocol_stub import run_protocol
+
+_DST = ['receiving labware location', 'receiving well location']
+
+def _dispensed(plan):
+    out = Counter()
+    for s in plan:
+        if s.op == gen.OP_DISPENSE:
+            out[(s.slot, s.well)] += s.volume
+    return out
+
+def test_component_shards_keep_each_destination_on_one_robot():
+    stocks, _, transfers = load_use_case('HTE_Reaction_SamplePrep')
+    shards, seconds = gen.shard_transfers(stocks, transfers, 3)
+    assert len(shards) == len(seconds) == 3 and all(len(s) for s in shards)
+    owners = {}
+    for k, shard in enumerate(shards):
+        for dst in map(tuple, shard[_DST].to_numpy().tolist()):
+            assert owners.setdefault(dst, k) == k
+    pd.testing.assert_frame_equal(pd.concat(shards).sort_values(list(transfers.columns)).reset_index(drop=True),
+                                  transfers.sort_values(list(transfers.columns)).reset_index(drop=True))
+    assert max(seconds) < 0.5 * sum(seconds)
+
+def test_shard_plans_run_and_add_up_to_the_campaign(tmp_path):
+    stocks, labware, transfers = load_use_case('HTE_Reaction_SamplePrep')
+    written, summary = gen.generate_protocol_shards(stocks, labware, transfers, str(tmp_path / 'hte.py'), 3)
+    assert [p for p, _ in written] == [str(tmp_path / f'hte_robot{k}.py') for k in (1, 2, 3)]
+    total = Counter()
+    for path, plan in written:
+        with open(path, encoding='utf-8') as f:
+            assert run_protocol(f.read()) == run_protocol(gen.emit_python(plan))
+        total.update(_dispensed(plan))
+    whole = gen.build_plan(stocks.copy(), labware, transfers)
+    assert {k: round(v, 6) for k, v in total.items()} == {k: round(v, 6) for k, v in _dispensed(whole).items()}
+    assert summary['rows'] == [len(s) for s in gen.shard_transfers(stocks, transfers, 3)[0]]
+
+def test_stock_drawn_adds_up_to_the_unsharded_draw(tmp_path):
+    stocks, labware, transfers = load_use_case('HTE_Reaction_SamplePrep')
+    _, summary = gen.generate_protocol_shards(stocks, labware, transfers, str(tmp_path / 'hte.py'), 3)
+    drawn = Counter()
+    for used in summary['stock_drawn_ul']:
+        drawn.update(used)
+    after = stocks.copy()
+    gen.build_plan(after, labware, transfers)
+    whole = {f"{after.at[i, 'stock name']} ({after.at[i, 'labware location']}:{after.at[i, 'well location']})":
+             float(stocks.at[i, 'volume(ul)']) - float(after.at[i, 'volume(ul)']) for i in stocks.index}
+    assert drawn and drawn.keys() == {k for k, ul in whole.items() if ul > 0}
+    for key, ul in drawn.items():
+        assert ul == pytest.approx(whole[key], abs=0.1 * len(summary['stock_drawn_ul']))
@@ -0,0 +1,36 @@
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_small_case, load_use_case
+from protocol_stub import run_protocol
+
+_TIP_COMMANDS = ('pick_up_tip', 'drop_tip')
+
+def _liquid_commands(plan):
+    return [cmd for cmd in run_protocol(gen.emit_python(plan)) if cmd[1] not in _TIP_COMMANDS]
+
+@pytest.mark.parametrize('limits', [{'max_seconds': 1800}, {'max_steps': 200}, {'max_tips': {'p300': 10}}])
+def test_parts_respect_every_limit(limits):
+    plan = gen.build_plan(*load_use_case('HTE_Reaction_SamplePrep'))
+    parts = gen.split_plan(plan, **limits)
+    assert len(parts) > 1
+    for part in parts:
+        if 'max_seconds' in limits:
+            assert gen.estimate_runtime(part) <= limits['max_seconds']
+        if 'max_steps' in limits:
+            assert len(part) <= limits['max_steps']
+        if 'max_tips' in limits:
+            assert gen.tip_counts(part).get('p300', 0) <= limits['max_tips']['p300']
+    # Every part runs on its own (tips held across a cut are dropped and re-picked) and together
+    # they move the same liquid as the unsplit plan
+    assert sum((_liquid_commands(part) for part in parts), []) == _liquid_commands(plan)
+
+def test_limit_below_one_transfer_raises():
+    plan = gen.build_plan(*load_use_case('Example'))
+    with pytest.raises(RuntimeError, match="max_steps"):
+        gen.split_plan(plan, max_steps=3)
+
+def test_cut_never_falls_inside_a_module_step():
+    plan = gen.build_plan(*load_small_case('heater_shaker'))
+    with pytest.raises(RuntimeError, match="max_seconds"):
+        gen.split_plan(plan, max_seconds=30)
@@ -0,0 +1,21 @@
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_small_case, load_use_case
+from protocol_stub import run_protocol
+
+def test_stamped_runs_the_unrolled_commands(any_case):
+    *tables, options = any_case
+    plan = gen.build_plan(*tables, **options)
+    assert run_protocol(gen.emit_python_stamped(plan)) == run_protocol(gen.emit_python(plan))
+
+def test_copies_start_on_transfer_boundaries():
+    plan = gen.build_plan(*load_use_case('HTE_Reaction_SamplePrep'))
+    starts = set(gen.checkpoints(plan)) | {len(plan)}
+    regions = gen.stamp_patterns(plan)
+    copies = [c for _, _, cs in regions if cs for c in cs]
+    assert all(a in starts and b in starts for a, b in copies)
+    # The per-source tip is held across copies, so stamping must not wait for tip-free boundaries
+    assert sum(b - a for a, b in copies) > len(plan) // 2
+
+def test_one_pattern_per_plate():
+    plan = gen.build_plan(*load_small_case('plates'))
+    assert [(a, b, len(cs)) for a, b, cs in gen.stamp_patterns(plan)] == [(0, len(plan), 4)]
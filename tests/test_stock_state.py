@@ -0,0 +1,35 @@
+import pandas as pd
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+
+def _volumes(state):
+    return dict(zip(state['stock name'], state['volume(ul)']))
+
+def test_filled_wells_are_stocks_in_the_state():
+    stocks, labware, transfers = load_use_case('HTE_Reaction_SamplePrep')
+    gen.build_plan(stocks, labware, transfers)
+    state = gen.stock_state(stocks, labware)
+    # A destination holds what it received less what later rows drew from it
+    filled = transfers.groupby(['receiving labware location', 'receiving well location'])['volume 1'].sum()
+    drawn = transfers.groupby(['stock labware location 1', 'stock well location 1'])['volume 1'].sum()
+    net = filled.sub(drawn.rename_axis(filled.index.names), fill_value=0).loc[filled.index]
+    assert len(state) == len(load_use_case('HTE_Reaction_SamplePrep')[0]) + len(filled)
+    volumes = _volumes(state)
+    assert {f'{slot}:{well}': volumes[f'{slot}:{well}'] for slot, well in filled.index} == \
+           {f'{slot}:{well}': float(ul) for (slot, well), ul in net.items()}
+    assert state['height (mm)'].iloc[-len(filled):].notna().all()
+
+def test_next_day_starts_from_the_exported_state(tmp_path):
+    stocks, labware, day1 = load_use_case('Example')
+    day2 = day1.assign(**{'stock well location 1': 'A2', 'receiving well location': 'A3', 'volume 1': 400})
+    written = gen.generate_protocol_days(stocks, labware, [day1, day2], str(tmp_path / 'run.py'))
+    (_, state1_path, _), (_, state2_path, _) = written
+    state1 = pd.read_csv(state1_path)
+    assert _volumes(state1) == {'H2O': 3500.0, '7:A2': 1500.0}
+    # Day 2 draws from the well day 1 filled
+    assert _volumes(pd.read_csv(state2_path)) == {'H2O': 3500.0, '7:A2': 1100.0, '7:A3': 400.0}
+    # The same as feeding the day-1 file back in by hand
+    by_hand = state1.copy()
+    gen.build_plan(by_hand, labware, day2)
+    assert _volumes(by_hand) == _volumes(pd.read_csv(state2_path))
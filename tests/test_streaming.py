@@ -0,0 +1,36 @@
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+
+def _stream(tables, path, chunksize, emitter, options):
+    stocks, labware, transfers = tables
+    chunks = [transfers[k:k + chunksize] for k in range(0, len(transfers), chunksize)]
+    gen.generate_protocol_streaming(stocks.copy(), labware, chunks, str(path), chunksize=chunksize,
+                                    emitter=emitter, **options)
+    return path.read_text(encoding='utf-8')
+
+@pytest.mark.parametrize('emitter', ['python', 'loop'])
+def test_streaming_writes_the_in_memory_protocol(any_case, emitter, tmp_path):
+    *tables, options = any_case
+    text, _ = gen.generate_protocol_text(tables[0].copy(), *tables[1:], emitter=emitter, **options)
+    assert _stream(tables, tmp_path / 'protocol.py', gen.DEFAULT_CHUNK_ROWS, emitter, options) == text
+
+@pytest.mark.parametrize('emitter', ['python', 'loop'])
+def test_chunk_boundaries_do_not_change_the_protocol(use_case, emitter, tmp_path):
+    # Module steps are only overlapped within a chunk, so this holds for sheets without module actions
+    text, _ = gen.generate_protocol_text(use_case[0].copy(), *use_case[1:], emitter=emitter)
+    assert _stream(use_case, tmp_path / 'protocol.py', 5, emitter, {}) == text
+
+@pytest.mark.parametrize('ext', ['.parquet', '.feather'])
+def test_arrow_files_stream_the_in_memory_protocol(use_case, ext, tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    stocks, labware, transfers = use_case
+    source = tmp_path / f'transfers{ext}'
+    table = pa.Table.from_pandas(transfers, preserve_index=False)
+    if ext == '.parquet':
+        pytest.importorskip('pyarrow.parquet').write_table(table, source, row_group_size=7)
+    else:
+        pytest.importorskip('pyarrow.feather').write_feather(table, source, compression='uncompressed')
+    text, _ = gen.generate_protocol_text(stocks.copy(), labware, transfers)
+    gen.generate_protocol_streaming(stocks.copy(), labware, str(source), str(tmp_path / 'protocol.py'), chunksize=5)
+    assert (tmp_path / 'protocol.py').read_text(encoding='utf-8') == text
@@ -0,0 +1,25 @@
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+from protocol_stub import run_protocol
+
+def test_telemetry_runs_the_python_commands(any_case):
+    *tables, options = any_case
+    plan = gen.build_plan(*tables, **options)
+    assert run_protocol(gen.emit_python_telemetry(plan)) == run_protocol(gen.emit_python(plan))
+
+def test_marker_before_every_transfer(use_case):
+    plan = gen.build_plan(*use_case)
+    comments = [cmd[1] for cmd in run_protocol(gen.emit_python_telemetry(plan), comments=True) if cmd[0] == 'comment']
+    marks = [int(text.split()[1]) for text in comments if text.startswith(gen.TELEMETRY_MARKER)]
+    assert marks == gen.checkpoints(plan) + [len(plan)]
+
+def test_timing_is_a_parameter_not_module_state():
+    plan = gen.build_plan(*load_use_case('HTE_Reaction_SamplePrep'))
+    default = gen.estimate_runtime(plan)
+    picks = sum(gen.tip_counts(plan).values())
+    slower = gen.timing_model({'T_PICK_S': gen.T_PICK_S + 1.0})
+    assert gen.estimate_runtime(plan, slower) == pytest.approx(default + picks)
+    assert gen.estimate_runtime(plan) == default
+    assert gen.timing_model()['T_PICK_S'] == gen.T_PICK_S
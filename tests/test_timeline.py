@@ -0,0 +1,61 @@
+import math
+
+import pandas as pd
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_use_case
+
+def test_volumes_and_heights_over_the_run():
+    plan = gen.build_plan(*load_use_case('Example'))
+    timeline = gen.VolumeTimeline(plan)
+    assert [timeline.volume_at(7, 'A1', step) for step in (0, 1, 3, 4, len(plan))] == [5000, 4100, 4100, 3500, 3500]
+    assert timeline.volume_at(7, 'a01', 2) == 4100
+    assert [timeline.volume_at(7, 'A2', step) for step in (1, 2, 5)] == [0, 900, 1500]
+    assert math.isnan(timeline.height_at(7, 'A1', 0))
+    assert timeline.height_at(7, 'A1', 3) == plan[1].z
+    assert math.isnan(timeline.height_at(7, 'A2', 5))
+    assert list(timeline.history(7, 'A1')['volume (ul)']) == [4100, 3500]
+    with pytest.raises(RuntimeError, match="No volume events for 7:B1"):
+        timeline.volume_at(7, 'B1', 0)
+
+def _repeated():
+    stocks, labware, transfers = load_use_case('Example')
+    return stocks, labware, pd.concat([transfers] * 3, ignore_index=True).assign(**{'volume 1': 100, 'mix': 'no'})
+
+def test_optimized_plan_keeps_its_timeline():
+    stocks, labware, transfers = _repeated()
+    plan = gen.build_plan(stocks, labware, transfers)
+    optimized, report = gen.optimize_plan(plan, {(7, 'A1')})
+    assert report['dispenses_merged'] > 0
+    before, after = gen.VolumeTimeline(plan), gen.VolumeTimeline(optimized)
+    for slot, well in before.vessels():
+        assert after.volume_at(slot, well, len(optimized)) == before.volume_at(slot, well, len(plan))
+        # Every event sits on an aspirate or dispense of its own well in the optimized plan
+        for step in after.history(slot, well)['step']:
+            s = optimized[step]
+            assert s.op in (gen.OP_ASPIRATE, gen.OP_DISPENSE) and (s.slot, s.well) == (slot, well)
+
+def test_slice_keeps_the_events_inside_it():
+    plan = gen.build_plan(*load_use_case('CalibrationCurve_SamplePrep'))
+    start, end = gen.checkpoints(plan)[3], gen.checkpoints(plan)[-2]
+    whole, part = gen.VolumeTimeline(plan), gen.VolumeTimeline(plan.slice(start, end))
+    for slot, well in part.vessels():
+        for step in range(start, end):
+            assert part.volume_at(slot, well, step - start) == pytest.approx(whole.volume_at(slot, well, step))
+
+@pytest.mark.parametrize('optimize', [False, True])
+def test_cli_reports_one_well(tmp_path, capsys, optimize):
+    stocks, labware, transfers = _repeated()
+    paths = [str(tmp_path / name) for name in ('stocks.csv', 'labware.csv', 'transfers.csv')]
+    for table, path in zip((stocks, labware, transfers), paths):
+        table.to_csv(path, index=False)
+    extra = ['--optimize'] if optimize else []
+    gen.timeline_cli(paths + ['7', 'A2'] + extra)
+    history = capsys.readouterr().out.splitlines()
+    assert history[0] == 'step,volume (ul),z (mm)'
+    assert float(history[-1].split(',')[1]) == 300.0
+    # Three additions; with --optimize the first two are one merged dispense
+    assert len({line.split(',')[0] for line in history[1:]}) == (2 if optimize else 3)
+    gen.timeline_cli(paths + ['7', 'A1', '--step', '1000'] + extra)
+    assert capsys.readouterr().out.startswith("7:A1 after step 1000: 4700.0 µL, last aspirate z")
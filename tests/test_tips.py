@@ -0,0 +1,41 @@
+import pandas as pd
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import SMALL_CASES, load_small_case
+from protocol_stub import run_protocol
+
+def test_consolidated_tip_is_not_reused_for_a_plain_stock():
+    # MeCN row, then X and Y consolidated into B1, then MeCN again: the tip that carried X and Y
+    # must not go back into the MeCN stock
+    plan = gen.build_plan(*load_small_case('consolidate'), **SMALL_CASES['consolidate'])
+    steps = [s for s in plan if s.op != gen.OP_COMMENT]
+    last = max(k for k, s in enumerate(steps) if s.op == gen.OP_ASPIRATE)
+    assert (steps[last].slot, steps[last].well) == (1, 'A1')
+    assert steps[last - 1].op == gen.OP_PICK
+    assert plan.report['tips_saved'] == 0
+
+def test_same_stock_still_shares_a_tip():
+    stocks, labware, transfers = load_small_case('consolidate')
+    transfers = transfers[transfers['consolidate'].isna()]
+    plan = gen.build_plan(stocks, labware, transfers, tip_compatibility=True)
+    assert gen.tip_counts(plan) == {'p300': 1}
+
+def test_column_transfers_use_the_multichannel():
+    plan = gen.build_plan(*load_small_case('multichannel'), **SMALL_CASES['multichannel'])
+    commands = run_protocol(gen.emit_python(plan))
+    by_pipette = {}
+    for model, cmd, *args in commands:
+        if cmd == 'dispense':
+            by_pipette.setdefault(model, []).append(args[1][1:3])
+    # Whole columns go in one multichannel dispense from the rack it owns; the lone well stays single
+    assert by_pipette == {'p300_multi_gen2': [(2, 'A1'), (2, 'A2'), (3, 'A1')],
+                          'p300_single_gen2': [(3, 'A2')]}
+    assert {args[0] for model, cmd, *args in commands if cmd == 'pick_up_tip' and model == 'p300_multi_gen2'} == {11}
+
+def test_tipracks_of_any_size_get_their_own_variable():
+    stocks, labware, transfers = load_small_case('multichannel')
+    labware = pd.concat([labware, labware[labware['location'].isin([9, 10])].assign(location=[8, 7])])
+    plan = gen.build_plan(stocks, labware, transfers)
+    racks = [var for var, title, _ in plan.labware if 'tiprack' in title]
+    assert racks == ['tiprack_300ul', 'tiprack_200ul', 'tiprack_200ul_11', 'tiprack_300ul_8', 'tiprack_200ul_7']
+    assert 'tiprack_200ul_7' in gen.emit_python(plan)
@@ -0,0 +1,27 @@
+import pandas as pd
+import pytest
+
+import OpentronsProtocolGenerator_V1 as gen
+from conftest import load_small_case, load_use_case
+
+def test_overfilled_destination_is_reported_by_sheet_row():
+    stocks, labware, transfers = load_small_case('plates')
+    transfers.loc[2, 'volume 1'] = 400.0
+    with pytest.raises(RuntimeError, match=r"transfers row 3: 2:B1 \(corning_96_wellplate_360ul_flat\) reaches 400.0 µL"):
+        gen.build_plan(stocks, labware, transfers)
+
+def test_pooled_stock_is_checked_as_a_whole():
+    stocks, labware, transfers = load_use_case('HTE_Reaction_SamplePrep')
+    # The sheet's solvent reservoir sits in slot 7 while the transfers draw from slot 8
+    stocks.loc[stocks['labware location'] == 7, 'labware location'] = 8
+    name = 'MeCN'
+    assert gen.build_plan(stocks.copy(), labware, transfers, pool_stocks=True) is not None
+    stocks.loc[stocks['stock name'] == name, 'volume(ul)'] = 1.0
+    with pytest.raises(RuntimeError, match=f"pool:{name} is drawn down"):
+        gen.build_plan(stocks, labware, transfers, pool_stocks=True)
+
+def test_lookup_id_reads_the_custom_diameters():
+    labware = pd.DataFrame({'labware_title': list(gen._CUSTOM_ID_CM) + ['nest_12_reservoir_15ml'],
+                            'location': [1, 2, 3, 4]})
+    ids = [gen.lookup_id({'stock labware location 1': slot}, labware) for slot in labware['location']]
+    assert ids == list(gen._CUSTOM_ID_CM.values()) + [gen.DEFAULT_ID_CM]